@@ -72,6 +72,11 @@ data_upload_lambda = DataUploadLambda(  # Creates sample data for clients to tes
     app,
     'dataUploadLambda',
     dataset_table=dynamo_db_stack.dataset_table,
+    batch_size=100,  # stream records handed to one invocation
+    max_batching_window=cdk.Duration.seconds(5),  # how long the stream waits to fill a batch
+    parallelization_factor=1,  # concurrent invocations per stream shard
+    preview_rows=1000,  # larger datasets get a preview right away and their full files in the background
+    materialize_max_rows=100000,  # larger datasets are served by the row api until their full files are requested
     env=env
 )
 
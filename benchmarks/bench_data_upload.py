@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+""" Throughput benchmark for the data upload lambda
+
+Drives lambda_function.lambda_handler end to end with synthetic DynamoDB stream events, against moto's in-process
+stand-ins for DynamoDB and S3, over a matrix of row counts, column counts and attribute type mixes. Every case runs in
+its own python process so peak RSS and cold caches are measured per case. Results are written as JSON; pass an earlier
+result file as --baseline to fail on throughput regressions.
+
+Besides wall time and peak RSS (which includes moto's in-memory copy of everything uploaded), every case measures the
+peak memory the generation and encoding pipeline itself takes for each format (the growth of the peak RSS of a fresh
+process writing the dataset to a null sink, which also counts arrow's allocations) against the raw size of the data (8
+bytes per value), and the time per value, to check that wide schemas scale linearly in columns x rows. A case of at
+least --min-memory-check-bytes of raw data whose pipeline takes more memory than that fails.
+
+A case whose records the lambda reports in batchItemFailures did not generate its dataset, so its numbers mean
+nothing: the benchmark prints it as FAILED and exits with an error.
+
+    python benchmarks/bench_data_upload.py --rows 1000 100000 --columns 5 50 5000 --formats csv parquet
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import resource
+import subprocess
+from decimal import Decimal
+
+lambda_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas', 'data_upload_lambda')
+layer_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas', 'instrumentation_layer', 'python')
+
+TABLE_NAME = 'dataset_table'
+BUCKET_NAME = 'artificien-fake-dataset-storage'
+
+# attribute types cycled through to build the columns of each type mix ('F' being any double)
+TYPE_MIXES = {
+    'numeric': ['N', 'F'],
+    'strings': ['S'],
+    'mixed': ['N', 'B', 'S', 'F'],
+}
+
+
+def dataset_item(dataset_id, num_rows, num_columns, type_mix, output_formats):
+    attribute_types = [TYPE_MIXES[type_mix][i % len(TYPE_MIXES[type_mix])] for i in range(num_columns)]
+    numeric = [t for t in attribute_types if t not in ('S', 'B')]
+    return {
+        'dataset_id': dataset_id,
+        'attributes': ['attribute_{}'.format(i) for i in range(num_columns)],
+        'attributeTypes': attribute_types,
+        'attributeRangeMins': [Decimal(0)] * len(numeric),
+        'attributeRangeMaxes': [Decimal(1000)] * len(numeric),
+        'num_devices': num_rows,
+        'category': 'Benchmark',
+        'sampleDataFormats': output_formats,
+    }
+
+
+def stream_event(item, sequence_number):
+    from boto3.dynamodb.types import TypeSerializer
+    serializer = TypeSerializer()
+    return {'Records': [{
+        'eventID': str(sequence_number),
+        'eventName': 'INSERT',
+        'dynamodb': {
+            'SequenceNumber': str(sequence_number),
+            'NewImage': {key: serializer.serialize(value) for key, value in item.items()}
+        }
+    }]}
+
+
+class StageTimer:
+    """ Accumulates wall time per stage by wrapping the functions that make up each stage """
+
+    def __init__(self):
+        self.seconds = {}
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+
+        setattr(owner, name, timed)
+
+
+class NullSink:
+    """ Write-only file object that only counts the bytes written to it """
+
+    def __init__(self):
+        self.bytes_written = 0
+        self.closed = False
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+def peak_rss_bytes():
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def set_up_environment():
+    os.environ.update({
+        'AWS_REGION': 'us-east-1',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'DYNAMO_TABLE': TABLE_NAME,
+        'S3_BUCKET': BUCKET_NAME,
+        'MAX_WORKERS': '1',
+        # generate every case in full, in one phase, inside the measured invocation
+        'PREVIEW_ROWS': str(2 ** 62),
+        'MATERIALIZE_MAX_ROWS': str(2 ** 62),
+    })
+    sys.path.insert(0, lambda_dir)
+    sys.path.insert(1, layer_dir)
+
+
+def run_pipeline(case, output_format):
+    """ Peak memory taken by generating and encoding a whole dataset in one format, in this (fresh) process """
+    set_up_environment()
+    import helper_functions
+    from output_formats import write_rows
+    import pyarrow.parquet  # noqa: F401 (loaded before the baseline: the library itself is not the pipeline)
+
+    item = dataset_item('benchmark', case['rows'], case['columns'], case['type_mix'], [output_format])
+    dataset = helper_functions.grab_relevant_info('dataset_id', item['dataset_id'], item)
+    before = peak_rss_bytes()
+    write_rows(output_format, dataset.plan, dataset.vocabulary, dataset.seed, 0, dataset.num_rows, NullSink(),
+               dataset.parquet_compression)
+    return peak_rss_bytes() - before
+
+
+def run_case(case):
+    """ Runs one benchmark case in this (fresh) process and returns its measurements """
+    set_up_environment()
+
+    import boto3
+    from moto import mock_aws
+
+    with mock_aws():
+        boto3.client('s3').create_bucket(Bucket=BUCKET_NAME)
+        boto3.client('dynamodb').create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{'AttributeName': 'dataset_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'dataset_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+        import lambda_function
+        import helper_functions
+        from schema_plan import SchemaPlan
+        from s3_streaming import S3MultipartWriter
+
+        timer = StageTimer()
+        timer.wrap(helper_functions, 'grab_relevant_info', 'schema_fetch')
+        timer.wrap(SchemaPlan, 'sample', 'generation')
+        timer.wrap(helper_functions, 'write_columns', 'write_total')
+        timer.wrap(S3MultipartWriter, '_upload_part', 'upload_parts')
+        timer.wrap(S3MultipartWriter, 'close', 'upload_close')
+        timer.wrap(helper_functions, 'copy_object', 'cache_copy')
+
+        item = dataset_item('benchmark', case['rows'], case['columns'], case['type_mix'], case['formats'])
+        boto3.resource('dynamodb').Table(TABLE_NAME).put_item(Item=item)
+        event = stream_event(item, 1)
+
+        start = time.perf_counter()
+        response = lambda_function.lambda_handler(event, None)
+        total = time.perf_counter() - start
+
+        objects = boto3.client('s3').list_objects_v2(Bucket=BUCKET_NAME, Prefix='/benchmark')['Contents']
+        bytes_written = sum(o['Size'] for o in objects)
+
+    # parts uploaded while the data was being written count as upload, not encoding
+    seconds = timer.seconds
+    generation = seconds.get('generation', 0.0)
+    upload = seconds.get('upload_parts', 0.0) + seconds.get('upload_close', 0.0)
+    stages = {
+        'schema_fetch': seconds.get('schema_fetch', 0.0),
+        'generation': generation,
+        'encoding': max(seconds.get('write_total', 0.0) - generation - seconds.get('upload_parts', 0.0), 0.0),
+        'upload': upload + seconds.get('cache_copy', 0.0),
+    }
+
+    return dict(case, **{
+        'failures': len(response['batchItemFailures']),
+        'seconds': total,
+        'rows_per_second': case['rows'] / total,
+        'ns_per_value': total / (case['rows'] * case['columns']) * 1e9,
+        'bytes_written': bytes_written,
+        'peak_rss_bytes': peak_rss_bytes(),
+        'raw_bytes': case['rows'] * case['columns'] * 8,
+        'stage_seconds': stages,
+    })
+
+
+def run_in_subprocess(*arguments):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__)] + list(arguments),
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+    ).stdout
+    # the lambda prints its metrics to stdout; the result is the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_case(case):
+    """ Runs a case, then its pipeline in every format, each in a fresh process """
+    result = run_in_subprocess('--case', json.dumps(case))
+    result['pipeline_peak_bytes_by_format'] = {
+        output_format: run_in_subprocess('--pipeline', json.dumps(case), output_format)
+        for output_format in case['formats']
+    }
+    result['pipeline_peak_bytes'] = max(result['pipeline_peak_bytes_by_format'].values())
+    return result
+
+
+def exceeds_memory(result, min_raw_bytes):
+    # below min_raw_bytes, the pipeline's fixed overhead (libraries, buffers) outweighs the data
+    return result['raw_bytes'] >= min_raw_bytes and result['pipeline_peak_bytes'] > result['raw_bytes']
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    return result['rows'], result['columns'], result['type_mix'], tuple(result['formats'])
+
+
+def find_regressions(results, baseline, tolerance):
+    baseline_results = {case_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = baseline_results.get(case_key(result))
+        if before and result['rows_per_second'] < before['rows_per_second'] * (1 - tolerance):
+            regressions.append((case_key(result), before['rows_per_second'], result['rows_per_second']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--columns', type=int, nargs='+', default=[5, 20, 100, 5000])
+    parser.add_argument('--type-mixes', nargs='+', default=sorted(TYPE_MIXES), choices=sorted(TYPE_MIXES))
+    parser.add_argument('--formats', nargs='+', default=['csv', 'parquet'],
+                        help='sampleDataFormats of the benchmark dataset')
+    parser.add_argument('--max-values', type=int, default=50000000, help='skip cases with more rows x columns')
+    parser.add_argument('--output', default=os.path.join(tempfile.gettempdir(), 'bench_output.json'),
+                        help='result file (in the temporary directory unless given)')
+    parser.add_argument('--baseline', help='earlier result file to compare rows/s against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed rows/s drop before failing')
+    parser.add_argument('--min-memory-check-bytes', type=int, default=256 * 1024 * 1024,
+                        help='raw data size from which the pipeline must take no more memory than the data')
+    parser.add_argument('--case', help=argparse.SUPPRESS)  # internal: run a single case in this process
+    parser.add_argument('--pipeline', nargs=2, help=argparse.SUPPRESS)  # internal: the pipeline of a case, one format
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(json.loads(args.case))))
+        return 0
+    if args.pipeline:
+        print(json.dumps(run_pipeline(json.loads(args.pipeline[0]), args.pipeline[1])))
+        return 0
+
+    results = []
+    for type_mix in args.type_mixes:
+        for num_columns in args.columns:
+            for num_rows in args.rows:
+                if num_rows * num_columns > args.max_values:
+                    continue
+                case = {'rows': num_rows, 'columns': num_columns, 'type_mix': type_mix, 'formats': args.formats}
+                result = measure_case(case)
+                results.append(result)
+                if result['failures']:
+                    print('FAILED {}: {} record(s) in batchItemFailures'.format(case_key(result), result['failures']))
+                    continue
+                print('{type_mix:>8} {columns:>5} cols {rows:>9} rows: {rows_per_second:>12,.0f} rows/s '
+                      '{ns_per_value:>7,.0f} ns/value {peak_rss_bytes:>13,} B peak RSS '
+                      '{pipeline_peak_bytes:>13,} B pipeline peak {raw_bytes:>13,} B raw '
+                      '{bytes_written:>13,} B written'.format(**result))
+                for output_format, peak in result['pipeline_peak_bytes_by_format'].items():
+                    print('{:>24} pipeline peak {:>13,} B'.format(output_format, peak))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'results': results,
+        }, f, indent=2)
+    print('results written to {}'.format(args.output))
+
+    failed = [case_key(result) for result in results if result['failures']]
+    for key in failed:
+        print('FAILED {}'.format(key))
+    for result in results:
+        if exceeds_memory(result, args.min_memory_check_bytes):
+            print('FAILED {}: pipeline peak {:,} B above {:,} B of raw data'.format(
+                case_key(result), result['pipeline_peak_bytes'], result['raw_bytes']))
+            failed.append(case_key(result))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for key, before, after in regressions:
+            print('REGRESSION {}: {:,.0f} -> {:,.0f} rows/s'.format(key, before, after))
+        failed += regressions
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+""" Cold start benchmark for the model retrieval lambda
+
+Every run starts a fresh python process, the way a new lambda container does, and measures how long importing
+get_models takes, which of the heavy packages (torch, syft, requests) that import pulled in, and the time to the first
+response of the handler: GET /test (no AWS calls) and GET /retrieve/status (the first DynamoDB call of the container),
+against moto's in-process stand-in for DynamoDB. Results are written as JSON; pass an earlier result file as
+--baseline to fail if the median import or first response got slower.
+
+    python benchmarks/bench_model_retrieval_startup.py --runs 10 --output startup_output.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import platform
+import statistics
+import subprocess
+
+lambda_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas', 'model_retrieval_lambda')
+layer_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambdas', 'instrumentation_layer', 'python')
+
+# packages that must not be loaded until a request needs them
+HEAVY_PACKAGES = ['torch', 'syft', 'requests']
+
+MEASUREMENTS = ['import_seconds', 'test_response_seconds', 'status_response_seconds']
+
+
+def run_once():
+    """ Cold starts get_models in this (fresh) process and returns its measurements """
+    os.environ.update({
+        'AWS_REGION': 'us-east-1',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'S3_BUCKET': 'artificien-retrieved-models-storage',
+    })
+    sys.path.insert(0, lambda_dir)
+    sys.path.insert(1, layer_dir)
+
+    start = time.perf_counter()
+    import get_models
+    import_seconds = time.perf_counter() - start
+    # checked before moto is imported, as moto itself loads requests
+    loaded = [package for package in HEAVY_PACKAGES if package in sys.modules]
+
+    import boto3
+    from moto import mock_aws
+
+    with mock_aws():
+        boto3.client('dynamodb').create_table(
+            TableName='model_retrieval_job_table',
+            KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'job_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+
+        start = time.perf_counter()
+        get_models.lambda_handler({'httpMethod': 'GET', 'path': '/test'}, None)
+        test_response_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        response = get_models.lambda_handler({'httpMethod': 'GET', 'path': '/retrieve/status',
+                                              'queryStringParameters': {'jobId': 'benchmark'}}, None)
+        status_response_seconds = time.perf_counter() - start
+
+    return {
+        'import_seconds': import_seconds,
+        'test_response_seconds': test_response_seconds,
+        'status_response_seconds': status_response_seconds,
+        'status_code': response['statusCode'],
+        'heavy_packages_loaded': loaded,
+    }
+
+
+def run_in_subprocess():
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--once'],
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True
+    ).stdout
+    # the lambda prints its metrics to stdout; the result is the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(runs):
+    return {name: {'median': statistics.median(run[name] for run in runs), 'max': max(run[name] for run in runs)}
+            for name in MEASUREMENTS}
+
+
+def find_regressions(summary, baseline, tolerance):
+    return [(name, baseline['summary'][name]['median'], summary[name]['median']) for name in MEASUREMENTS
+            if summary[name]['median'] > baseline['summary'][name]['median'] * (1 + tolerance)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5, help='cold starts to measure')
+    parser.add_argument('--output', default=os.path.join(tempfile.gettempdir(), 'startup_output.json'),
+                        help='result file (in the temporary directory unless given)')
+    parser.add_argument('--baseline', help='earlier result file to compare the medians against')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown of a median before failing')
+    parser.add_argument('--once', action='store_true', help=argparse.SUPPRESS)  # internal: one cold start
+    args = parser.parse_args()
+
+    if args.once:
+        print(json.dumps(run_once()))
+        return 0
+
+    runs = []
+    for run in range(args.runs):
+        result = run_in_subprocess()
+        runs.append(result)
+        print('run {:>3}: import {:>7.3f} s, GET /test {:>7.3f} s, GET /retrieve/status {:>7.3f} s, '
+              'heavy packages loaded: {}'.format(run, result['import_seconds'], result['test_response_seconds'],
+                                                 result['status_response_seconds'],
+                                                 ', '.join(result['heavy_packages_loaded']) or 'none'))
+
+    summary = summarize(runs)
+    with open(args.output, 'w') as f:
+        json.dump({
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'summary': summary,
+            'runs': runs,
+        }, f, indent=2)
+    print('results written to {}'.format(args.output))
+
+    failed = any(run['heavy_packages_loaded'] for run in runs)
+    if failed:
+        print('FAILED: heavy packages are imported at startup')
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(summary, json.load(f), args.tolerance)
+        for name, before, after in regressions:
+            print('REGRESSION {}: {:.3f} -> {:.3f} s'.format(name, before, after))
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
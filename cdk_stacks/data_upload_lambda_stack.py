@@ -1,56 +1,178 @@
+import json
 from aws_cdk.aws_lambda_event_sources import(
     DynamoEventSource,
     SqsDlq
 )
 from aws_cdk import core as cdk
 import aws_cdk.aws_lambda as aws_lambda
+from aws_cdk.aws_lambda_python import PythonFunction
 import aws_cdk.aws_sqs as sqs
 import aws_cdk.aws_iam as iam
 import aws_cdk.aws_s3 as s3
+import aws_cdk.aws_apigateway as apigateway
+from cdk_stacks.instrumentation_layer import create_instrumentation_layer
 
 
 class DataUploadLambda(cdk.Stack):
 
-    def __init__(self, scope: cdk.Construct, id: str, dataset_table, **kwargs) -> None:
-        """ Deploy the DynamoDB Database and Data Tables """
+    def __init__(self, scope: cdk.Construct, id: str, dataset_table, batch_size: int = 100,
+                 max_batching_window: cdk.Duration = cdk.Duration.seconds(5), parallelization_factor: int = 1,
+                 generation_workers: int = 4, materialize_max_rows: int = 100000, preview_rows: int = 1000,
+                 cache_expiration: cdk.Duration = cdk.Duration.days(7), **kwargs) -> None:
+        """ Deploy the lambda that generates a sample dataset for every new dataset in the dataset table
+
+        batch_size, max_batching_window and parallelization_factor configure how the dataset table's stream is fed
+        to the lambda; generation_workers bounds how many datasets of one batch the lambda generates concurrently.
+        Datasets with more than preview_rows rows first get a preview of that many rows, and their full files from an
+        asynchronous invocation of the row api function. Datasets with more than materialize_max_rows rows are served
+        page by page by the row api, and only written to S3 in full when requested. Generated files are also kept under
+        their content hash in the bucket's cache/ prefix for cache_expiration.
+        """
         super().__init__(scope, id, **kwargs)
 
         # Create S3 Bucket to store the sample data CSVs in
         bucket_name = 'artificien-fake-dataset-storage'
-        self.bucket = s3.Bucket(self, 'FakeDataBucket', bucket_name=bucket_name)
+        # every file is written under its content hash in cache/ and copied into place (see upload_sample_data). The
+        # copies in cache/ serve retries, redrives and re-registrations, which come within days, and are otherwise
+        # just a second copy of every dataset, so they expire
+        self.bucket = s3.Bucket(
+            self,
+            'FakeDataBucket',
+            bucket_name=bucket_name,
+            lifecycle_rules=[s3.LifecycleRule(prefix='cache/', expiration=cache_expiration)]
+        )
         
+        # both functions share the instrumentation layer and the role
+        self.instrumentation_layer = create_instrumentation_layer(self)
+        self.lambda_role = self.create_lambda_role()
+
+        # the row api function also writes the full files of datasets registered in two phases
+        row_api_function_name = 'FakeDataRowApiLambda'
+
         # Create the lambda function
+        # PythonFunction bundles the packages in the lambda's requirements.txt (numpy) alongside the code
         lambda_dir = './lambdas/data_upload_lambda'
-        self.lambda_function = aws_lambda.Function(
+        self.lambda_function = PythonFunction(
             self,
             'FakeDataLambda',
             function_name='FakeDataLambda',
             runtime=aws_lambda.Runtime.PYTHON_3_8,
-            role=self.create_lambda_role(),
+            role=self.lambda_role,
             environment={
                 'DYNAMO_TABLE': dataset_table.table_name,  # tells function which table to read from
-                'S3_BUCKET': bucket_name  # tells the function which bucket to write to
+                'S3_BUCKET': bucket_name,  # tells the function which bucket to write to
+                'MAX_WORKERS': str(generation_workers),  # datasets generated concurrently per batch
+                'MATERIALIZE_MAX_ROWS': str(materialize_max_rows),  # larger datasets are left to the row api
+                'PREVIEW_ROWS': str(preview_rows),  # larger datasets get a preview first, their full files later
+                'GENERATION_FUNCTION': row_api_function_name,  # writes those full files
+                'GENERATION_LEASE_SECONDS': '60'  # the timeout: a generation lease outlives the worker holding it
             },
-            code=aws_lambda.Code.from_asset(lambda_dir),  # directory where code is located
-            handler='lambda_function.lambda_handler',  # the function the lambda invokes,
-            memory_size=128,  # MB - shouldn't need many MB to generate fake data,
-            timeout=cdk.Duration.seconds(5)
+            entry=lambda_dir,  # directory where code is located
+            index='lambda_function.py',
+            handler='lambda_handler',  # the function the lambda invokes,
+            layers=[self.instrumentation_layer],  # timers and CloudWatch metrics (see instrumentation.py)
+            memory_size=512,  # MB - each concurrent generation streams through its own chunk and upload part buffers
+            timeout=cdk.Duration.seconds(60)  # a whole batch of datasets is generated per invocation
         )
 
         # Save failed writes of Fake Datasets to an SQS queue so that we do not experience data loss
-        dead_letter_queue = sqs.Queue(self, 'deadLetterQueueNewDataset');
+        self.dead_letter_queue = sqs.Queue(self, 'deadLetterQueueNewDataset');
 
         # Configure the Dynamo Trigger - sends the lambda the new data schema every time a new developer signs on
         self.lambda_function.add_event_source(
             DynamoEventSource(
                 table=dataset_table,
                 starting_position=aws_lambda.StartingPosition.LATEST,
-                batch_size=1,
+                batch_size=batch_size,
+                max_batching_window=max_batching_window,
+                parallelization_factor=parallelization_factor,
                 retry_attempts=5,
-                on_failure=SqsDlq(dead_letter_queue)
+                on_failure=SqsDlq(self.dead_letter_queue)
             )
         )
 
+        # Only new datasets are generated (see lambda_function.process_record), so the status and lease updates the
+        # functions write back to the dataset table are filtered out before they invoke the lambda. The lambda reports
+        # the records that failed, so only those are retried or sent to the DLQ. DynamoEventSource supports neither
+        # in this CDK version, so they are set on the event source mapping it created
+        for child in self.lambda_function.node.children:
+            if isinstance(child, aws_lambda.EventSourceMapping):
+                child.node.default_child.add_property_override('FilterCriteria', {
+                    'Filters': [{'Pattern': json.dumps({'eventName': ['INSERT']})}]
+                })
+                child.node.default_child.add_property_override('FunctionResponseTypes', ['ReportBatchItemFailures'])
+
+        self.generation_dead_letter_queue = sqs.Queue(self, 'deadLetterQueueSampleDataGeneration')
+
+        # Create the row api - serves any page of rows of a dataset, generated on request (see row_api.py)
+        self.row_api_function = PythonFunction(
+            self,
+            'FakeDataRowApiLambda',
+            function_name=row_api_function_name,
+            runtime=aws_lambda.Runtime.PYTHON_3_8,
+            role=self.lambda_role,
+            environment={
+                'DYNAMO_TABLE': dataset_table.table_name,
+                'S3_BUCKET': bucket_name,
+                'MATERIALIZE_MAX_ROWS': str(materialize_max_rows),
+                'PREVIEW_ROWS': str(preview_rows),
+                'GENERATION_FUNCTION': row_api_function_name,
+                'GENERATION_LEASE_SECONDS': '300'
+            },
+            entry=lambda_dir,
+            index='row_api.py',
+            handler='lambda_handler',
+            layers=[self.instrumentation_layer],
+            memory_size=1024,  # MB - a page is built in memory before it is returned
+            timeout=cdk.Duration.minutes(5),  # a materialize request writes the full files of a large dataset
+            retry_attempts=2,  # asynchronous generation requests are retried, then kept in their own queue
+            dead_letter_queue=self.generation_dead_letter_queue
+        )
+
+        # both functions hand full generations to an asynchronous invocation of the row api function (referenced by
+        # name, as a reference to the function would make its role depend on it)
+        self.lambda_role.add_to_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=['lambda:InvokeFunction'],
+            resources=[self.format_arn(service='lambda', resource='function', resource_name=row_api_function_name,
+                                       sep=':')]
+        ))
+
+        # arrow and the compressed formats are binary, so every body goes through API gateway base64 encoded
+        self.row_api = apigateway.LambdaRestApi(
+            self,
+            'FakeDataRowApi',
+            handler=self.row_api_function,
+            binary_media_types=['*/*']
+        )
+
+        # Create the redrive function - regenerates the datasets of both dead letter queues when invoked, e.g. after an
+        # outage (see redrive.py)
+        dead_letter_queues = [self.dead_letter_queue, self.generation_dead_letter_queue]
+        self.redrive_function = PythonFunction(
+            self,
+            'FakeDataRedriveLambda',
+            function_name='FakeDataRedriveLambda',
+            runtime=aws_lambda.Runtime.PYTHON_3_8,
+            role=self.lambda_role,
+            environment={
+                'DYNAMO_TABLE': dataset_table.table_name,
+                'S3_BUCKET': bucket_name,
+                'MATERIALIZE_MAX_ROWS': str(materialize_max_rows),
+                'GENERATION_FUNCTION': row_api_function_name,
+                'GENERATION_LEASE_SECONDS': '900',
+                'DEAD_LETTER_QUEUE_URLS': ','.join(queue.queue_url for queue in dead_letter_queues)
+            },
+            entry=lambda_dir,
+            index='redrive.py',
+            handler='lambda_handler',
+            layers=[self.instrumentation_layer],
+            memory_size=2048,  # MB - several datasets are generated at the same time
+            timeout=cdk.Duration.minutes(15)
+        )
+        for queue in dead_letter_queues:
+            queue.grant_consume_messages(self.redrive_function)
+
     def create_lambda_role(self):
         return iam.Role(
             self,
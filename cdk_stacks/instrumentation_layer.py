@@ -0,0 +1,17 @@
+from aws_cdk import core as cdk
+import aws_cdk.aws_lambda as aws_lambda
+
+
+def create_instrumentation_layer(scope: cdk.Construct, id: str = 'InstrumentationLayer') -> aws_lambda.LayerVersion:
+    """ Lambda layer with the timing/metrics module (instrumentation.py) shared by all of our lambdas
+
+    Every stack builds its own copy of the layer from the same source, rather than importing one from another stack,
+    so that changing the layer never has to replace a version another stack still exports/depends on.
+    """
+    return aws_lambda.LayerVersion(
+        scope,
+        id,
+        code=aws_lambda.Code.from_asset('./lambdas/instrumentation_layer'),  # python/ ends up on the lambda's path
+        compatible_runtimes=[aws_lambda.Runtime.PYTHON_3_7, aws_lambda.Runtime.PYTHON_3_8],
+        description='Timers, CloudWatch embedded metrics and sampled debug logging for the Artificien lambdas'
+    )
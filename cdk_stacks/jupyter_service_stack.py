@@ -117,7 +117,8 @@ class JupyterServiceStack(cdk.Stack):
                 
                 # Use a cronjob to pull new sample data and tutorials to the repository every 30 minutes
                 "sudo crontab -l > mycron",
-                "echo \'0,30 * * * * aws s3 cp s3://artificien-fake-dataset-storage /srv/data/sample_data --recursive\' >> mycron ",
+                "echo \'0,30 * * * * aws s3 cp s3://artificien-fake-dataset-storage /srv/data/sample_data --recursive " +
+                "--exclude \"cache/*\"\' >> mycron ",
                 "echo \'0,30 * * * * aws s3 cp s3://artificien-tutorials /srv/data/sample_data --recursive\' >> mycron ",
                 "sudo crontab mycron",
                 "rm mycron",
@@ -5,8 +5,10 @@ from aws_cdk import (
     aws_apigateway as apigateway,
     aws_ec2 as ec2,
     aws_efs as efs,
-    aws_s3 as s3
+    aws_s3 as s3,
+    aws_dynamodb as dynamodb
 )
+from cdk_stacks.instrumentation_layer import create_instrumentation_layer
 
 
 class ModelRetrievalLambda(cdk.Stack):
@@ -50,32 +52,65 @@ class ModelRetrievalLambda(cdk.Stack):
             posix_user=efs.PosixUser(gid="1001", uid="1001")
         )
 
-        # Create S3 Bucket to store the pickled model in
+        # Create S3 Bucket to store the pickled model in; retrievals of a 'latest' checkpoint that can't be cached are
+        # dropped after a week, with their jobs
         bucket_name = 'artificien-retrieved-models-storage'
-        self.bucket = s3.Bucket(self, 'PickledModelsBucket', bucket_name=bucket_name)
+        self.bucket = s3.Bucket(
+            self, 'PickledModelsBucket',
+            bucket_name=bucket_name,
+            lifecycle_rules=[s3.LifecycleRule(prefix='latest/', expiration=cdk.Duration.days(7))]
+        )
+
+        # Create the table of retrieval jobs: /retrieve queues a job and an asynchronous invocation of the lambda
+        # does it
+        job_table_name = 'model_retrieval_job_table'
+        self.job_table = dynamodb.Table(
+            self, 'ModelRetrievalJobTable',
+            table_name=job_table_name,
+            partition_key=dynamodb.Attribute(
+                name='job_id',
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute='expires_at',  # finished jobs are dropped after a week
+            removal_policy=cdk.RemovalPolicy.DESTROY
+        )
 
         # Create the lambda function
         lambda_dir = './lambdas/model_retrieval_lambda'
+        function_name = 'ModelRetrievalLambdaFunction'
         self.lambda_function = _lambda.Function(
             self,
             'ModelRetrievalLambdaFunction',
             vpc=vpc,
             security_group=lambda_security_group,
-            function_name='ModelRetrievalLambdaFunction',
+            function_name=function_name,
             environment={
-                'S3_BUCKET': bucket_name
+                'S3_BUCKET': bucket_name,
+                'JOB_TABLE': job_table_name,
+                'RETRIEVAL_LEASE_SECONDS': '900'  # the timeout: a retrieval lease outlives the job holding it
             },
             runtime=_lambda.Runtime.PYTHON_3_7,
             code=_lambda.Code.from_asset(lambda_dir),  # directory where code is located
             handler='get_models.lambda_handler',  # the function the lambda invokes,
-            memory_size=1024,  # May need a large amount of memory to download and store models temporarily
-            timeout=cdk.Duration.seconds(60),  # may take a long time to load syft for the first time
+            layers=[create_instrumentation_layer(self)],  # timers and CloudWatch metrics (see instrumentation.py)
+            memory_size=512,  # models are streamed to S3 a few 8 MB parts at a time, whatever their size
+            timeout=cdk.Duration.minutes(15),  # a retrieval job streams a whole model; API calls return in moments
+            retry_attempts=2,  # failed retrieval jobs are started over
             filesystem=_lambda.FileSystem.from_efs_access_point(access_point, '/mnt/python')
         )
 
         # Allow the above fn to provide the lambda with required permissions for EFS/ VPC execution, then add the rest
         add_permissions_to_lambda(self.lambda_function.role)
 
+        # retrieval jobs run in an asynchronous invocation of the lambda itself (referenced by name, as a reference to
+        # the function would make its role depend on it)
+        self.lambda_function.add_to_role_policy(iam.PolicyStatement(
+            effect=iam.Effect.ALLOW,
+            actions=['lambda:InvokeFunction'],
+            resources=[self.format_arn(service='lambda', resource='function', resource_name=function_name, sep=':')]
+        ))
+
         # Create the REST API and allow it to invoke the lambda
         # TODO: This lambda is open to the world right now. Figure out how to use passed IAM principles to gate access.
         self.api = apigateway.LambdaRestApi(
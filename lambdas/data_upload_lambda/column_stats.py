@@ -0,0 +1,150 @@
+# Importing relevant packages
+import numpy as np
+from schema_plan import BINARY_TYPE, INTEGER_TYPE, STRING_TYPE
+
+'''
+Per-column statistics of a dataset, accumulated chunk by chunk in the same pass that generates and writes it:
+
+- numeric (and binary) columns: count, min, max, mean, variance and a histogram with fixed bins over the column's
+  range (one bin per value for integer columns with few values)
+- string columns: count, number of distinct words and the most frequent words
+'''
+
+HISTOGRAM_BINS = 20
+TOP_WORDS = 10
+
+# bump whenever the statistics written for the same rows change
+STATS_VERSION = 1
+
+
+class NumericStats:
+    """ Streaming count/min/max/mean/variance (merged chunk by chunk, Chan et al.) and fixed-bin histograms of a group
+    of numeric columns, computed for all of them at once """
+
+    def __init__(self, columns, lows, highs, integer):
+        self.columns = list(columns)
+        lows, highs, integer = np.array(lows, dtype=np.float64), np.array(highs, dtype=np.float64), np.array(integer)
+
+        # every histogram has equal-width bins: one per value for integer columns with few values, HISTOGRAM_BINS
+        # over the range otherwise
+        per_value = integer & (highs - lows + 1 <= HISTOGRAM_BINS)
+        self.bins = np.where(per_value, highs - lows + 1, HISTOGRAM_BINS).astype(np.int64)
+        self.first_edge = np.where(per_value, lows - 0.5, lows)
+        self.width = np.where(per_value, 1.0, np.where(highs > lows, highs - lows, 1.0) / HISTOGRAM_BINS)
+
+        size = len(self.columns)
+        self.count, self.mean, self.m2 = 0, np.zeros(size), np.zeros(size)
+        self.min, self.max = np.full(size, np.inf), np.full(size, -np.inf)
+        self.histogram = np.zeros((size, HISTOGRAM_BINS), dtype=np.int64)
+
+    def observe(self, data_columns):
+        values = np.array([data_columns[column] for column in self.columns], dtype=np.float64)  # (columns, rows)
+        count = values.shape[1]
+        if count == 0:
+            return
+        mean = values.mean(axis=1)
+        m2 = ((values - mean[:, None]) ** 2).sum(axis=1)
+
+        delta, total = mean - self.mean, self.count + count
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+
+        self.min = np.minimum(self.min, values.min(axis=1))
+        self.max = np.maximum(self.max, values.max(axis=1))
+
+        # the bin of every value (the last bin includes the top of the range), counted for all columns in one go
+        bins = np.clip(((values - self.first_edge[:, None]) / self.width[:, None]).astype(np.int64), 0,
+                       self.bins[:, None] - 1)
+        bins += np.arange(len(self.columns))[:, None] * HISTOGRAM_BINS
+        self.histogram += np.bincount(bins.ravel(), minlength=self.histogram.size).reshape(self.histogram.shape)
+
+    def to_dicts(self):
+        for i, column in enumerate(self.columns):
+            bins = self.bins[i]
+            yield column, {
+                'count': self.count,
+                'min': float(self.min[i]) if self.count else None,
+                'max': float(self.max[i]) if self.count else None,
+                'mean': float(self.mean[i]),
+                'variance': float(self.m2[i] / self.count) if self.count else 0.0,
+                'histogram': {'edges': (self.first_edge[i] + self.width[i] * np.arange(bins + 1)).tolist(),
+                              'counts': self.histogram[i, :bins].tolist()}
+            }
+
+
+class WordStats:
+    """ Word frequencies of a group of string columns, counted for all of them at once """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.count = 0
+        self.word_ids = {}  # word -> column of counts
+        self.counts = np.zeros((len(self.columns), 0), dtype=np.int64)
+
+    def observe(self, data_columns):
+        values = np.array([data_columns[column] for column in self.columns])  # (columns, rows)
+        words, inverse = np.unique(values, return_inverse=True)
+        ids = np.array([self.word_ids.setdefault(word, len(self.word_ids)) for word in words.tolist()], dtype=np.int64)
+
+        num_words = len(self.word_ids)
+        if num_words > self.counts.shape[1]:
+            self.counts = np.pad(self.counts, ((0, 0), (0, num_words - self.counts.shape[1])))
+
+        flat = ids[inverse.reshape(values.shape)] + np.arange(len(self.columns))[:, None] * num_words
+        self.counts += np.bincount(flat.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+        self.count += values.shape[1]
+
+    def to_dicts(self):
+        words = np.array(list(self.word_ids), dtype=object)
+        for i, column in enumerate(self.columns):
+            top = np.argsort(-self.counts[i], kind='stable')[:TOP_WORDS]
+            yield column, {
+                'count': self.count,
+                'distinct': int(np.count_nonzero(self.counts[i])),
+                'top_words': [{'word': words[j], 'count': int(self.counts[i, j])} for j in top if self.counts[i, j]]
+            }
+
+
+class DatasetStats:
+    """ Statistics of every column of a dataset, fed with the column chunks as they are generated """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.rows = 0
+
+        ranges = {column: (low, high) for column, low, high in plan.ranges}
+        numeric = [(column, 0, 1, True) if attribute_type == BINARY_TYPE else
+                   (column,) + ranges[column] + (attribute_type == INTEGER_TYPE,)
+                   for column, attribute_type in enumerate(plan.types) if attribute_type != STRING_TYPE]
+        words = [column for column, attribute_type in enumerate(plan.types) if attribute_type == STRING_TYPE]
+
+        self.groups = []
+        if numeric:
+            self.groups.append(NumericStats(*zip(*numeric)))
+        if words:
+            self.groups.append(WordStats(words))
+
+    def observe(self, data_columns):
+        for group in self.groups:
+            group.observe(data_columns)
+        self.rows += len(data_columns[0])
+
+    def observe_chunks(self, column_chunks):
+        """ Passes the chunks through unchanged, observing each one on the way """
+        for data_columns in column_chunks:
+            self.observe(data_columns)
+            yield data_columns
+
+    def to_dict(self):
+        stats = dict(item for group in self.groups for item in group.to_dicts())
+        columns = {name: dict(stats[column], type=attribute_type)
+                   for column, (name, attribute_type) in enumerate(zip(self.plan.columns, self.plan.types))}
+        return {'rows': self.rows, 'stats_version': STATS_VERSION, 'columns': columns}
+
+
+def summarize(stats):
+    """ The statistics of a dataset without the histograms and words, for copies that must stay small """
+    columns = {name: {key: value for key, value in column.items() if key not in ('histogram', 'top_words')}
+               for name, column in stats['columns'].items()}
+    return dict(stats, columns=columns)
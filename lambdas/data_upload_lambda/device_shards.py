@@ -0,0 +1,91 @@
+# Importing relevant packages
+from typing import NamedTuple
+import numpy as np
+from fake_data import generate_column_chunks
+from output_formats import CSV, OUTPUT_FORMATS
+from schema_plan import INTEGER_TYPE
+
+'''
+Sample data split into one shard per simulated device, for simulating federated training in notebooks.
+
+Device d holds rows [d * rows_per_device, (d + 1) * rows_per_device) of the dataset, so with no skew the shards are
+exactly the single-file sample data cut into pieces. With skew > 0 every device only sees part of the range of each
+numeric column: its values are squeezed to (1 - skew) of the range, at a position drawn per device and column. At
+skew 1 every device has a single value per numeric column. String and binary columns are never skewed.
+'''
+
+# random streams of the devices are seeded by (seed, device, DEVICE_STREAM), so they never overlap the row blocks
+DEVICE_STREAM = 1
+
+
+class DeviceLayout(NamedTuple):
+    """ How the sample data of a dataset is split into device shards """
+    num_devices: int
+    rows_per_device: int
+    skew: float = 0.0
+    output_format: str = CSV
+
+    @property
+    def num_rows(self):
+        return self.num_devices * self.rows_per_device
+
+
+def device_rng(seed, device):
+    return np.random.default_rng([seed, device, DEVICE_STREAM])
+
+
+def device_file_name(device, output_format):
+    return 'device-{:05d}{}'.format(device, OUTPUT_FORMATS[output_format].extension)
+
+
+def skew_columns(plan, data_columns, rng, skew):
+    if skew == 0:
+        return data_columns
+
+    data_columns = list(data_columns)
+    positions = rng.random(len(plan.ranges))  # where in its range each numeric column of this device lies
+    for (column, low, high), position in zip(plan.ranges, positions):
+        values = low + (data_columns[column] - low) * (1 - skew) + position * (high - low) * skew
+        data_columns[column] = np.rint(values).astype(np.int64) if plan.types[column] == INTEGER_TYPE else values
+    return data_columns
+
+
+def generate_device_columns(plan, vocabulary, seed, layout):
+    """ Yields (device, data_columns) for every device in order, each holding that device's rows
+
+    The dataset is generated block by block as usual and cut at device boundaries, so small devices don't each draw a
+    whole block; at most one device's rows are carried over from one block to the next.
+    """
+    device, parts, carried_rows = 0, [], 0
+    for data_columns in generate_column_chunks(plan, vocabulary, seed, 0, layout.num_rows):
+        position, chunk_rows = 0, len(data_columns[0])
+        while position < chunk_rows:
+            taken = min(layout.rows_per_device - carried_rows, chunk_rows - position)
+            parts.append([column[position:position + taken] for column in data_columns])
+            position += taken
+            carried_rows += taken
+
+            if carried_rows == layout.rows_per_device:
+                device_columns = parts[0] if len(parts) == 1 else [np.concatenate(c) for c in zip(*parts)]
+                yield device, skew_columns(plan, device_columns, device_rng(seed, device), layout.skew)
+                device, parts, carried_rows = device + 1, [], 0
+
+
+def device_manifest(dataset_id, plan, layout, content_hash, shards):
+    """ Index of the device shards, written next to them as manifest.json
+
+    shards holds (device, bytes) of every shard; files are named relative to the manifest, so notebooks can load any
+    subset of the devices from a synced copy of the bucket
+    """
+    return {
+        'dataset_id': dataset_id,
+        'content_hash': content_hash,
+        'columns': list(plan.columns),
+        'types': list(plan.types),
+        'format': layout.output_format,
+        'num_devices': layout.num_devices,
+        'rows_per_device': layout.rows_per_device,
+        'skew': layout.skew,
+        'devices': [{'device': device, 'file': device_file_name(device, layout.output_format),
+                     'rows': layout.rows_per_device, 'bytes': size} for device, size in shards]
+    }
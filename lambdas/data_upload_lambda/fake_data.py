@@ -0,0 +1,118 @@
+# Importing relevant packages
+import io
+import os
+import csv
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from instrumentation import metrics
+
+# Rows are generated in blocks of up to BLOCK_ROWS rows, and at most BLOCK_CELLS values, so a block of a wide schema
+# stays as small as one of a narrow schema. Every block draws from its own random stream, seeded by (seed, block
+# number), so row i of a dataset is the same no matter which range, shard or process generates it
+BLOCK_ROWS = 10000
+BLOCK_CELLS = 500000
+
+# bump whenever the rows generated for a given schema, row count and seed change, so cached artifacts are not reused
+GENERATOR_VERSION = 3
+
+
+def block_rng(seed, block):
+    return np.random.default_rng([seed, block])
+
+
+# the number of rows in every block of a schema
+def plan_block_rows(plan):
+    return max(1, min(BLOCK_ROWS, BLOCK_CELLS // len(plan.columns)))
+
+
+# yields the columns (numpy arrays) of rows [start, stop) of a dataset, one block at a time, so the whole dataset never
+# has to sit in memory
+def generate_column_chunks(plan, vocabulary, seed, start, stop):
+    block_rows = plan_block_rows(plan)
+    for block in range(start // block_rows, (stop + block_rows - 1) // block_rows):
+        block_start = block * block_rows
+
+        # always draw the whole block (the random streams only line up that way), then keep the rows in range
+        rows = slice(max(start - block_start, 0), min(stop - block_start, block_rows))
+        with metrics.timer('GenerationTime'):
+            data_columns = plan.sample(block_rows, vocabulary, block_rng(seed, block), rows)
+        metrics.put_metric('RowsGenerated', len(data_columns[0]) if data_columns else 0, 'Count')
+        yield data_columns
+
+
+# one chunk of columns as a list of rows of plain python values; the columns are laid into one object array first, so
+# the conversion is one call per column and one for the whole chunk rather than one per value
+def chunk_rows(data_columns):
+    rows = np.empty((len(data_columns[0]), len(data_columns)), dtype=object)
+    for column, values in enumerate(data_columns):
+        rows[:, column] = values
+    return rows.tolist()
+
+
+# same chunks as generate_column_chunks, as lists of rows
+def generate_row_chunks(plan, vocabulary, seed, start, stop):
+    for data_columns in generate_column_chunks(plan, vocabulary, seed, start, stop):
+        yield chunk_rows(data_columns)
+
+
+# csv-encodes every chunk of rows (after the header, if there is one), yielding one bytes object per chunk
+def encode_csv_chunks(columns, row_chunks, header=True):
+    buffer = io.StringIO()
+    spamwriter = csv.writer(buffer, delimiter=',', quotechar='|', quoting=csv.QUOTE_MINIMAL)
+    if header:
+        spamwriter.writerow(columns)
+
+    for rows in row_chunks:
+        spamwriter.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+    # a range without rows still has to emit its header
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+# rows [start, stop) as csv; only the range that starts the dataset carries the header, so the parts of a sharded
+# dataset concatenate to exactly the csv a single process would write
+def encode_csv_range(plan, vocabulary, seed, start, stop):
+    row_chunks = generate_row_chunks(plan, vocabulary, seed, start, stop)
+    return encode_csv_chunks(plan.columns, row_chunks, header=(start == 0))
+
+
+# splits [0, num_rows) into num_shards contiguous ranges, aligned to whole blocks so no block is drawn twice
+def shard_ranges(num_rows, num_shards, block_rows=BLOCK_ROWS):
+    num_blocks = (num_rows + block_rows - 1) // block_rows
+    num_shards = max(1, min(num_shards, num_blocks))
+
+    ranges = []
+    for shard in range(num_shards):
+        start = min(num_blocks * shard // num_shards * block_rows, num_rows)
+        stop = min(num_blocks * (shard + 1) // num_shards * block_rows, num_rows)
+        ranges.append((start, stop))
+    return ranges
+
+
+def part_file_name(part):
+    return 'part-{:05d}.csv'.format(part)
+
+
+def write_csv_part(plan, vocabulary, seed, start, stop, path):
+    with open(path, 'wb') as f:
+        for data in encode_csv_range(plan, vocabulary, seed, start, stop):
+            f.write(data)
+    return path
+
+
+def write_csv_parts(plan, vocabulary, seed, num_rows, directory, num_shards, max_workers=None):
+    """ Generate a dataset on a process pool as ordered part files (part-00000.csv, ...) in directory
+
+    Concatenating the returned paths in order gives the same bytes as generating the whole dataset in one process.
+    """
+    ranges = shard_ranges(num_rows, num_shards, plan_block_rows(plan))
+    paths = [os.path.join(directory, part_file_name(part)) for part in range(len(ranges))]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(write_csv_part, plan, vocabulary, seed, start, stop, path)
+                   for (start, stop), path in zip(ranges, paths)]
+        return [future.result() for future in futures]
@@ -1,233 +1,623 @@
 # Importing relevant packages
 import os
-import csv
-import random
+import json
+import time
+import uuid
+import hashlib
+from decimal import Decimal
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
 import boto3
-
-# setting up connection with dynamoDB
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import Binary, TypeDeserializer
+from column_stats import STATS_VERSION, DatasetStats, summarize
+from device_shards import DeviceLayout, device_file_name, device_manifest, generate_device_columns
+from fake_data import GENERATOR_VERSION, chunk_rows, generate_column_chunks
+from instrumentation import logger, metrics
+from output_formats import CSV, OUTPUT_FORMATS, PARQUET, PARQUET_COMPRESSIONS, write_columns
+from s3_streaming import S3MultipartWriter
+from schema_plan import SchemaError, SchemaPlan, compile_schema
+from vocabulary import UNIFORM, ZIPF, Vocabulary, get_vocabulary
+
+# setting up connection with dynamoDB; clients are thread safe, resources are not, so every worker thread of the
+# lambda handler gets its own dynamoDB resource (see get_table)
 region_name = os.environ["AWS_REGION"]
-dynamodb = boto3.resource('dynamodb', region_name=region_name)
 s3 = boto3.client('s3')
+thread_local = threading.local()
+deserializer = TypeDeserializer()
 
 # Will only ever make a fake dataset from dataset table, so may as well declare it!
-table = dynamodb.Table(os.environ['DYNAMO_TABLE'])
+table_name = os.environ['DYNAMO_TABLE']
 s3_bucket_name = os.environ['S3_BUCKET']
 
-
-def get_random_words():
-    f = open('words.txt', 'r')
-    content = f.read()
-    word_list = str.split(content)
-    return word_list
+# every generated artifact is also kept under its content hash, so identical requests are a HEAD plus a server-side
+# copy instead of a full regeneration (the JupyterHub cron excludes this prefix when it syncs the bucket). Objects
+# under it expire after a week (see the stack), so a dataset's files are only stored twice while retries are likely
+cache_prefix = 'cache/'
+content_hash_metadata_key = 'content-hash'
+
+# datasets with more rows than this are only served page by page through the row api (row_api.py) until someone asks
+# for the full files (or the dataset sets materializeSampleData)
+materialize_max_rows = int(os.environ.get('MATERIALIZE_MAX_ROWS', '100000'))
+
+# the column statistics copied into the dataset item lose their histograms and words beyond this size. Items are
+# limited to max_item_bytes, so the statistics of very wide schemas are left out of the item altogether (the item
+# points at their sidecar in S3 instead); item_update_margin_bytes is kept for the other attributes of the update
+max_item_stats_bytes = 100 * 1024
+max_item_bytes = 400 * 1000
+item_update_margin_bytes = 4 * 1024
+
+# device shards of one dataset uploaded at the same time
+shard_workers = int(os.environ.get('SHARD_WORKERS', '16'))
+
+# Datasets with more rows than preview_rows are registered in two phases: the stream handler only writes a preview (the
+# first preview_rows rows and the schema) and hands the full files to an asynchronous invocation of the generation
+# function (the row api, see row_api.py). sample_data_status on the dataset item tells which phase a dataset is in
+preview_rows = int(os.environ.get('PREVIEW_ROWS', '1000'))
+generation_function = os.environ.get('GENERATION_FUNCTION')
+lambda_client = boto3.client('lambda')
+
+SAMPLE_DATA_PREVIEW = 'preview'
+SAMPLE_DATA_READY = 'ready'
+
+# Generations of the same dataset that overlap (a stream retry, a DLQ redrive, a materialize request) are serialized by
+# a lease on the dataset item: the worker holding it writes the files, any other waits up to lease_wait_seconds for it
+# and otherwise leaves the work to the holder. The lease lasts as long as the function may run (its timeout), so a
+# worker that is killed doesn't block the dataset for longer than that
+generation_lease_seconds = int(os.environ.get('GENERATION_LEASE_SECONDS', '900'))
+lease_wait_seconds = float(os.environ.get('GENERATION_LEASE_WAIT_SECONDS', '10'))
+lease_poll_seconds = 1
+
+
+class SampleDataset(NamedTuple):
+    """ Everything needed to (re)generate the sample data of one dataset """
+    dataset_id: str
+    plan: SchemaPlan
+    num_rows: int
+    vocabulary: Vocabulary
+    seed: int
+    output_formats: tuple = (CSV,)
+    parquet_compression: str = PARQUET_COMPRESSIONS[0]
+    materialize: bool = True  # whether the full files are written as soon as the dataset is registered
+    devices: DeviceLayout = None  # set if the sample data is written as one shard per device instead of one file
+
+    def content_hash(self, output_format=CSV):
+        # the bytes are fully determined by the schema, row count, vocabulary, seed, generator version and format
+        normalized = json.dumps({
+            'schema': self.plan.schema_hash,
+            'num_rows': self.num_rows,
+            'vocabulary': [self.vocabulary.name, self.vocabulary.distribution],
+            'seed': self.seed,
+            'generator_version': GENERATOR_VERSION,
+            'format': output_format,
+            'compression': self.parquet_compression if output_format == PARQUET else None
+        }, sort_keys=True)
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def devices_content_hash(self):
+        # the shards are the rows of the whole dataset in the shard format, cut up and skewed per device
+        normalized = json.dumps({
+            'rows': self.content_hash(self.devices.output_format),
+            'rows_per_device': self.devices.rows_per_device,
+            'skew': self.devices.skew
+        }, sort_keys=True)
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def stats_content_hash(self):
+        normalized = json.dumps({
+            'rows': self.devices_content_hash() if self.devices is not None else self.content_hash(CSV),
+            'stats_version': STATS_VERSION
+        }, sort_keys=True)
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def preview_key(self):
+        return "/" + self.dataset_id + ".preview.json"
+
+    def stats_key(self):
+        # the statistics sidecar sits next to the data
+        if self.devices is not None:
+            return "/" + self.dataset_id + "/devices/stats.json"
+        return "/" + self.dataset_id + ".stats.json"
+
+
+class GenerationLease(NamedTuple):
+    """ The right to write the sample data of a dataset, until expires (epoch seconds) """
+    dataset_id: str
+    owner: str
+    version: int  # generation_version of the item when the lease was taken; fences off any earlier holder
+    expires: int
+
+
+# datasets without an explicit sampleSeed get one derived from their id, so regenerating a dataset reproduces it
+def default_seed(dataset_id):
+    return int.from_bytes(hashlib.sha256(dataset_id.encode('utf-8')).digest()[:8], 'big')
+
+
+def get_table():
+    if not hasattr(thread_local, 'table'):
+        dynamodb = boto3.session.Session().resource('dynamodb', region_name=region_name)
+        thread_local.table = dynamodb.Table(table_name)
+    return thread_local.table
 
 
 def preprocess_dynamo_row(column_header, input):
-    print("PK: {} Value: {}".format(column_header, input))
-    response = table.get_item(Key={column_header: input})
+    logger.debug("PK: %s Value: %s", column_header, input)
+    with metrics.timer('DynamoGetItemTime'):
+        response = get_table().get_item(Key={column_header: input})
     return response['Item']
 
 
-# this function will grab the relevant rows (column header, min, max, num_rows)
-def grab_relevant_info(column_header, input):
-    # this grabs the dictionary of the row of data we want!
-    dict = preprocess_dynamo_row(column_header, input)
+# the attributes of a dataset item that grab_relevant_info needs; the ranges are only needed (and only present) when
+# at least one column is numeric
+def missing_attributes(item):
+    required = ['attributes', 'attributeTypes', 'num_devices']
+    if any(attribute_type not in ('S', 'B') for attribute_type in item.get('attributeTypes', [])):
+        required += ['attributeRangeMins', 'attributeRangeMaxes']
+    return [attribute for attribute in required if attribute not in item]
+
 
-    columns = []
-    schema = []
-    num_rows = 0
-    ranges = []
-    # correlation = []
+# turns the NewImage of a dataset table stream record (dynamo type descriptors, e.g. {"S": "..."}) into the same item
+# dictionary a get_item would return. The stream carries the full new item, so dynamo is only read again if the image
+# is missing something we need
+def dataset_item_from_image(new_image):
+    item = {key: deserializer.deserialize(value) for key, value in new_image.items()}
 
-    # grab the column headers; we assume that this is the right length of columns the data should be.
-    columns = dict['attributes']
+    missing = missing_attributes(item)
+    if missing:
+        logging.info("stream image of %s is missing %s, reading it from dynamo", item['dataset_id'], missing)
+        item = preprocess_dynamo_row('dataset_id', item['dataset_id'])
 
-    # grab the data schema, we assume that this is per row (i.e. if 3 columns of data, this is the same length)
-    schema = dict['attributeTypes']
+    return item
+
+
+# this function will grab the relevant rows (column header, min, max, num_rows) and compile them into a schema plan,
+# returned together with everything else generation needs as a SampleDataset. If the dataset item is already at hand
+# (e.g. from the stream image) it is used as is, otherwise it is read from dynamo
+def grab_relevant_info(column_header, input, item=None):
+    # this grabs the dictionary of the row of data we want!
+    dict = item if item is not None else preprocess_dynamo_row(column_header, input)
 
     # grab the number of rows (fake data)
     num_rows = int(dict['num_devices'])  # this avoids any problem with that it is a Decimal value
-
-    # to create ranges we need to make sure our data is not all string and/or binary
-    num = 0  # we assume it IS all string/binary, the schema must prove us wrong
-    for i in range(len(schema)):
-        if schema[i] == "N":
-            num = 1
-
-    # this makes sure there is one number, i.e. there has to be a range!
-    # if the bool is false there is no 'attributerange...' hence we need to instantiate a list somehow
-    if (num == 1):
-        mins = dict['attributeRangeMins']
-        maxs = dict['attributeRangeMaxes']
+    if num_rows <= 0:
+        raise SchemaError('dataset {} has an invalid number of rows: {}'.format(input, num_rows))
+
+    # datasets with rowsPerDevice get one shard of that many rows per device (optionally skewed per device, see
+    # device_shards.py) instead of a single file
+    devices = None
+    if 'rowsPerDevice' in dict:
+        devices = DeviceLayout(num_rows, int(dict['rowsPerDevice']), float(dict.get('deviceSkew', 0)),
+                               dict.get('deviceShardFormat', CSV))
+        if devices.rows_per_device <= 0 or not 0 <= devices.skew <= 1:
+            raise SchemaError('dataset {} has an invalid device layout: {} rows per device, skew {}'.format(
+                input, devices.rows_per_device, devices.skew))
+        if devices.output_format not in OUTPUT_FORMATS:
+            raise SchemaError('dataset {} has an unknown device shard format: {}'.format(input, devices.output_format))
+        num_rows = devices.num_rows
+
+    # numeric columns can be correlated, either pairwise ([{"attributes": [a, b], "correlation": r}, ...]) or with a
+    # covariance matrix over all numeric attributes (in the order of the ranges)
+    try:
+        correlations = [(c['attributes'][0], c['attributes'][1], c['correlation'])
+                        for c in dict.get('attributeCorrelations', [])]
+    except (KeyError, IndexError, TypeError):
+        raise SchemaError('dataset {} has malformed attributeCorrelations'.format(input))
+
+    # the column headers, their types, the ranges of the numeric columns (only present if there is one) and the
+    # correlations are validated and compiled once per schema; a warm container reuses the plan for every dataset
+    # with that schema
+    plan = compile_schema(
+        dict['attributes'],
+        dict['attributeTypes'],
+        dict.get('attributeRangeMins', []),
+        dict.get('attributeRangeMaxes', []),
+        correlations,
+        dict.get('attributeCovariance')
+    )
+
+    # string columns draw from the vocabulary of the dataset's category, uniformly unless the dataset asks for
+    # zipf-weighted words (loaded once per container, like the plans)
+    distribution = dict.get('wordDistribution', UNIFORM)
+    if distribution not in (UNIFORM, ZIPF):
+        raise SchemaError('dataset {} has an unknown word distribution: {}'.format(input, distribution))
+    vocabulary = get_vocabulary(dict.get('category'), distribution)
+
+    seed = int(dict['sampleSeed']) if 'sampleSeed' in dict else default_seed(input)
+
+    # the formats the sample data is written in (csv unless the dataset asks for others) and the parquet codec
+    output_formats = tuple(dict.get('sampleDataFormats', [CSV]))
+    unknown_formats = [output_format for output_format in output_formats if output_format not in OUTPUT_FORMATS]
+    if unknown_formats or not output_formats:
+        raise SchemaError('dataset {} has invalid sample data formats: {}'.format(input, list(output_formats)))
+
+    parquet_compression = dict.get('parquetCompression', PARQUET_COMPRESSIONS[0])
+    if parquet_compression not in PARQUET_COMPRESSIONS:
+        raise SchemaError('dataset {} has an unknown parquet compression: {}'.format(input, parquet_compression))
+
+    materialize = bool(dict.get('materializeSampleData', num_rows <= materialize_max_rows))
+
+    logger.debug("grab relevant info done")
+    return SampleDataset(input, plan, num_rows, vocabulary, seed, output_formats, parquet_compression, materialize,
+                         devices)
+
+
+# stats, if given, observes every chunk of the data on its way to S3
+def write_sample_data(dataset, output_format, key, metadata=None, stats=None):
+    s3_args = OUTPUT_FORMATS[output_format].s3_args()
+    column_chunks = generate_column_chunks(dataset.plan, dataset.vocabulary, dataset.seed, 0, dataset.num_rows)
+    if stats is not None:
+        column_chunks = stats.observe_chunks(column_chunks)
+
+    # stream the data straight into S3 as it is generated; no local file and no full copy of the data in memory
+    with metrics.timer('SampleDataWriteTime'):
+        with S3MultipartWriter(s3, s3_bucket_name, key, Metadata=metadata or {}, **s3_args) as upload:
+            write_columns(output_format, dataset.plan, column_chunks, upload, dataset.parquet_compression)
+
+    metrics.put_metric('SampleDataBytes', upload.bytes_written, 'Bytes')
+    logger.debug("uploaded %s bytes to %s", upload.bytes_written, key)
+
+
+# returns the content hash stored in the metadata of an S3 object, or None if there is no such object
+def head_content_hash(key):
+    try:
+        with metrics.timer('S3HeadTime'):
+            response = s3.head_object(Bucket=s3_bucket_name, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return response['Metadata'].get(content_hash_metadata_key)
+
+
+# takes the generation lease of a dataset if nobody holds it (or the holder's lease ran out), returning it, or None if
+# another worker holds it or the dataset was deleted
+def acquire_generation_lease(dataset_id):
+    owner, now = uuid.uuid4().hex, int(time.time())
+    expires = now + generation_lease_seconds
+    try:
+        with metrics.timer('DynamoUpdateItemTime'):
+            response = get_table().update_item(
+                Key={'dataset_id': dataset_id},
+                UpdateExpression="set generation_lease_owner = :o, generation_lease_expires = :e, "
+                                 "generation_version = if_not_exists(generation_version, :zero) + :one",
+                ConditionExpression="attribute_exists(dataset_id) AND "
+                                    "(attribute_not_exists(generation_lease_owner) OR generation_lease_expires < :now)",
+                ExpressionAttributeValues={':o': owner, ':e': expires, ':now': now, ':zero': 0, ':one': 1},
+                ReturnValues='UPDATED_NEW'
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return None
+    return GenerationLease(dataset_id, owner, int(response['Attributes']['generation_version']), expires)
+
+
+# waits up to lease_wait_seconds for the lease of a dataset another worker holds
+def wait_for_generation_lease(dataset_id):
+    deadline = time.monotonic() + lease_wait_seconds
+    while True:
+        lease = acquire_generation_lease(dataset_id)
+        if lease is not None or time.monotonic() >= deadline:
+            return lease
+        metrics.put_metric('GenerationLeaseWaits', 1, 'Count')
+        time.sleep(lease_poll_seconds)
+
+
+# gives the lease back after a failed generation, so a retry doesn't have to wait for it to expire
+def release_generation_lease(lease):
+    try:
+        with metrics.timer('DynamoUpdateItemTime'):
+            get_table().update_item(
+                Key={'dataset_id': lease.dataset_id},
+                UpdateExpression="remove generation_lease_owner, generation_lease_expires",
+                ConditionExpression="generation_lease_owner = :o",
+                ExpressionAttributeValues={':o': lease.owner}
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def copy_object(source_key, destination_key, output_format, metadata):
+    extra_args = dict(OUTPUT_FORMATS[output_format].s3_args(), Metadata=metadata, MetadataDirective='REPLACE')
+    with metrics.timer('S3CopyTime'):
+        s3.copy({'Bucket': s3_bucket_name, 'Key': source_key}, s3_bucket_name, destination_key, ExtraArgs=extra_args)
+
+
+# records which artifacts the dataset's sample data currently are, and their column statistics (as much of them as
+# fits in the item, and the key of their sidecar), on the dataset item and releases the lease; the full files are
+# written by then, so the dataset is ready. Nothing is recorded if the dataset was deleted meanwhile, or if the lease
+# ran out and another worker took it (that one records its own files)
+def save_content_hashes(lease, content_hashes, column_stats=None, stats_key=None):
+    update_expression = "set sample_data_hashes = :h, sample_data_status = :r"
+    remove = ["generation_lease_owner", "generation_lease_expires"]
+    values = {':h': content_hashes, ':r': SAMPLE_DATA_READY, ':v': lease.version}
+    if stats_key is not None:
+        update_expression += ", column_stats_key = :k"
+        values[':k'] = stats_key
+    if column_stats is not None:
+        item_stats = item_column_stats(column_stats, item_stats_budget(lease.dataset_id))
+        if item_stats is not None:
+            update_expression += ", column_stats = :s"
+            values[':s'] = item_stats
+        else:
+            # statistics of an earlier schema would be misleading
+            remove.append("column_stats")
+            metrics.put_metric('ColumnStatsNotInItem', 1, 'Count')
+            logging.info("column statistics of %s don't fit in its item, only recording their key", lease.dataset_id)
+
+    try:
+        with metrics.timer('DynamoUpdateItemTime'):
+            get_table().update_item(
+                Key={'dataset_id': lease.dataset_id},
+                UpdateExpression=update_expression + " remove " + ", ".join(remove),
+                ConditionExpression="attribute_exists(dataset_id) AND generation_version = :v",
+                ExpressionAttributeValues=values
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        metrics.put_metric('GenerationLeasesLost', 1, 'Count')
+        logging.warning("%s was taken over by another worker or deleted, not recording its files", lease.dataset_id)
+
+
+# an upper bound of the size dynamo counts for a value of an item: numbers are counted as the length of their digits,
+# while dynamo only takes a byte per two digits
+def dynamo_size(value):
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, Binary):
+        return len(value.value)
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float, Decimal)):
+        return len(str(value))
+    if isinstance(value, dict):
+        return 3 + sum(1 + dynamo_size(key) + dynamo_size(item) for key, item in value.items())
+    if isinstance(value, (set, frozenset)):
+        return sum(dynamo_size(item) for item in value)
+    return 3 + sum(1 + dynamo_size(item) for item in value)
+
+
+# the room left in a dataset item for its column statistics, besides everything else it holds
+def item_stats_budget(dataset_id):
+    with metrics.timer('DynamoGetItemTime'):
+        item = get_table().get_item(Key={'dataset_id': dataset_id}, ConsistentRead=True).get('Item', {})
+    kept = {name: value for name, value in item.items() if name != 'column_stats'}
+    return max_item_bytes - item_update_margin_bytes - dynamo_size(kept) - len('column_stats')
+
+
+# the column statistics as a dynamo attribute (floats become Decimals) in as much detail as fits in max_bytes: all of
+# them up to max_item_stats_bytes, otherwise only their summary, or None if even that is too large
+def item_column_stats(column_stats, max_bytes=max_item_bytes):
+    item_stats = json.loads(json.dumps(column_stats), parse_float=Decimal)
+    if dynamo_size(item_stats) > min(max_bytes, max_item_stats_bytes):
+        item_stats = json.loads(json.dumps(summarize(column_stats)), parse_float=Decimal)
+        if dynamo_size(item_stats) > max_bytes:
+            return None
+    return item_stats
+
+
+# makes sure the sample data of a dataset exists in one output format, returning its content hash. If the data has to
+# be generated, stats (if given) observes it on the way
+def upload_sample_data(dataset, output_format, stats=None):
+    key = "/" + dataset.dataset_id + OUTPUT_FORMATS[output_format].extension
+    content_hash = dataset.content_hash(output_format)
+    cache_key = cache_prefix + content_hash + OUTPUT_FORMATS[output_format].extension
+    metadata = {content_hash_metadata_key: content_hash}
+
+    # a stream retry, DLQ redrive or re-registration of the same schema: the object is already there
+    if head_content_hash(key) == content_hash:
+        metrics.put_metric('SampleDataUpToDate', 1, 'Count')
+        logger.debug("%s is already up to date", key)
+
+    # the same data was generated before (e.g. for another dataset with the same schema and seed): copy it over
+    elif head_content_hash(cache_key) == content_hash:
+        copy_object(cache_key, key, output_format, metadata)
+        metrics.put_metric('SampleDataCacheHits', 1, 'Count')
+        logger.debug("copied cached %s to %s", cache_key, key)
+
+    # write the object under its content hash, then copy it into place: the dataset's key only ever changes from one
+    # complete object to another, and the copy under the content hash serves the next identical request
     else:
-        mins = []
-        maxs = []
-
-    # corresponding min and max of column; if string, make [0, 0]
-    min_max_counter = 0  # this tracks the smaller array
-
-    # go through each column and figure out if its range exists OR we must add a value suppose schema = [S, N, S],
-    # then range only equals [[3, 10]], must append [0, 0] for index 0 and 2 so we can iterate cleanly in other
-    # functions
-    for i in range(len(columns)):
-        if schema[i] == 'S':
-            ranges.append([0, 0])
-        elif schema[i] == 'B':
-            ranges.append([0, 1])
+        write_sample_data(dataset, output_format, cache_key, metadata, stats)
+        copy_object(cache_key, key, output_format, metadata)
+        metrics.put_metric('SampleDataGenerated', 1, 'Count')
+
+    return content_hash
+
+
+def write_device_shard(dataset, device, data_columns, key):
+    s3_args = OUTPUT_FORMATS[dataset.devices.output_format].s3_args()
+    with S3MultipartWriter(s3, s3_bucket_name, key, **s3_args) as upload:
+        write_columns(dataset.devices.output_format, dataset.plan, [data_columns], upload, dataset.parquet_compression)
+    return device, upload.bytes_written
+
+
+# writes one shard per device under /<dataset_id>/devices/ and then their manifest.json, returning its content hash.
+# Shards are uploaded concurrently while the next devices are generated; the manifest goes last, so a notebook that
+# finds it finds every shard it lists. stats (if given) observes every device's rows
+def upload_device_shards(dataset, stats=None):
+    prefix = "/" + dataset.dataset_id + "/devices/"
+    manifest_key = prefix + 'manifest.json'
+    content_hash = dataset.devices_content_hash()
+
+    if head_content_hash(manifest_key) == content_hash:
+        metrics.put_metric('SampleDataUpToDate', 1, 'Count')
+        logger.debug("%s is already up to date", manifest_key)
+        return content_hash
+
+    with metrics.timer('DeviceShardsWriteTime'), ThreadPoolExecutor(max_workers=shard_workers) as executor:
+        pending, shards = deque(), []
+        for device, data_columns in generate_device_columns(dataset.plan, dataset.vocabulary, dataset.seed,
+                                                            dataset.devices):
+            if stats is not None:
+                stats.observe(data_columns)
+            key = prefix + device_file_name(device, dataset.devices.output_format)
+            pending.append(executor.submit(write_device_shard, dataset, device, data_columns, key))
+
+            # generation runs ahead of the uploads by at most a couple of shards per worker
+            while len(pending) > 2 * shard_workers:
+                shards.append(pending.popleft().result())
+        shards += [future.result() for future in pending]
+
+    manifest = device_manifest(dataset.dataset_id, dataset.plan, dataset.devices, content_hash, shards)
+    with metrics.timer('S3PutObjectTime'):
+        s3.put_object(Bucket=s3_bucket_name, Key=manifest_key, Body=json.dumps(manifest, indent=1).encode('utf-8'),
+                      ContentType='application/json', Metadata={content_hash_metadata_key: content_hash})
+
+    metrics.put_metric('DeviceShards', len(shards), 'Count')
+    metrics.put_metric('SampleDataBytes', sum(size for _, size in shards), 'Bytes')
+    logger.debug("uploaded %s device shards to %s", len(shards), prefix)
+    return content_hash
+
+
+# the column statistics of a dataset in a pass of their own, for when the data itself didn't need to be written
+def compute_column_stats(dataset):
+    stats = DatasetStats(dataset.plan)
+    with metrics.timer('ColumnStatsTime'):
+        if dataset.devices is not None:
+            for _, data_columns in generate_device_columns(dataset.plan, dataset.vocabulary, dataset.seed,
+                                                           dataset.devices):
+                stats.observe(data_columns)
         else:
-            ranges.append([])
-            ranges[i].append(float(mins[min_max_counter]))
-            ranges[i].append(float(maxs[min_max_counter]))
-            min_max_counter += 1
-
-    # find correlation; this will be later. this supposes that we have another column of length n where 0 = no
-    # correlation with anyone else a non-zero means that this column is a function of another column (so each
-    # non-zero must occur at least twice!) a function of the other column goes both ways which enables flexibility in
-    # terms of how we write the code (refer to my last PR in correlated_fake_data in our experimental repo)
-    # correlation = list(dict['Correlation'])
-
-    print("grab relevant info done")
-    return columns, schema, num_rows, ranges  # ,correlation
-
-
-# inputs: columns, discrete/continuous, ranges for each column, correlation, number of rows this has every column
-# besides the first column be a function of the first column correlation: index of length n, 0 means no correlation
-# with anything else, any non-zero int needs to have a pair (should be validated, will not be yet) assume earlier
-# index is the one the later one is based on... doesn't really matter
-def schematic_fake_data(columns, schema, ranges, num_rows):
-    word_list = get_random_words()
-
-    # input validation
-    if len(columns) != len(ranges):
-        return "incorrect lengths of columns in one of the first three inputs"
-    elif num_rows <= 0:
-        return "incorrect number of rows"
-
-    # # this is a dictionary on that tracks the counts of each value in array
-    # correlation_counter_dict = {}
-    # validation_counter = 0
-
-    # while validation_counter < len(correlation):
-    #     if correlation[validation_counter] in correlation_counter_dict.keys():
-    #         correlation_counter_dict[correlation[validation_counter]] += 1
-    #     else:
-    #         correlation_counter_dict[correlation[validation_counter]] = 1
-
-    #     validation_counter += 1
-    # val_list = (list(correlation_counter_dict.values()))
-    # key_list = (list(correlation_counter_dict.keys()))
-    # for i in val_list:
-    #     if i < 2:
-    #         if key_list[val_list.index(i)] != 0:
-    #             return ("error: need a corresponding value with this correlation value")
-
-    output_data = [columns]
-
-    col_iterator = 0
-    row_of_data = 1  # topline is the headers
-    # write an array where each item is a row of fake data
-
-    while row_of_data <= num_rows:
-
-        output_data.append([])
-
-        while len(columns) > col_iterator:
-
-            # # if this is a "correlated column", need to find other column and make it a function of another
-            # if (correlation[col_iterator] != 0):
-            #
-            #     # this finds if this current column is later
-            #     temp = 0
-            #     while temp < col_iterator:
-            #
-            #         # this means that this column is later
-            #         if correlation[temp] == correlation[col_iterator]:
-            #             output_data[row_of_data].append(output_data[row_of_data][temp] * 3 + random.random() * 5)
-            #             temp = col_iterator + 2 # to cut out of the loop
-            #             col_iterator += 1
-            #         else:
-            #             temp +=1
-            #
-            #     # if this column index is earlier, make it random
-            #     if schema[col_iterator] == "int":
-            #         output_data[row_of_data].append(random.randint(range[col_iterator][0], range[col_iterator][1]))
-            #         col_iterator += 1
-            #     else:
-            #         output_data[row_of_data].append(range[col_iterator][0] + random.random() *
-            #                                         (range[col_iterator][1] - range[col_iterator][0]))
-            #         col_iterator += 1
-            #
-            # else:
-            # if an integer or binary, which means they have an ACTUAL range, we select integer between the two!
-            if schema[col_iterator] == "N" or schema[col_iterator] == "B":
-                print(ranges)
-                print(col_iterator)
-                output_data[row_of_data].append(random.randint(ranges[col_iterator][0], ranges[col_iterator][1]))
-                col_iterator += 1
-
-            # if it a string, we just add a random word from our list of 1k words
-            elif schema[col_iterator] == "S":
-                rand_word = (word_list[random.randint(0, len(word_list) - 1)])
-                output_data[row_of_data].append(rand_word)
-                col_iterator += 1
-
-            # if not an int, a double, so we get a random double from min to max (i.e. min + (random decimal from 0
-            # --> 1)(max-min))
-            else:
-                output_data[row_of_data].append(
-                    ranges[col_iterator][0] + random.random() * (ranges[col_iterator][1] - ranges[col_iterator][0]))
-                col_iterator += 1
-
-        col_iterator = 0
-        row_of_data += 1
-
-    print("schematic fake data done")
-    return output_data
-
-
-def convert_to_csv(columns, schema, ranges, num_rows, file_name):
-    output = schematic_fake_data(columns, schema, ranges, num_rows)
-    print(columns)
-    print(schema)
-    print(ranges)
-
-    with open(file_name, 'w', newline='') as csvfile:
-        spamwriter = csv.writer(csvfile, delimiter=',',
-                                quotechar='|', quoting=csv.QUOTE_MINIMAL)
-
-        x = 0
-        while x < len(output):
-            spamwriter.writerow(output[x])
-            print(output[x])
-            x += 1
-
-    s3.upload_file(file_name, s3_bucket_name, file_name)
-
-
-def query_to_csv(column_header, input):
-    # first, get the dictionary
-    right_info = grab_relevant_info(column_header, input)
-
-    # parse the right info into the four values we need
-    test_columns = right_info[0]
-    test_schema = right_info[1]
-    test_num_rows = right_info[2]
-    test_ranges = right_info[3]
-
-    # write the csv
-    filename = ("/" + input + '.csv')
-    convert_to_csv(test_columns, test_schema, test_ranges, test_num_rows, filename)
-    print("convert to csv done")
-
-
-def import_test():
-    print('henlo')
-
-
-def combine_ranges(mins, maxes):
-    final_list = []
-    for i in range(len(mins)):
-        print(mins[i])
-        print(maxes[i])
-        pair_list = (mins[i], maxes[i])
-        final_list.append(pair_list)
-    return final_list
+            for data_columns in generate_column_chunks(dataset.plan, dataset.vocabulary, dataset.seed, 0,
+                                                       dataset.num_rows):
+                stats.observe(data_columns)
+    return stats
+
+
+def upload_column_stats(dataset, column_stats):
+    with metrics.timer('S3PutObjectTime'):
+        s3.put_object(Bucket=s3_bucket_name, Key=dataset.stats_key(), Body=json.dumps(column_stats).encode('utf-8'),
+                      ContentType='application/json',
+                      Metadata={content_hash_metadata_key: dataset.stats_content_hash()})
+
+
+def read_column_stats(dataset):
+    with metrics.timer('S3GetObjectTime'):
+        body = s3.get_object(Bucket=s3_bucket_name, Key=dataset.stats_key())['Body'].read()
+    return json.loads(body)
+
+
+# writes the full sample data files of a dataset and their column statistics; large datasets are skipped unless force
+# is set (i.e. the files were explicitly requested through the row api), and so are datasets another worker is writing
+def query_to_csv(column_header, input, item=None, force=False):
+    # first, get the compiled schema, the number of rows, the vocabulary, the seed and the output formats
+    dataset = grab_relevant_info(column_header, input, item)
+
+    if not (force or dataset.materialize):
+        metrics.put_metric('SampleDataDeferred', 1, 'Count')
+        logging.info("%s has %s rows, leaving it to the row api", input, dataset.num_rows)
+        return
+
+    lease = wait_for_generation_lease(input)
+    if lease is None:
+        metrics.put_metric('GenerationsSkipped', 1, 'Count')
+        logging.info("%s is being generated by another worker, leaving it to that one", input)
+        return
+
+    try:
+        write_full_sample_data(dataset, lease)
+    except Exception:
+        release_generation_lease(lease)
+        raise
+
+
+def write_full_sample_data(dataset, lease):
+    # the column statistics are gathered while the data is generated, unless they are already up to date
+    stats_up_to_date = head_content_hash(dataset.stats_key()) == dataset.stats_content_hash()
+    stats = None if stats_up_to_date else DatasetStats(dataset.plan)
+
+    content_hashes = {}
+    if dataset.devices is not None:
+        content_hashes['devices'] = upload_device_shards(dataset, stats)
+    else:
+        for output_format in dataset.output_formats:
+            # only the first format that is actually generated needs to be observed
+            observer = stats if stats is not None and stats.rows == 0 else None
+            content_hashes[output_format] = upload_sample_data(dataset, output_format, observer)
+
+    if stats_up_to_date:
+        column_stats = read_column_stats(dataset)
+    else:
+        # every format was already there (or copied from the cache), so nothing was generated to observe
+        if stats.rows != dataset.num_rows:
+            stats = compute_column_stats(dataset)
+        column_stats = stats.to_dict()
+        upload_column_stats(dataset, column_stats)
+
+    save_content_hashes(lease, content_hashes, column_stats, dataset.stats_key())
+    logger.debug("convert to csv done")
+
+
+# phase one of a two-phase registration: the first preview_rows rows (the start of the full data, as the rows are
+# seeded) as json, together with the schema
+def upload_preview(dataset):
+    num_rows = min(preview_rows, dataset.num_rows)
+    rows = [row for data_columns in generate_column_chunks(dataset.plan, dataset.vocabulary, dataset.seed, 0, num_rows)
+            for row in chunk_rows(data_columns)]
+    preview = {
+        'dataset_id': dataset.dataset_id,
+        'columns': list(dataset.plan.columns),
+        'types': list(dataset.plan.types),
+        'ranges': {dataset.plan.columns[column]: [low, high] for column, low, high in dataset.plan.ranges},
+        'num_rows': dataset.num_rows,
+        'preview_rows': num_rows,
+        'rows': rows
+    }
+
+    with metrics.timer('S3PutObjectTime'):
+        s3.put_object(Bucket=s3_bucket_name, Key=dataset.preview_key(), Body=json.dumps(preview).encode('utf-8'),
+                      ContentType='application/json')
+
+
+# marks a dataset as previewed, unless a retry of its stream record finds it ready already
+def save_preview_status(dataset_id):
+    try:
+        with metrics.timer('DynamoUpdateItemTime'):
+            get_table().update_item(
+                Key={'dataset_id': dataset_id},
+                UpdateExpression="set sample_data_status = :p",
+                ConditionExpression="attribute_exists(dataset_id) AND "
+                                    "(attribute_not_exists(sample_data_status) OR sample_data_status <> :r)",
+                ExpressionAttributeValues={':p': SAMPLE_DATA_PREVIEW, ':r': SAMPLE_DATA_READY}
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+# phase two: the full files, written by an asynchronous invocation of the generation function (see row_api.py).
+# force writes them even for datasets that are otherwise left to the row api
+def request_generation(dataset_id, force=False):
+    with metrics.timer('LambdaInvokeTime'):
+        lambda_client.invoke(
+            FunctionName=generation_function,
+            InvocationType='Event',
+            Payload=json.dumps({'materialize': dataset_id, 'force': force}).encode('utf-8')
+        )
+
+
+def register_sample_data(column_header, input, item=None):
+    """ Called for every new dataset: small datasets get their full files right away, larger ones a preview now and
+    their full files in the background """
+    dataset = grab_relevant_info(column_header, input, item)
+    if dataset.num_rows <= preview_rows:
+        query_to_csv(column_header, input, item)
+        return
+
+    with metrics.timer('PreviewTime'):
+        upload_preview(dataset)
+        save_preview_status(input)
+
+    if dataset.materialize:
+        request_generation(input)
+    else:
+        metrics.put_metric('SampleDataDeferred', 1, 'Count')
+        logging.info("%s has %s rows, leaving it to the row api", input, dataset.num_rows)
@@ -1,12 +1,42 @@
 # Importing relevant packages
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from helper_functions import *
+from instrumentation import instrumented_handler, metrics
 
+# Datasets generated at the same time; bounded so a large batch cannot exhaust the lambda's memory
+max_workers = int(os.environ.get('MAX_WORKERS', '4'))
 
+
+def process_record(record):
+    # the stack's event filter only lets INSERTs through; updates of a dataset's status and lease need no work
+    if record["eventName"] == 'INSERT':
+        item = dataset_item_from_image(record["dynamodb"]["NewImage"])
+        pk = item["dataset_id"]  # dataset name
+        register_sample_data('dataset_id', pk, item)
+
+
+@instrumented_handler
 def lambda_handler(event, context):
-    import_test()
+    records = event["Records"]
+    batch_item_failures = []
+
+    # generate the datasets of the batch concurrently, then report every record that failed so that only those (and
+    # the records after them in the shard) are retried or eventually sent to the dead letter queue
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(records)))) as executor:
+        futures = [executor.submit(process_record, record) for record in records]
+
+        for record, future in zip(records, futures):
+            try:
+                future.result()
+            except SchemaError:
+                # retrying can't fix an invalid schema and would only hold up the rest of the shard
+                logging.error('Invalid schema in record %s, skipping it', record.get("eventID"), exc_info=True)
+                metrics.put_metric('InvalidSchemas', 1, 'Count')
+            except Exception:
+                logging.error('Failed to generate sample dataset for record %s', record.get("eventID"), exc_info=True)
+                batch_item_failures.append({"itemIdentifier": record["dynamodb"]["SequenceNumber"]})
 
-    for record in event["Records"]:
-        if record["eventName"] == 'INSERT':
-            new_image = record["dynamodb"]["NewImage"]
-            pk = new_image["dataset_id"]["S"]  # dataset name
-            query_to_csv('dataset_id', pk)
+    metrics.put_metric('RecordsProcessed', len(records), 'Count')
+    metrics.put_metric('RecordFailures', len(batch_item_failures), 'Count')
+    return {"batchItemFailures": batch_item_failures}
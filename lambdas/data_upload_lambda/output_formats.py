@@ -0,0 +1,133 @@
+# Importing relevant packages
+import json
+import gzip
+from typing import NamedTuple
+from fake_data import chunk_rows, encode_csv_chunks, generate_column_chunks
+from schema_plan import BINARY_TYPE, INTEGER_TYPE, STRING_TYPE
+
+CSV = 'csv'
+CSV_GZIP = 'csv.gz'
+PARQUET = 'parquet'
+JSON_LINES = 'jsonl'
+ARROW = 'arrow'
+
+PARQUET_COMPRESSIONS = ('snappy', 'zstd')
+
+# parquet row groups are built from up to ROW_GROUP_ROWS rows, large enough for good compression and fast scans, and
+# at most ROW_GROUP_CELLS values: a row group is buffered (and encoded) whole, so one of a wide schema has to stay as
+# small as one of a narrow schema. Not much smaller, though: the writer keeps the metadata of every column of every
+# row group (a couple of KB each) until the file is closed
+ROW_GROUP_ROWS = 100000
+ROW_GROUP_CELLS = 5000000
+
+
+class OutputFormat(NamedTuple):
+    extension: str
+    content_type: str
+    content_encoding: str = None
+
+    def s3_args(self):
+        # arguments for put_object/create_multipart_upload/copy so the object is served with the right headers
+        args = {'ContentType': self.content_type}
+        if self.content_encoding:
+            args['ContentEncoding'] = self.content_encoding
+        return args
+
+
+OUTPUT_FORMATS = {
+    CSV: OutputFormat('.csv', 'text/csv'),
+    CSV_GZIP: OutputFormat('.csv.gz', 'text/csv', 'gzip'),
+    PARQUET: OutputFormat('.parquet', 'application/vnd.apache.parquet'),
+    JSON_LINES: OutputFormat('.jsonl', 'application/x-ndjson'),
+    ARROW: OutputFormat('.arrows', 'application/vnd.apache.arrow.stream'),
+}
+
+# Every writer writes a sequence of column chunks (as generated by generate_column_chunks) as one standalone file (csv
+# always starts with the header), so the same code serves whole datasets, the pages of the row api and device shards
+
+
+def write_csv(plan, column_chunks, fileobj):
+    row_chunks = (chunk_rows(data_columns) for data_columns in column_chunks)
+    for data in encode_csv_chunks(plan.columns, row_chunks, header=True):
+        fileobj.write(data)
+
+
+def write_csv_gzip(plan, column_chunks, fileobj):
+    with gzip.GzipFile(fileobj=fileobj, mode='wb', compresslevel=6, mtime=0) as compressed:
+        write_csv(plan, column_chunks, compressed)
+
+
+# one json object per row, keyed by column name
+def write_json_lines(plan, column_chunks, fileobj):
+    for data_columns in column_chunks:
+        lines = [json.dumps(dict(zip(plan.columns, row))) for row in chunk_rows(data_columns)]
+        fileobj.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+def arrow_schema(plan):
+    import pyarrow as pa  # only loaded by datasets that ask for parquet
+
+    arrow_types = {INTEGER_TYPE: pa.int64(), BINARY_TYPE: pa.bool_(), STRING_TYPE: pa.string()}
+    return pa.schema([(name, arrow_types.get(attribute_type, pa.float64()))
+                      for name, attribute_type in zip(plan.columns, plan.types)])
+
+
+def record_batch(schema, data_columns):
+    import pyarrow as pa
+
+    arrays = [pa.array(column.astype(bool) if field.type == pa.bool_() else column, type=field.type)
+              for column, field in zip(data_columns, schema)]
+    return pa.record_batch(arrays, schema=schema)
+
+
+def write_parquet(plan, column_chunks, fileobj, compression='snappy'):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = arrow_schema(plan)
+    row_group_rows = max(1, min(ROW_GROUP_ROWS, ROW_GROUP_CELLS // len(plan.columns)))
+    batches, batched_rows = [], 0
+
+    with pq.ParquetWriter(fileobj, schema, compression=compression) as writer:
+        for data_columns in column_chunks:
+            batches.append(record_batch(schema, data_columns))
+            batched_rows += len(data_columns[0])
+
+            if batched_rows >= row_group_rows:
+                writer.write_table(pa.Table.from_batches(batches, schema=schema))
+                batches, batched_rows = [], 0
+
+        if batches:
+            writer.write_table(pa.Table.from_batches(batches, schema=schema))
+
+
+# arrow IPC stream format: one record batch per chunk, readable with pyarrow.ipc.open_stream
+def write_arrow(plan, column_chunks, fileobj):
+    import pyarrow as pa
+
+    schema = arrow_schema(plan)
+    with pa.ipc.new_stream(fileobj, schema) as writer:
+        for data_columns in column_chunks:
+            writer.write_batch(record_batch(schema, data_columns))
+
+
+def write_columns(output_format, plan, column_chunks, fileobj, compression=None):
+    """ Write column chunks to fileobj as one file in the given output format, streaming them chunk by chunk """
+    if output_format == CSV:
+        write_csv(plan, column_chunks, fileobj)
+    elif output_format == CSV_GZIP:
+        write_csv_gzip(plan, column_chunks, fileobj)
+    elif output_format == PARQUET:
+        write_parquet(plan, column_chunks, fileobj, compression or PARQUET_COMPRESSIONS[0])
+    elif output_format == JSON_LINES:
+        write_json_lines(plan, column_chunks, fileobj)
+    elif output_format == ARROW:
+        write_arrow(plan, column_chunks, fileobj)
+    else:
+        raise ValueError('unknown output format {}'.format(output_format))
+
+
+def write_rows(output_format, plan, vocabulary, seed, start, stop, fileobj, compression=None):
+    """ Write rows [start, stop) of a dataset to fileobj in the given output format """
+    column_chunks = generate_column_chunks(plan, vocabulary, seed, start, stop)
+    write_columns(output_format, plan, column_chunks, fileobj, compression)
@@ -0,0 +1,242 @@
+# Importing relevant packages
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from helper_functions import query_to_csv, region_name, table_name
+from instrumentation import instrumented_handler, metrics
+from schema_plan import SchemaError
+
+'''
+Drains the dead letter queues of sample data generation and regenerates the datasets their messages refer to:
+
+- deadLetterQueueNewDataset gets a description of every stream batch the data upload lambda gave up on (its shard and
+  range of sequence numbers, not the records themselves), so the new datasets of the batch are read back from the
+  stream, which keeps them for 24 hours
+- deadLetterQueueSampleDataGeneration gets the asynchronous generation requests ({"materialize": dataset_id}) the
+  generation function gave up on
+
+Messages are taken off the queue a batch at a time. The current items of all their datasets are fetched with
+BatchGetItem and generated at most redrive_workers at a time, and a message is only deleted once every dataset it
+refers to was generated. Anything that fails stays in the queue for the next run, and so does anything the function
+has no time left for: it only takes another batch with at least batch_budget_seconds to go.
+
+    python redrive.py <queue url> [<queue url> ...] [--workers 8]
+
+or invoke the redrive function with {"queue_urls": [...]} (it defaults to both queues).
+'''
+
+dead_letter_queue_urls = [url for url in os.environ.get('DEAD_LETTER_QUEUE_URLS', '').split(',') if url]
+
+# datasets generated at the same time, and messages taken off the queue per batch
+redrive_workers = int(os.environ.get('REDRIVE_WORKERS', '8'))
+batch_messages = 100
+
+# messages of a batch stay hidden from other consumers (and later batches of this run) for this long
+visibility_timeout = 15 * 60
+
+# the longest a batch is expected to take; the function stops taking messages off the queue once it has less time left,
+# rather than time out with a batch half done (whose messages would then stay hidden for visibility_timeout)
+batch_budget_seconds = int(os.environ.get('REDRIVE_BATCH_BUDGET_SECONDS', '300'))
+
+# BatchGetItem accepts at most 100 keys, and SQS deletes at most 10 messages, per call
+batch_get_keys = 100
+delete_batch_size = 10
+
+sqs = boto3.client('sqs')
+streams = boto3.client('dynamodbstreams')
+dynamodb = boto3.resource('dynamodb', region_name=region_name)
+
+
+# time left before the invocation times out; the command line has no deadline
+def remaining_seconds(context):
+    if context is None:
+        return float('inf')
+    return context.get_remaining_time_in_millis() / 1000
+
+
+# up to max_messages messages of the queue, leaving out the ones in seen (ids of messages received before)
+def receive_messages(queue_url, max_messages, visibility_timeout=visibility_timeout, seen=()):
+    messages = {}
+    while len(messages) < max_messages:
+        with metrics.timer('SqsReceiveTime'):
+            response = sqs.receive_message(
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=min(10, max_messages - len(messages)),
+                VisibilityTimeout=visibility_timeout
+            )
+        received = {message['MessageId']: message for message in response.get('Messages', [])
+                    if message['MessageId'] not in seen and message['MessageId'] not in messages}
+        if not received:
+            break
+        messages.update(received)
+    return list(messages.values())
+
+
+# the ids of the datasets inserted in a range of a stream shard, read back from the stream
+def stream_dataset_ids(batch_info):
+    with metrics.timer('StreamReadTime'):
+        iterator = streams.get_shard_iterator(
+            StreamArn=batch_info['streamArn'],
+            ShardId=batch_info['shardId'],
+            ShardIteratorType='AT_SEQUENCE_NUMBER',
+            SequenceNumber=batch_info['startSequenceNumber']
+        )['ShardIterator']
+
+        end, dataset_ids = int(batch_info['endSequenceNumber']), []
+        while iterator:
+            response = streams.get_records(ShardIterator=iterator)
+            for record in response['Records']:
+                # only new datasets are generated (see lambda_function.process_record)
+                if record['eventName'] == 'INSERT':
+                    dataset_ids.append(record['dynamodb']['Keys']['dataset_id']['S'])
+                if int(record['dynamodb']['SequenceNumber']) >= end:
+                    return dataset_ids
+
+            # an open shard returns no records once it has been read up to its latest record
+            if not response['Records']:
+                break
+            iterator = response.get('NextShardIterator')
+    return dataset_ids
+
+
+def message_requests(message):
+    """ (dataset_id, force) of every dataset a dead letter message refers to """
+    body = json.loads(message['Body'])
+    if 'materialize' in body:
+        return [(body['materialize'], body.get('force', False))]
+    return [(dataset_id, False) for dataset_id in stream_dataset_ids(body['DDBStreamBatchInfo'])]
+
+
+# the current items of the given datasets; deleted datasets are left out
+def batch_get_datasets(dataset_ids):
+    keys, items = [{'dataset_id': dataset_id} for dataset_id in dict.fromkeys(dataset_ids)], {}
+    for i in range(0, len(keys), batch_get_keys):
+        request, attempt = {table_name: {'Keys': keys[i:i + batch_get_keys]}}, 0
+        while request:
+            if attempt:
+                time.sleep(min(0.05 * 2 ** attempt, 1))  # back off before asking for the unprocessed keys again
+            with metrics.timer('DynamoBatchGetItemTime'):
+                response = dynamodb.batch_get_item(RequestItems=request)
+            for item in response['Responses'].get(table_name, []):
+                items[item['dataset_id']] = item
+            request, attempt = response.get('UnprocessedKeys'), attempt + 1
+    return items
+
+
+def regenerate(dataset_id, item, force):
+    # a deleted dataset needs no sample data
+    if item is not None:
+        query_to_csv('dataset_id', dataset_id, item, force=force)
+
+
+def delete_messages(queue_url, messages):
+    for i in range(0, len(messages), delete_batch_size):
+        entries = [{'Id': str(j), 'ReceiptHandle': message['ReceiptHandle']}
+                   for j, message in enumerate(messages[i:i + delete_batch_size])]
+        with metrics.timer('SqsDeleteTime'):
+            response = sqs.delete_message_batch(QueueUrl=queue_url, Entries=entries)
+        for failure in response.get('Failed', []):
+            logging.warning('Could not delete redriven message: %s', failure.get('Message'))
+
+
+def redrive_batch(queue_url, messages, executor):
+    """ Regenerates the datasets of a batch of messages, deleting the messages all of whose datasets succeeded;
+    returns the number of messages deleted """
+    requests = {}
+    for message in messages:
+        try:
+            requests[message['MessageId']] = message_requests(message)
+        except Exception:
+            # e.g. the stream no longer holds the records of the batch; the message is kept for someone to look into
+            logging.error('Cannot resolve dead letter message %s', message['MessageId'], exc_info=True)
+            metrics.put_metric('UnresolvedMessages', 1, 'Count')
+
+    # a dataset is generated once per batch, forced if any of its messages asks for that
+    datasets = {}
+    for dataset_requests in requests.values():
+        for dataset_id, force in dataset_requests:
+            datasets[dataset_id] = datasets.get(dataset_id, False) or force
+
+    items = batch_get_datasets(datasets)
+    futures = {dataset_id: executor.submit(regenerate, dataset_id, items.get(dataset_id), force)
+               for dataset_id, force in datasets.items()}
+
+    succeeded = set()
+    for dataset_id, future in futures.items():
+        try:
+            future.result()
+            succeeded.add(dataset_id)
+        except SchemaError:
+            # retrying can't fix an invalid schema, so its messages are done with
+            logging.error('Invalid schema in dataset %s, skipping it', dataset_id, exc_info=True)
+            metrics.put_metric('InvalidSchemas', 1, 'Count')
+            succeeded.add(dataset_id)
+        except Exception:
+            logging.error('Failed to regenerate sample dataset %s', dataset_id, exc_info=True)
+            metrics.put_metric('RedriveFailures', 1, 'Count')
+
+    done = [message for message in messages if message['MessageId'] in requests and
+            all(dataset_id in succeeded for dataset_id, _ in requests[message['MessageId']])]
+    delete_messages(queue_url, done)
+
+    metrics.put_metric('DatasetsRedriven', len(succeeded), 'Count')
+    metrics.put_metric('MessagesRedriven', len(done), 'Count')
+    return len(done)
+
+
+def redrive(queue_url, workers=None, visibility_timeout=visibility_timeout, context=None):
+    """ Drains a dead letter queue, returning (messages deleted, messages tried and left in the queue)
+
+    Every message is tried once per run: a message that failed and becomes visible again (once visibility_timeout has
+    passed) is left alone, and the run ends when the queue holds nothing else, or when the invocation (context) has
+    too little time left for another batch.
+    """
+    deleted, seen = 0, set()
+    with ThreadPoolExecutor(max_workers=workers or redrive_workers) as executor:
+        while True:
+            if remaining_seconds(context) < batch_budget_seconds:
+                metrics.put_metric('RedrivesOutOfTime', 1, 'Count')
+                logging.warning('Out of time, leaving the rest of %s for the next run', queue_url)
+                break
+            messages = receive_messages(queue_url, batch_messages, visibility_timeout, seen)
+            if not messages:
+                break
+            seen.update(message['MessageId'] for message in messages)
+            deleted += redrive_batch(queue_url, messages, executor)
+
+    logging.info('Redrove %s of %s messages from %s', deleted, len(seen), queue_url)
+    return deleted, len(seen) - deleted
+
+
+@instrumented_handler
+def lambda_handler(event, context):
+    results = {}
+    for queue_url in event.get('queue_urls') or dead_letter_queue_urls:
+        deleted, left = redrive(queue_url, event.get('workers'), context=context)
+        results[queue_url] = {'redriven': deleted, 'left': left}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Regenerates the datasets of dead letter queue messages')
+    parser.add_argument('queue_urls', nargs='+')
+    parser.add_argument('--workers', type=int, default=redrive_workers, help='datasets generated at the same time')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    left = 0
+    for queue_url in args.queue_urls:
+        deleted, queue_left = redrive(queue_url, args.workers)
+        print('{}: {} redriven, {} left'.format(queue_url, deleted, queue_left))
+        left += queue_left
+    metrics.flush()
+    return 1 if left else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
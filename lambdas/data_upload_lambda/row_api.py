@@ -0,0 +1,169 @@
+# Importing relevant packages
+import io
+import os
+import json
+import base64
+import logging
+from helper_functions import get_table, grab_relevant_info, query_to_csv, request_generation
+from instrumentation import instrumented_handler, metrics
+from output_formats import CSV, OUTPUT_FORMATS, write_rows
+from schema_plan import SchemaError
+
+'''
+REST api serving the sample data of a dataset page by page, generated on request from the compiled schema (the rows
+are seeded by dataset, so every page is the same every time it is asked for):
+
+GET  /datasets/{dataset_id}/rows?offset=0&limit=1000&format=csv
+    rows [offset, offset + limit) as csv (with header), jsonl (one object per row), arrow (IPC stream) or any other
+    sample data format. The response carries the dataset's total row count (X-Total-Rows) and, if there are more rows,
+    the offset of the next page (X-Next-Offset). A page of a wide dataset may hold fewer rows than asked for
+POST /datasets/{dataset_id}/materialize
+    writes the full sample data files to S3 in the background (see query_to_csv), for datasets too large to be written
+    as soon as they are registered
+
+The same function writes the full files of every dataset registered in two phases (see register_sample_data).
+
+Lambda proxy responses cannot be streamed, so pages are bounded in rows, in values (rows x columns) and in bytes.
+'''
+
+default_page_rows = 1000
+max_page_rows = int(os.environ.get('MAX_PAGE_ROWS', '50000'))
+
+# the rows of a page are cut down to at most max_page_cells values, so a page of a wide schema is generated (and, for
+# parquet, buffered) in as little memory as one of a narrow schema; X-Next-Offset tells where the rest starts
+max_page_cells = int(os.environ.get('MAX_PAGE_CELLS', '2000000'))
+
+# lambda responses are capped at 6 MB, and the body is base64 encoded (4/3 larger) so binary formats come out intact
+max_response_bytes = 4 * 1024 * 1024
+
+
+def response(status_code, body, headers=None):
+    return {
+        'isBase64Encoded': False,
+        'statusCode': status_code,
+        'headers': headers or {},
+        'body': json.dumps(body)
+    }
+
+
+class BadRequest(Exception):
+    pass
+
+
+class PageTooLarge(Exception):
+    pass
+
+
+class ResponseBuffer(io.BytesIO):
+    """ In-memory response body that refuses to grow beyond max_bytes, so a page too large to be returned stops being
+    generated as soon as it gets there """
+
+    def __init__(self, max_bytes):
+        super().__init__()
+        self.max_bytes = max_bytes
+
+    def write(self, data):
+        if self.tell() + len(data) > self.max_bytes:
+            raise PageTooLarge()
+        return super().write(data)
+
+
+def int_parameter(parameters, name, default):
+    try:
+        return int(parameters.get(name, default))
+    except ValueError:
+        raise BadRequest('{} must be an integer'.format(name))
+
+
+def get_dataset(dataset_id):
+    with metrics.timer('DynamoGetItemTime'):
+        item = get_table().get_item(Key={'dataset_id': dataset_id}).get('Item')
+    return None if item is None else grab_relevant_info('dataset_id', dataset_id, item)
+
+
+def get_rows(dataset_id, parameters):
+    offset = int_parameter(parameters, 'offset', 0)
+    limit = int_parameter(parameters, 'limit', default_page_rows)
+    output_format = parameters.get('format', CSV)
+    if offset < 0 or not 0 < limit <= max_page_rows:
+        raise BadRequest('offset must be at least 0 and limit between 1 and {}'.format(max_page_rows))
+    if output_format not in OUTPUT_FORMATS:
+        raise BadRequest('format must be one of {}'.format(', '.join(sorted(OUTPUT_FORMATS))))
+
+    dataset = get_dataset(dataset_id)
+    if dataset is None:
+        return response(404, {'message': 'No dataset {}'.format(dataset_id)})
+
+    page_rows = min(limit, max(1, max_page_cells // len(dataset.plan.columns)))
+    start, stop = min(offset, dataset.num_rows), min(offset + page_rows, dataset.num_rows)
+    body = ResponseBuffer(max_response_bytes)
+    try:
+        with metrics.timer('PageGenerationTime'):
+            write_rows(output_format, dataset.plan, dataset.vocabulary, dataset.seed, start, stop, body,
+                       dataset.parquet_compression)
+    except PageTooLarge:
+        metrics.put_metric('PagesTooLarge', 1, 'Count')
+        message = 'Page is larger than {} bytes, ask for fewer rows'.format(max_response_bytes)
+        return response(413, {'message': message})
+
+    metrics.put_metric('PageRows', stop - start, 'Count')
+    metrics.put_metric('PageBytes', body.tell(), 'Bytes')
+
+    headers = {'Content-Type': OUTPUT_FORMATS[output_format].content_type, 'X-Total-Rows': str(dataset.num_rows)}
+    if OUTPUT_FORMATS[output_format].content_encoding:
+        headers['Content-Encoding'] = OUTPUT_FORMATS[output_format].content_encoding
+    if stop < dataset.num_rows:
+        headers['X-Next-Offset'] = str(stop)
+
+    return {
+        'isBase64Encoded': True,
+        'statusCode': 200,
+        'headers': headers,
+        'body': base64.b64encode(body.getvalue()).decode('ascii')
+    }
+
+
+# the full files can take far longer than API gateway waits, so they are written by an asynchronous invocation of
+# this same function
+def request_materialization(dataset_id):
+    if get_dataset(dataset_id) is None:
+        return response(404, {'message': 'No dataset {}'.format(dataset_id)})
+
+    request_generation(dataset_id, force=True)
+    return response(202, {'message': 'Writing the sample data files of {}'.format(dataset_id)})
+
+
+@instrumented_handler
+def lambda_handler(event, context):
+    # asynchronous invocation from request_generation
+    if 'materialize' in event:
+        query_to_csv('dataset_id', event['materialize'], force=event.get('force', True))
+        return
+
+    try:
+        # /datasets/{dataset_id}/rows or /datasets/{dataset_id}/materialize
+        path = event['path'].strip('/').split('/')
+        method = event['httpMethod']
+        parameters = event.get('queryStringParameters') or {}
+
+        if len(path) == 3 and path[0] == 'datasets':
+            if method == 'GET' and path[2] == 'rows':
+                return get_rows(path[1], parameters)
+            if method == 'POST' and path[2] == 'materialize':
+                return request_materialization(path[1])
+
+        return response(404, {'message': 'ERROR: Method not found'})
+
+    except BadRequest as e:
+        return response(400, {'message': str(e)})
+
+    except SchemaError as e:
+        return response(422, {'message': str(e)})
+
+    except KeyError:
+        logging.warning('Not a proper REST call', exc_info=True)  # prints stack trace
+        return response(400, {'message': 'Not a proper REST call. No HTTP method or path found.'})
+
+    except Exception:
+        logging.error('Unexpected Error', exc_info=True)  # prints stack trace
+        return response(500, {'message': 'Unexpected error occurred.'})
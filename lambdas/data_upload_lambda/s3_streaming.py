@@ -0,0 +1,111 @@
+# Importing relevant packages
+import logging
+from instrumentation import metrics
+
+# S3 requires every part of a multipart upload except the last one to be at least 5 MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+
+
+class S3MultipartWriter:
+    """ Binary file-like object that streams everything written to it into one S3 object.
+
+    At most one part (part_size bytes) is held in memory at a time. Objects smaller than one part are sent with a
+    single put_object, anything bigger goes through a multipart upload that is aborted if the writer exits with an
+    exception, so a failed run never leaves a half-written object behind.
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=DEFAULT_PART_SIZE, **extra_args):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError('part_size must be at least {} bytes'.format(MIN_PART_SIZE))
+
+        self.s3 = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.extra_args = extra_args  # e.g. ContentType, Metadata; passed to put_object/create_multipart_upload
+
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._closed = False
+
+    def write(self, data):
+        if self._closed:
+            raise ValueError('write to closed S3MultipartWriter')
+
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    # the rest of the file-like interface, so gzip and pyarrow can write into the upload directly
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        # nothing went out as a part yet, so the whole object fits in a single request
+        if self._upload_id is None:
+            with metrics.timer('S3PutObjectTime'):
+                self.s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), **self.extra_args)
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            with metrics.timer('S3CompleteUploadTime'):
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={'Parts': self._parts}
+                )
+        self._buffer = bytearray()
+
+    def abort(self):
+        self._closed = True
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            logging.warning('Aborting multipart upload of s3://%s/%s', self.bucket, self.key)
+            self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+
+    def _upload_part(self, body):
+        if self._upload_id is None:
+            response = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key, **self.extra_args)
+            self._upload_id = response['UploadId']
+
+        part_number = len(self._parts) + 1
+        with metrics.timer('S3UploadPartTime'):
+            response = self.s3.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                PartNumber=part_number,
+                Body=body
+            )
+        self._parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
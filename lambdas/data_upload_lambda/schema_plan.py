@@ -0,0 +1,249 @@
+# Importing relevant packages
+import json
+import math
+import hashlib
+import threading
+from typing import NamedTuple, Tuple
+import numpy as np
+
+# attribute types that don't take a range from attributeRangeMins/attributeRangeMaxes; every other type is numeric,
+# 'N' being an integer and anything else a double
+STRING_TYPE = 'S'
+BINARY_TYPE = 'B'
+INTEGER_TYPE = 'N'
+
+
+class SchemaError(ValueError):
+    """ Raised when the attributes of a dataset item do not describe a schema we can generate data for """
+
+
+# Columns are generated in groups: every independent column of the same kind goes into one 2-D typed block that is
+# drawn with a single call, shaped (columns, rows) so every column is a contiguous row of the block. Wide schemas thus
+# cost a handful of calls per block of rows instead of one (or more) per column
+
+
+class IntegerBlockSampler:
+    """ Uniform integers, each column from its low to its high (inclusive); binary columns are integers from 0 to 1 """
+    __slots__ = ('columns', 'lows', 'highs')
+
+    def __init__(self, columns, lows, highs):
+        self.columns = tuple(columns)
+        self.lows = np.array(lows, dtype=np.int64)[:, None]
+        self.highs = np.array(highs, dtype=np.int64)[:, None]
+
+    def sample(self, rng, num_rows, vocabulary):
+        return rng.integers(self.lows, self.highs, size=(len(self.columns), num_rows), endpoint=True)
+
+
+class FloatBlockSampler:
+    """ Uniform doubles, each column low + (random decimal from 0 --> 1)(high - low) """
+    __slots__ = ('columns', 'lows', 'spans')
+
+    def __init__(self, columns, lows, highs):
+        self.columns = tuple(columns)
+        self.lows = np.array(lows, dtype=np.float64)[:, None]
+        self.spans = np.array(highs, dtype=np.float64)[:, None] - self.lows
+
+    def sample(self, rng, num_rows, vocabulary):
+        return self.lows + rng.random((len(self.columns), num_rows)) * self.spans
+
+
+class WordBlockSampler:
+    """ Random words from the vocabulary the dataset is generated with """
+    __slots__ = ('columns',)
+
+    def __init__(self, columns):
+        self.columns = tuple(columns)
+
+    def sample(self, rng, num_rows, vocabulary):
+        return vocabulary.sample(rng, len(self.columns) * num_rows).reshape(len(self.columns), num_rows)
+
+
+class CorrelatedSampler:
+    """ Jointly normal numeric columns, drawn with one batched multivariate draw
+
+    Every column is centered on the middle of its range with the given covariance (pairwise correlations are scaled so
+    that the range spans +-3 standard deviations), then clamped to its range and rounded if it is an integer column.
+    """
+    __slots__ = ('columns', 'means', 'factor', 'lows', 'highs', 'integer')
+
+    def __init__(self, columns, lows, highs, integer, covariance):
+        self.columns = tuple(columns)
+        self.lows = np.array(lows, dtype=np.float64)
+        self.highs = np.array(highs, dtype=np.float64)
+        self.means = (self.lows + self.highs) / 2
+        self.integer = tuple(integer)
+
+        # covariance = factor @ factor.T; an eigendecomposition (unlike cholesky) also copes with constant columns
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        if eigenvalues.min() < -1e-9 * max(1.0, abs(eigenvalues.max())):
+            raise SchemaError('attribute correlations/covariance are not consistent (not positive semi-definite)')
+        self.factor = eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+
+    def sample(self, rng, num_rows, vocabulary):
+        block = self.means + rng.standard_normal((num_rows, len(self.columns))) @ self.factor.T
+        block = np.clip(block, self.lows, self.highs)
+        return [np.rint(block[:, i]).astype(np.int64) if integer else block[:, i]
+                for i, integer in enumerate(self.integer)]
+
+
+class SchemaPlan(NamedTuple):
+    """ Validated, immutable description of how to generate every column of a dataset """
+    columns: Tuple[str, ...]
+    types: Tuple[str, ...]
+    groups: tuple  # block samplers, together covering every column exactly once
+    schema_hash: str
+    ranges: tuple = ()  # (column, low, high) of every numeric column
+
+    def sample(self, num_rows, vocabulary, rng, rows=slice(None)):
+        # one batched draw per group of columns, of which only the selected rows are kept; returns one numpy array
+        # per column (a view into its group's block)
+        data_columns = [None] * len(self.columns)
+        for group in self.groups:
+            for column, values in zip(group.columns, group.sample(rng, num_rows, vocabulary)):
+                data_columns[column] = values[rows]
+        return data_columns
+
+    def generate(self, num_rows, vocabulary, rng, rows=slice(None)):
+        # same as sample, but as python lists so the values written out are plain ints/floats/strings
+        return [column.tolist() for column in self.sample(num_rows, vocabulary, rng, rows)]
+
+
+# plans compiled by this container, keyed by schema hash; a warm lambda compiles each schema only once
+plan_cache = {}
+plan_cache_lock = threading.Lock()
+
+
+def schema_hash(attributes, attribute_types, range_mins, range_maxes, correlations=(), covariance=None):
+    normalized = json.dumps([
+        list(attributes),
+        list(attribute_types),
+        [float(x) for x in range_mins],
+        [float(x) for x in range_maxes],
+        [[a, b, float(r)] for a, b, r in correlations],
+        None if covariance is None else [[float(x) for x in row] for row in covariance]
+    ])
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def compile_schema(attributes, attribute_types, range_mins=(), range_maxes=(), correlations=(), covariance=None):
+    """ Validate a dataset schema and compile it into a SchemaPlan (cached by schema hash)
+
+    range_mins/range_maxes only hold entries for the numeric columns, in column order, exactly like the
+    attributeRangeMins/attributeRangeMaxes of a dataset item. Numeric columns can be made correlated either with
+    (attribute, attribute, correlation) triples or with a covariance matrix over all numeric columns (in that same
+    order); such columns are normally distributed around the middle of their range instead of uniform.
+    """
+    try:
+        key = schema_hash(attributes, attribute_types, range_mins, range_maxes, correlations, covariance)
+    except (TypeError, ValueError) as e:
+        raise SchemaError('schema contains a value that is not a number or string: {}'.format(e))
+
+    plan = plan_cache.get(key)
+    if plan is None:
+        plan = build_plan(attributes, attribute_types, range_mins, range_maxes, correlations, covariance, key)
+        with plan_cache_lock:
+            plan_cache[key] = plan
+    return plan
+
+
+def build_plan(attributes, attribute_types, range_mins, range_maxes, correlations, covariance, key):
+    if len(attributes) == 0:
+        raise SchemaError('schema has no attributes')
+    if len(attributes) != len(attribute_types):
+        raise SchemaError('schema has {} attributes but {} attribute types'.format(
+            len(attributes), len(attribute_types)))
+    if len(range_mins) != len(range_maxes):
+        raise SchemaError('schema has {} range minimums but {} range maximums'.format(
+            len(range_mins), len(range_maxes)))
+
+    num_numeric = sum(1 for t in attribute_types if t not in (STRING_TYPE, BINARY_TYPE))
+    if num_numeric != len(range_mins):
+        raise SchemaError('schema has {} numeric attributes but {} ranges'.format(num_numeric, len(range_mins)))
+
+    numeric_columns = {}  # column index -> (low, high) of every numeric column, in column order
+    range_counter = 0  # ranges only exist for the numeric columns, so they are tracked separately
+    for column, (name, attribute_type) in enumerate(zip(attributes, attribute_types)):
+        if attribute_type in (STRING_TYPE, BINARY_TYPE):
+            continue
+
+        low, high = float(range_mins[range_counter]), float(range_maxes[range_counter])
+        range_counter += 1
+
+        if not (math.isfinite(low) and math.isfinite(high)) or low > high:
+            raise SchemaError('attribute {} has an invalid range [{}, {}]'.format(name, low, high))
+        if attribute_type == INTEGER_TYPE and not (low.is_integer() and high.is_integer()):
+            raise SchemaError('integer attribute {} has a non-integer range [{}, {}]'.format(name, low, high))
+        numeric_columns[column] = (low, high)
+
+    groups = []
+    correlated = set()
+    if covariance is not None or len(correlations) > 0:
+        correlated_group = build_correlated_sampler(attributes, attribute_types, numeric_columns, correlations,
+                                                    covariance)
+        correlated = set(correlated_group.columns)
+
+    # every other column goes into the block of its kind
+    integers, floats, words = [], [], []
+    for column, attribute_type in enumerate(attribute_types):
+        if column in correlated:
+            continue
+        if attribute_type == STRING_TYPE:
+            words.append(column)
+        elif attribute_type == BINARY_TYPE:
+            integers.append((column, 0, 1))
+        elif attribute_type == INTEGER_TYPE:
+            integers.append((column,) + numeric_columns[column])
+        else:
+            floats.append((column,) + numeric_columns[column])
+
+    if integers:
+        groups.append(IntegerBlockSampler(*zip(*integers)))
+    if floats:
+        groups.append(FloatBlockSampler(*zip(*floats)))
+    if words:
+        groups.append(WordBlockSampler(words))
+    if correlated:
+        groups.append(correlated_group)
+
+    return SchemaPlan(columns=tuple(attributes), types=tuple(attribute_types), groups=tuple(groups), schema_hash=key,
+                      ranges=tuple((column, low, high) for column, (low, high) in numeric_columns.items()))
+
+
+def build_correlated_sampler(attributes, attribute_types, numeric_columns, correlations, covariance):
+    if covariance is not None:
+        # the covariance matrix covers every numeric column, in the order of the ranges
+        columns = list(numeric_columns)
+        covariance = np.array(covariance, dtype=np.float64)
+        if covariance.shape != (len(columns), len(columns)) or not np.allclose(covariance, covariance.T):
+            raise SchemaError('covariance must be a symmetric {0}x{0} matrix over the numeric attributes'.format(
+                len(columns)))
+    else:
+        # only the columns named in a correlation are drawn jointly; the others stay uniform
+        index = {name: i for i, name in enumerate(attributes)}
+        columns = []
+        for a, b, r in correlations:
+            for name in (a, b):
+                if index.get(name) not in numeric_columns:
+                    raise SchemaError('correlated attribute {} is not a numeric attribute of the schema'.format(name))
+            if a == b or not -1 <= float(r) <= 1:
+                raise SchemaError('invalid correlation {} between {} and {}'.format(r, a, b))
+            columns += [index[name] for name in (a, b) if index[name] not in columns]
+        columns.sort()
+
+        position = {column: i for i, column in enumerate(columns)}
+        correlation = np.eye(len(columns))
+        for a, b, r in correlations:
+            i, j = position[index[a]], position[index[b]]
+            correlation[i, j] = correlation[j, i] = float(r)
+
+        spreads = np.array([numeric_columns[column][1] - numeric_columns[column][0] for column in columns]) / 6
+        covariance = correlation * np.outer(spreads, spreads)
+
+    return CorrelatedSampler(
+        columns,
+        [numeric_columns[column][0] for column in columns],
+        [numeric_columns[column][1] for column in columns],
+        [attribute_types[column] == INTEGER_TYPE for column in columns],
+        covariance
+    )
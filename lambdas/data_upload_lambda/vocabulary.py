@@ -0,0 +1,110 @@
+# Importing relevant packages
+import os
+import threading
+import numpy as np
+
+# words.txt holds the 999 most common english words, most frequent first. A dataset category gets its own word list
+# by dropping a <category>.txt file (same format) into the vocabularies directory
+vocabulary_dir = os.path.dirname(os.path.abspath(__file__))
+default_vocabulary_file = os.path.join(vocabulary_dir, 'words.txt')
+category_vocabulary_dir = os.path.join(vocabulary_dir, 'vocabularies')
+
+UNIFORM = 'uniform'
+ZIPF = 'zipf'
+
+
+class Vocabulary:
+    """ Word list loaded into a compact numpy array that fills whole string columns in one vectorized call
+
+    Words are drawn uniformly or, since the word files are in frequency order, with Zipf weights (the k-th word
+    has weight 1 / k ** zipf_exponent) using a precomputed alias table, so weighted draws cost the same as uniform ones.
+    """
+    __slots__ = ('name', 'distribution', 'words', 'probabilities', 'aliases')
+
+    def __init__(self, name, words, distribution=UNIFORM, zipf_exponent=1.0):
+        if len(words) == 0:
+            raise ValueError('vocabulary {} has no words'.format(name))
+        if distribution not in (UNIFORM, ZIPF):
+            raise ValueError('unknown word distribution {}'.format(distribution))
+
+        self.name = name
+        self.distribution = distribution
+        self.words = np.array(words)
+
+        if distribution == ZIPF:
+            weights = 1.0 / np.arange(1, len(words) + 1) ** zipf_exponent
+            self.probabilities, self.aliases = build_alias_table(weights)
+        else:
+            self.probabilities, self.aliases = None, None
+
+    def __len__(self):
+        return len(self.words)
+
+    def sample_indices(self, rng, num_rows):
+        columns = rng.integers(0, len(self.words), size=num_rows)
+        if self.probabilities is None:
+            return columns
+
+        # alias method: pick a column of the table, keep it with its probability, otherwise take its alias
+        keep = rng.random(num_rows) < self.probabilities[columns]
+        return np.where(keep, columns, self.aliases[columns])
+
+    def sample(self, rng, num_rows):
+        return self.words[self.sample_indices(rng, num_rows)]
+
+
+def build_alias_table(weights):
+    """ Vose's alias method: returns (probabilities, aliases) arrays for O(1) weighted draws """
+    n = len(weights)
+    scaled = np.asarray(weights, dtype=np.float64) * n / np.sum(weights)
+    probabilities = np.ones(n)
+    aliases = np.arange(n)
+
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        probabilities[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] = scaled[more] + scaled[less] - 1.0
+        if scaled[more] < 1.0:
+            small.append(more)
+        else:
+            large.append(more)
+
+    # anything left over is (up to rounding error) exactly 1, i.e. always keeps its own column
+    return probabilities, aliases
+
+
+def read_words(path):
+    with open(path, 'r') as f:
+        return f.read().split()
+
+
+# vocabularies loaded by this container, keyed by (file, distribution); each word file is read only once
+loaded_vocabularies = {}
+vocabulary_lock = threading.Lock()
+
+
+def vocabulary_file(category):
+    if category:
+        path = os.path.join(category_vocabulary_dir, str(category).lower() + '.txt')
+        if os.path.isfile(path):
+            return path
+    return default_vocabulary_file
+
+
+def get_vocabulary(category=None, distribution=UNIFORM):
+    """ The vocabulary for a dataset category (or the default english words if the category has none) """
+    path = vocabulary_file(category)
+    key = (path, distribution)
+
+    vocabulary = loaded_vocabularies.get(key)
+    if vocabulary is None:
+        with vocabulary_lock:
+            vocabulary = loaded_vocabularies.get(key)
+            if vocabulary is None:
+                name = os.path.splitext(os.path.basename(path))[0]
+                vocabulary = Vocabulary(name, read_words(path), distribution)
+                loaded_vocabularies[key] = vocabulary
+    return vocabulary
@@ -0,0 +1,151 @@
+# Importing relevant packages
+import os
+import json
+import time
+import random
+import logging
+import functools
+import threading
+from contextlib import contextmanager
+
+'''
+Instrumentation shared by all of our lambdas (deployed to them as a lambda layer, see
+cdk_stacks/instrumentation_layer.py).
+
+- metrics.timer / metrics.put_metric collect latencies and counters during an invocation, and metrics.flush writes them
+  to stdout as CloudWatch Embedded Metric Format (EMF) records, which CloudWatch turns into metrics without any API
+  calls. instrumented_handler flushes after every invocation.
+- Debug logging is sampled: a DEBUG_SAMPLE_RATE fraction of invocations log at DEBUG, the rest at INFO, so detailed
+  logs are available without paying for them on every invocation. Only our own logger (logger, 'artificien') is
+  sampled: the AWS SDK logs signed request headers, security tokens included, at DEBUG.
+- capture_metrics collects the EMF records in a list instead of printing them, for tests and local runs.
+'''
+
+NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'Artificien')
+DEBUG_SAMPLE_RATE = float(os.environ.get('DEBUG_SAMPLE_RATE', '0.01'))
+
+# EMF accepts at most 100 values per metric in one record
+MAX_VALUES_PER_RECORD = 100
+
+
+def print_sink(record):
+    print(json.dumps(record))
+
+
+class MetricsLogger:
+    """ Thread safe collector of metric values, emitted as EMF records on flush """
+
+    def __init__(self, namespace=NAMESPACE, dimensions=None, sink=print_sink):
+        self.namespace = namespace
+        self.dimensions = dimensions if dimensions is not None else default_dimensions()
+        self.sink = sink
+        self._metrics = {}  # name -> (unit, [values])
+        self._lock = threading.Lock()
+
+    def put_metric(self, name, value, unit='None'):
+        with self._lock:
+            self._metrics.setdefault(name, (unit, []))[1].append(value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.put_metric(name, (time.perf_counter() - start) * 1000, 'Milliseconds')
+
+    def timed(self, name):
+        """ Decorator version of timer """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def clear(self):
+        with self._lock:
+            self._metrics = {}
+
+    def flush(self):
+        with self._lock:
+            metrics, self._metrics = self._metrics, {}
+
+        # a metric with more than MAX_VALUES_PER_RECORD values is spread over several records
+        offset = 0
+        while any(len(values) > offset for _, values in metrics.values()):
+            record = {
+                '_aws': {
+                    'Timestamp': int(time.time() * 1000),
+                    'CloudWatchMetrics': [{
+                        'Namespace': self.namespace,
+                        'Dimensions': [list(self.dimensions)],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, (unit, values) in metrics.items()
+                                    if len(values) > offset]
+                    }]
+                }
+            }
+            record.update(self.dimensions)
+            for name, (_, values) in metrics.items():
+                if len(values) > offset:
+                    record[name] = values[offset:offset + MAX_VALUES_PER_RECORD]
+
+            self.sink(record)
+            offset += MAX_VALUES_PER_RECORD
+
+
+def default_dimensions():
+    return {'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')}
+
+
+# the collector every lambda module reports to
+metrics = MetricsLogger()
+
+# the logger every lambda module logs its debug output to
+logger = logging.getLogger('artificien')
+
+# libraries that never log below INFO, even if the root logger does
+QUIET_LOGGERS = ['botocore', 'boto3', 'urllib3']
+for name in QUIET_LOGGERS:
+    logging.getLogger(name).setLevel(logging.INFO)
+
+
+def sample_log_level(rate=None):
+    """ Log at DEBUG for a sampled fraction of invocations and at INFO for the rest """
+    rate = DEBUG_SAMPLE_RATE if rate is None else rate
+    logger.setLevel(logging.DEBUG if random.random() < rate else logging.INFO)
+
+
+def instrumented_handler(handler):
+    """ Wraps a lambda handler: samples the log level, times the invocation and flushes its metrics """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        sample_log_level()
+        try:
+            with metrics.timer('HandlerTime'):
+                return handler(event, context)
+        finally:
+            metrics.flush()
+    return wrapper
+
+
+@contextmanager
+def capture_metrics():
+    """ Collect the EMF records flushed inside the block in a list instead of printing them
+
+    Values collected before the block (e.g. by earlier tests) are dropped, so the records only hold what ran inside it.
+    """
+    records = []
+    previous_sink = metrics.sink
+    metrics.clear()
+    metrics.sink = records.append
+    try:
+        yield records
+    finally:
+        metrics.sink = previous_sink
+
+
+def metric_values(records, name):
+    """ All values of one metric across a list of captured EMF records """
+    return [value for record in records for value in record.get(name, [])]
@@ -1,15 +1,21 @@
 import os
 import sys
 import json
+import time
+import uuid
+import hashlib
 import logging
-import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
 
 efs_mount = '/mnt/python/'
 sys.path.append(efs_mount)  # import dependencies installed in EFS (can ONLY import EFS packages AFTER this step)
 # import syft as sy
-import requests
-import torch as th
+from instrumentation import instrumented_handler, logger, metrics
 
 logging.getLogger().setLevel(logging.INFO)
 
@@ -34,7 +40,120 @@ Requirements for the response:
     "body": "..."
     }
 '''
-logging.getLogger().setLevel(logging.INFO)
+
+# Nothing but these clients is set up when a container starts, and every invocation of the container reuses them.
+# Resources aren't thread safe, so every thread gets its own tables (see get_dynamodb). requests is installed on the
+# EFS mount, which is slow to import from, so only the first transfer from PyGrid imports it (see get_http_session)
+s3_bucket_name = os.environ['S3_BUCKET']
+s3 = boto3.client('s3')
+lambda_client = boto3.client('lambda')
+thread_local = threading.local()
+http_session = None
+
+# models are streamed from PyGrid into S3 in parts of this size, a few parts at a time, so the memory needed doesn't
+# depend on the size of the model
+transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=4)
+
+
+# Retrieved models are cached in S3 per owner, model, version and checkpoint number: a checkpoint never changes, so a
+# model that is already there is answered with a HEAD and no PyGrid traffic, and a newer checkpoint is simply another
+# key. 'latest' resolves through the model item's latest_checkpoint, if whoever registers the model's checkpoints
+# records it
+model_key_format = '{owner}/{model_id}/{version}/checkpoint-{checkpoint}/model.pkl'
+
+# Otherwise 'latest' can't be cached, as PyGrid doesn't say which checkpoint it served: every such retrieval gets a
+# key of its own (so nobody downloading an earlier one sees it change), and the bucket expires them with their jobs
+latest_key_format = 'latest/{owner}/{model_id}/{version}/{transfer_id}/model.pkl'
+
+# the first request for a checkpoint that isn't cached yet takes a lease on the model item and fills the cache; any
+# other request for it meanwhile waits up to cache_wait_seconds for the model to show up. Transfers of 'latest' hold
+# the same lease, so a model is only ever transferred from PyGrid once at a time. The lease lasts as long as the
+# function may run
+retrieval_lease_seconds = int(os.environ.get('RETRIEVAL_LEASE_SECONDS', '60'))
+cache_wait_seconds = 20  # API gateway gives up after 29 seconds
+cache_poll_seconds = 1
+
+# /retrieve only queues a job (kept in the job table for job_ttl_seconds) and returns its id; an asynchronous
+# invocation of this same function does the transfer, reporting its progress on the job every
+# progress_interval_seconds, and /retrieve/status reads it back
+job_table_name = os.environ.get('JOB_TABLE', 'model_retrieval_job_table')
+function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+job_ttl_seconds = 7 * 24 * 60 * 60
+progress_interval_seconds = 5
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+JOB_BATCH = 'batch'  # not a job itself: the ids of the jobs of one /retrieve/batch request
+
+# /retrieve/batch queues a job per model (at most max_batch_models) and a worker transfers them, batch_workers at a
+# time, finishing every job (and flipping the active_status of the models retrieved together, in one transaction per
+# max_transaction_items models) as soon as it is done. A worker only starts a job while its invocation has at least
+# transfer_budget_seconds left, and hands the jobs it didn't start to a new invocation
+max_batch_models = 100
+batch_workers = int(os.environ.get('BATCH_WORKERS', '4'))
+max_transaction_items = 100
+transfer_budget_seconds = int(os.environ.get('TRANSFER_BUDGET_SECONDS', '300'))
+
+# a job waits for another request retrieving the same model only as long as that leaves it transfer_budget_seconds,
+# and one still running job_deadline_margin_seconds before the invocation times out is marked failed, as lambda stops
+# it without running any more of its code
+job_deadline_margin_seconds = 10
+
+# Finished models are downloaded straight from S3 through presigned GET urls, which accept Range requests. Next to
+# every model is a manifest of its sha256 and that of every manifest_chunk_bytes chunk, computed as the model streams
+# through, so clients can download a large model in parallel ranges and resume
+download_url_seconds = int(os.environ.get('DOWNLOAD_URL_SECONDS', '900'))
+manifest_chunk_bytes = 8 * 1024 * 1024
+
+# the PyGrid node of models whose item doesn't have a node_URL
+default_node_url = "http://pygri-pygri-frtwp3inl2zq-2ea21a767266378c.elb.us-east-1.amazonaws.com:5000"
+
+
+class CountingReader:
+    """ Read-only file object over a streamed response body, counting and checksumming the bytes read through it, as
+    a whole and per chunk of chunk_bytes """
+
+    def __init__(self, raw, chunk_bytes=manifest_chunk_bytes):
+        self.raw = raw
+        self.bytes_read = 0
+        self.chunk_bytes = chunk_bytes
+        self.sha256 = hashlib.sha256()
+        self.chunk_hashes = []
+        self._chunk = hashlib.sha256()
+        self._chunk_read = 0
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        self.bytes_read += len(data)
+        self.sha256.update(data)
+
+        view = memoryview(data)
+        while view:
+            taken = min(len(view), self.chunk_bytes - self._chunk_read)
+            self._chunk.update(view[:taken])
+            self._chunk_read += taken
+            view = view[taken:]
+            if self._chunk_read == self.chunk_bytes:
+                self.chunk_hashes.append(self._chunk.hexdigest())
+                self._chunk, self._chunk_read = hashlib.sha256(), 0
+        return data
+
+    def manifest(self):
+        """ The size and checksums of everything read, once it has all been read """
+        chunk_hashes = self.chunk_hashes + ([self._chunk.hexdigest()] if self._chunk_read else [])
+        return {
+            'bytes': self.bytes_read,
+            'sha256': self.sha256.hexdigest(),
+            'chunk_bytes': self.chunk_bytes,
+            'chunks': [{'offset': i * self.chunk_bytes,
+                        'length': min(self.chunk_bytes, self.bytes_read - i * self.chunk_bytes),
+                        'range': 'bytes={}-{}'.format(i * self.chunk_bytes,
+                                                      min((i + 1) * self.chunk_bytes, self.bytes_read) - 1),
+                        'sha256': chunk_hash} for i, chunk_hash in enumerate(chunk_hashes)]
+        }
 
 
 def default():
@@ -57,117 +176,637 @@ def test():
     }
 
 
-def retrieve(event):
-    # 1. parse out the event values
-    query_string_parameters = event['queryStringParameters']
+def get_dynamodb():
+    if not hasattr(thread_local, 'dynamodb'):
+        thread_local.dynamodb = boto3.session.Session().resource('dynamodb', region_name='us-east-1')
+    return thread_local.dynamodb
+
+
+def get_model_table():
+    return get_dynamodb().Table('model_table')
+
+
+def get_http_session():
+    global http_session
+    if http_session is None:
+        import requests
+        http_session = requests.Session()
+    return http_session
 
-    user = query_string_parameters['ownerName']
-    model_id = query_string_parameters['modelId']
-    version = query_string_parameters['version']
-    node_url = "http://pygri-pygri-frtwp3inl2zq-2ea21a767266378c.elb.us-east-1.amazonaws.com:5000"  # test, should be query_string_parameters['nodeURL']
 
-    # 2. get pygrid model
+def get_model_item(table, model_id):
+    with metrics.timer('DynamoGetItemTime'):
+        return table.get_item(Key={'model_id': model_id}).get('Item')
+
+
+# the checkpoint number asked for, or the one 'latest' currently is; None if that isn't known
+def resolve_checkpoint(checkpoint, item):
+    if checkpoint == 'latest':
+        latest = item.get('latest_checkpoint')
+        return None if latest is None else int(latest)
+    return int(checkpoint)
+
+
+def model_exists(s3, s3_bucket_name, key):
+    try:
+        with metrics.timer('S3HeadTime'):
+            s3.head_object(Bucket=s3_bucket_name, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+
+# streams a model into the s3 bucket as it comes in from PyGrid; no copy of it in memory or on disk
+def transfer_model(s3, s3_bucket_name, key, node_url, model_id, version, checkpoint, progress=None):
     payload = {
         "name": model_id,
         "version": version,
-        "checkpoint": "latest"
+        "checkpoint": checkpoint
     }
 
     url = node_url + "/model-centric/retrieve-model"
-    r = requests.get(url, params=payload)
-    th.save(r.content, '/tmp/model.pkl') # only the /tmp directory in lambda is writable
-
-    # 3. put model to s3 bucket
-    s3 = boto3.client('s3')
-    s3_bucket_name = os.environ['S3_BUCKET']
-    region = os.environ['AWS_REGION']
-    file_name = user + model_id + version + '/tmp/model.pkl'
-    s3.upload_file('model.pkl', s3_bucket_name, file_name)
-    print('done!')
-
-    bucket_url = 'https://s3.console.aws.amazon.com/s3/object/' + s3_bucket_name + '?region=' + region + '&prefix=' + file_name
-
-    # 4. flip is_active boolean on model in dynamo
-    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-    table = dynamodb.Table('model_table')
-
-    update_response = table.update_item(
-        Key={'model_id': model_id},
-        UpdateExpression="set active_status = :r",
-        ExpressionAttributeValues={
-            ':r': 0,
-        },
+    with metrics.timer('PyGridRetrieveTime'):
+        r = get_http_session().get(url, params=payload, stream=True)
+    with r:
+        r.raise_for_status()
+        r.raw.decode_content = True  # undo any transfer compression, as r.content would
+        body = CountingReader(r.raw)
+        if progress is not None:
+            progress.start(int(r.headers['Content-Length']) if 'Content-Length' in r.headers else None)
+        with metrics.timer('ModelTransferTime'):
+            s3.upload_fileobj(body, s3_bucket_name, key, Config=transfer_config, Callback=progress)
+        if progress is not None:
+            progress.finish()
+
+    # the manifest goes last, so whoever finds it finds the whole model
+    with metrics.timer('S3PutObjectTime'):
+        s3.put_object(Bucket=s3_bucket_name, Key=manifest_key(key), Body=json.dumps(body.manifest()).encode('utf-8'),
+                      ContentType='application/json')
+
+    metrics.put_metric('ModelBytes', body.bytes_read, 'Bytes')
+    logger.debug('uploaded model %s version %s (%s bytes) to %s', model_id, version, body.bytes_read, key)
+
+
+# takes the retrieval lease of a model, returning its owner, or None if another request holds it
+def acquire_retrieval_lease(table, model_id):
+    owner, now = uuid.uuid4().hex, int(time.time())
+    try:
+        with metrics.timer('DynamoUpdateItemTime'):
+            table.update_item(
+                Key={'model_id': model_id},
+                UpdateExpression="set retrieval_lease_owner = :o, retrieval_lease_expires = :e",
+                # a model that doesn't exist is not leased (an update would create it)
+                ConditionExpression="attribute_exists(model_id) AND "
+                                    "(attribute_not_exists(retrieval_lease_owner) OR retrieval_lease_expires < :now)",
+                ExpressionAttributeValues={':o': owner, ':e': now + retrieval_lease_seconds, ':now': now}
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return None
+    return owner
+
+
+def release_retrieval_lease(table, model_id, owner):
+    try:
+        with metrics.timer('DynamoUpdateItemTime'):
+            table.update_item(
+                Key={'model_id': model_id},
+                UpdateExpression="remove retrieval_lease_owner, retrieval_lease_expires",
+                ConditionExpression="retrieval_lease_owner = :o",
+                ExpressionAttributeValues={':o': owner}
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+# makes sure a checkpoint of a model is in the cache, filling it if needed; returns False if another request is still
+# filling it after wait_seconds
+def cache_model(s3, s3_bucket_name, table, key, node_url, model_id, version, checkpoint,
+                wait_seconds=cache_wait_seconds, progress=None):
+    deadline = time.monotonic() + wait_seconds
+    while not model_exists(s3, s3_bucket_name, key):
+        owner = acquire_retrieval_lease(table, model_id)
+        if owner is not None:
+            try:
+                # another request may have filled the cache just before giving the lease back
+                if not model_exists(s3, s3_bucket_name, key):
+                    transfer_model(s3, s3_bucket_name, key, node_url, model_id, version, checkpoint, progress)
+                    metrics.put_metric('ModelCacheMisses', 1, 'Count')
+                return True
+            finally:
+                release_retrieval_lease(table, model_id, owner)
+
+        if time.monotonic() >= deadline:
+            return False
+        metrics.put_metric('ModelCacheWaits', 1, 'Count')
+        time.sleep(cache_poll_seconds)
+
+    metrics.put_metric('ModelCacheHits', 1, 'Count')
+    return True
+
+
+# transfers the latest checkpoint of a model, which can't be cached, under the retrieval lease; returns False if
+# another request still holds the lease after wait_seconds
+def transfer_latest(s3, s3_bucket_name, table, key, node_url, model_id, version, wait_seconds=cache_wait_seconds,
+                    progress=None):
+    deadline = time.monotonic() + wait_seconds
+    owner = acquire_retrieval_lease(table, model_id)
+    while owner is None:
+        if time.monotonic() >= deadline:
+            return False
+        metrics.put_metric('RetrievalLeaseWaits', 1, 'Count')
+        time.sleep(cache_poll_seconds)
+        owner = acquire_retrieval_lease(table, model_id)
+
+    try:
+        transfer_model(s3, s3_bucket_name, key, node_url, model_id, version, 'latest', progress)
+        metrics.put_metric('LatestModelTransfers', 1, 'Count')
+    finally:
+        release_retrieval_lease(table, model_id, owner)
+    return True
+
+
+def model_key(user, model_id, version, checkpoint):
+    return model_key_format.format(owner=user, model_id=model_id, version=version, checkpoint=checkpoint)
+
+
+def latest_key(user, model_id, version):
+    return latest_key_format.format(owner=user, model_id=model_id, version=version, transfer_id=uuid.uuid4().hex)
+
+
+def retrieve_model(s3, s3_bucket_name, table, item, user, version, checkpoint, wait_seconds=cache_wait_seconds,
+                   progress=None):
+    """ Gets a checkpoint of a model into the s3 bucket unless it is already there (a 'latest' whose number isn't
+    known, always), returning its key, or None if another request is still retrieving it after wait_seconds """
+    model_id = item['model_id']
+    node_url = item.get('node_URL') or default_node_url
+
+    checkpoint_number = resolve_checkpoint(checkpoint, item)
+    if checkpoint_number is None:
+        key = latest_key(user, model_id, version)
+        if not transfer_latest(s3, s3_bucket_name, table, key, node_url, model_id, version, wait_seconds, progress):
+            return None
+        return key
+
+    key = model_key(user, model_id, version, checkpoint_number)
+    if not cache_model(s3, s3_bucket_name, table, key, node_url, model_id, version, checkpoint_number, wait_seconds,
+                       progress):
+        return None
+    return key
+
+
+def manifest_key(key):
+    return key + '.manifest.json'
+
+
+# the manifest of a model, or None for models cached before there were manifests
+def read_manifest(s3, s3_bucket_name, key):
+    try:
+        with metrics.timer('S3GetObjectTime'):
+            body = s3.get_object(Bucket=s3_bucket_name, Key=manifest_key(key))['Body'].read()
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return json.loads(body)
+
+
+# a short-lived url anyone can download the model from, all at once or in ranges
+def download_url(s3, s3_bucket_name, key):
+    return s3.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': s3_bucket_name, 'Key': key},
+        ExpiresIn=download_url_seconds
     )
 
+
+# flip is_active boolean on models in dynamo, in one transaction per max_transaction_items models
+def deactivate_models(table, model_ids):
+    model_ids = list(dict.fromkeys(model_ids))  # a transaction can't touch the same item twice
+    for i in range(0, len(model_ids), max_transaction_items):
+        with metrics.timer('DynamoTransactWriteTime'):
+            table.meta.client.transact_write_items(TransactItems=[{
+                'Update': {
+                    'TableName': table.name,
+                    'Key': {'model_id': model_id},
+                    'UpdateExpression': "set active_status = :r",
+                    'ExpressionAttributeValues': {':r': 0}
+                }
+            } for model_id in model_ids[i:i + max_transaction_items]])
+
+
+# flip is_active boolean on model in dynamo
+def deactivate_model(table, model_id):
+    with metrics.timer('DynamoUpdateItemTime'):
+        update_response = table.update_item(
+            Key={'model_id': model_id},
+            UpdateExpression="set active_status = :r",
+            ExpressionAttributeValues={
+                ':r': 0,
+            },
+        )
+
     if update_response:
-        print("UPDATE success")
+        logger.debug("UPDATE success")
+
+
+def get_job_table():
+    return get_dynamodb().Table(job_table_name)
+
+
+def update_job(job_table, job_id, **attributes):
+    attributes['updated_at'] = int(time.time())
+    with metrics.timer('DynamoUpdateItemTime'):
+        job_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression='set ' + ', '.join('#{0} = :{0}'.format(name) for name in attributes),
+            ExpressionAttributeNames={'#' + name: name for name in attributes},
+            ExpressionAttributeValues={':' + name: value for name, value in attributes.items()}
+        )
 
-    # # 5. return response with url  
+
+class JobProgress:
+    """ Upload callback recording how far the transfer of a job got on its item, at most every
+    progress_interval_seconds """
+
+    def __init__(self, job_table, job_id):
+        self.job_table = job_table
+        self.job_id = job_id
+        self.bytes_transferred = 0
+        self._last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def start(self, total_bytes):
+        update_job(self.job_table, self.job_id, total_bytes=total_bytes)
+
+    # the callback skips updates that come less than progress_interval_seconds apart, the last one included
+    def finish(self):
+        update_job(self.job_table, self.job_id, bytes_transferred=self.bytes_transferred)
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.bytes_transferred += bytes_amount
+            if time.monotonic() - self._last_update < progress_interval_seconds:
+                return
+            self._last_update = time.monotonic()
+            bytes_transferred = self.bytes_transferred
+        update_job(self.job_table, self.job_id, bytes_transferred=bytes_transferred)
+
+
+# the checkpoint a request asks for: 'latest' or a checkpoint number, given as a number or a string of one; None if it
+# is neither, so that a bad request is turned down before a job is queued for it
+def parse_checkpoint(checkpoint):
+    if checkpoint == 'latest':
+        return checkpoint
+    try:
+        number = int(checkpoint)
+    except (TypeError, ValueError):
+        return None
+    if number < 0 or isinstance(checkpoint, (bool, float)):
+        return None
+    return number
+
+
+def new_job(job_id, user, model_id, version, checkpoint, now):
     return {
-        'statusCode': 200,
-        'isBase64Encoded': False,
-        'headers': {},
-        'body': {'message': 'You\'ve successfully invoked the retrieve model method'},
-        'url': bucket_url
+        'job_id': job_id,
+        'job_status': JOB_QUEUED,
+        'owner_name': user,
+        'model_id': model_id,
+        'version': version,
+        'checkpoint': checkpoint,
+        'bytes_transferred': 0,
+        'created_at': now,
+        'updated_at': now,
+        'expires_at': now + job_ttl_seconds  # the table's TTL attribute
     }
 
 
+# hands jobs to an asynchronous invocation of this function (see lambda_handler)
+def invoke_worker(payload):
+    with metrics.timer('LambdaInvokeTime'):
+        lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType='Event',
+            Payload=json.dumps(payload).encode('utf-8')
+        )
+
+
 def retrieve(event):
+    """ Queues the retrieval of a model, answering right away with the id of the job (see retrieval_status) """
     # 1. parse out the event values
     query_string_parameters = event['queryStringParameters']
 
     user = query_string_parameters['ownerName']
     model_id = query_string_parameters['modelId']
     version = query_string_parameters['version']
-    node_url = "http://pygri-pygri-frtwp3inl2zq-2ea21a767266378c.elb.us-east-1.amazonaws.com:5000"  # test, should be query_string_parameters['nodeURL']
+    checkpoint = parse_checkpoint(query_string_parameters.get('checkpoint', 'latest'))
+    if checkpoint is None:
+        return {
+            'isBase64Encoded': False,
+            'statusCode': 400,
+            'headers': {},
+            'body': json.dumps({'message': "checkpoint is either 'latest' or a checkpoint number"})
+        }
 
-    # 2. get pygrid model
-    payload = {
-        "name": model_id,
-        "version": version,
-        "checkpoint": "latest"
+    table = get_model_table()
+    if get_model_item(table, model_id) is None:
+        return {
+            'isBase64Encoded': False,
+            'statusCode': 404,
+            'headers': {},
+            'body': json.dumps({'message': 'No model {}'.format(model_id)})
+        }
+
+    # 2. record the job, then hand it to an asynchronous invocation of this function (see run_retrieval_job)
+    job_id = uuid.uuid4().hex
+    with metrics.timer('DynamoPutItemTime'):
+        get_job_table().put_item(Item=new_job(job_id, user, model_id, version, checkpoint, int(time.time())))
+    invoke_worker({'retrieval_job': job_id})
+
+    # 3. return the job id; /retrieve/status tells when the model is ready and where
+    return {
+        'isBase64Encoded': False,
+        'statusCode': 202,
+        'headers': {'Location': '/retrieve/status?jobId=' + job_id},
+        'body': json.dumps({'message': 'Retrieving model {}'.format(model_id), 'jobId': job_id})
     }
 
-    url = node_url + "/model-centric/retrieve-model"
-    r = requests.get(url, params=payload)
-    th.save(r.content, '/tmp/model.pkl') # only the /tmp directory in lambda is writable
-
-    # 3. put model to s3 bucket
-    s3 = boto3.client('s3')
-    s3_bucket_name = os.environ['S3_BUCKET']
-    region = os.environ['AWS_REGION']
-    file_name = user + model_id + version + '/tmp/model.pkl'
-    s3.upload_file('model.pkl', s3_bucket_name, file_name)
-    print('done!')
-
-    bucket_url = 'https://s3.console.aws.amazon.com/s3/object/' + s3_bucket_name + '?region=' + region + '&prefix=' + file_name
-
-    # 4. flip is_active boolean on model in dynamo
-    dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
-    table = dynamodb.Table('model_table')
-
-    update_response = table.update_item(
-        Key={'model_id': model_id},
-        UpdateExpression="set active_status = :r",
-        ExpressionAttributeValues={
-            ':r': 0,
-        },
-    )
 
-    if update_response:
-        print("UPDATE success")
+# the models of an owner that have finished training but haven't been retrieved yet (active models still training
+# are left alone)
+def owner_active_models(table, user):
+    query = {'IndexName': 'owner_name-active_status-index',
+             'KeyConditionExpression': Key('owner_name').eq(user) & Key('active_status').eq(1),
+             'FilterExpression': Attr('percent_complete').gte(100)}
+    items = []
+    while True:
+        with metrics.timer('DynamoQueryTime'):
+            response = table.query(**query)
+        items += response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def retrieve_batch(event):
+    """ Queues the retrieval of several models: the ones listed in the body ({"ownerName": ..., "models": [{"modelId":
+    ..., "version": ..., "checkpoint": ...}]}), or every model of the owner that has finished training but hasn't been
+    retrieved yet if there is no list. Answers right away with the id of the batch, whose status lists that of every
+    model """
+    body = json.loads(event.get('body') or '{}')
+    user = body['ownerName']
+
+    if 'models' in body:
+        models = [(model['modelId'], model['version'], parse_checkpoint(model.get('checkpoint', 'latest')))
+                  for model in body['models']]
+        if any(checkpoint is None for _, _, checkpoint in models):
+            return {
+                'isBase64Encoded': False,
+                'statusCode': 400,
+                'headers': {},
+                'body': json.dumps({'message': "checkpoint is either 'latest' or a checkpoint number"})
+            }
+    else:
+        models = [(item['model_id'], item['version'], 'latest')
+                  for item in owner_active_models(get_model_table(), user)]
+
+    if not 0 < len(models) <= max_batch_models:
+        message = 'A batch holds between 1 and {} models, not {}'.format(max_batch_models, len(models))
+        return {
+            'isBase64Encoded': False,
+            'statusCode': 400,
+            'headers': {},
+            'body': json.dumps({'message': message})
+        }
+
+    # a job per model, and the batch that lists them; one worker does them all
+    batch_id, now = uuid.uuid4().hex, int(time.time())
+    jobs = [new_job(uuid.uuid4().hex, user, model_id, version, checkpoint, now)
+            for model_id, version, checkpoint in models]
+    with metrics.timer('DynamoBatchWriteTime'), get_job_table().batch_writer() as batch:
+        for job in jobs:
+            batch.put_item(Item=job)
+        batch.put_item(Item={'job_id': batch_id, 'job_status': JOB_BATCH, 'owner_name': user,
+                             'job_ids': [job['job_id'] for job in jobs], 'created_at': now,
+                             'expires_at': now + job_ttl_seconds})
+    invoke_worker({'retrieval_batch': batch_id})
 
-    # # 5. return response with url  
     return {
-        'statusCode': 200,
         'isBase64Encoded': False,
+        'statusCode': 202,
+        'headers': {'Location': '/retrieve/status?jobId=' + batch_id},
+        'body': json.dumps({
+            'message': 'Retrieving {} models'.format(len(jobs)),
+            'batchId': batch_id,
+            'jobs': [{'jobId': job['job_id'], 'modelId': job['model_id'], 'version': job['version']} for job in jobs]
+        })
+    }
+
+
+def get_jobs(job_table, job_ids):
+    jobs, request = {}, {job_table.name: {'Keys': [{'job_id': job_id} for job_id in job_ids]}}
+    while request:
+        with metrics.timer('DynamoBatchGetItemTime'):
+            response = job_table.meta.client.batch_get_item(RequestItems=request)
+        jobs.update((job['job_id'], job) for job in response['Responses'].get(job_table.name, []))
+        request = response.get('UnprocessedKeys')
+    return [jobs[job_id] for job_id in job_ids if job_id in jobs]
+
+
+# marks a job failed, unless it is done by then
+def fail_job(job_table, job_id, error):
+    try:
+        with metrics.timer('DynamoUpdateItemTime'):
+            job_table.update_item(
+                Key={'job_id': job_id},
+                UpdateExpression='set job_status = :f, #error = :e, updated_at = :u',
+                ConditionExpression='job_status <> :d',
+                ExpressionAttributeNames={'#error': 'error'},
+                ExpressionAttributeValues={':f': JOB_FAILED, ':e': error, ':u': int(time.time()), ':d': JOB_DONE}
+            )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        return
+    metrics.put_metric('RetrievalJobFailures', 1, 'Count')
+
+
+# runs when a job is about to be stopped by the function timeout; on its own thread, so with its own table
+def time_out_job(job_id):
+    fail_job(get_job_table(), job_id, 'timed out')
+
+
+def transfer_job(job, deactivate=True, context=None):
+    """ Does the work of a queued job: the transfer from PyGrid, unless the model is already cached, and (unless
+    deactivate is False) the active_status flip. Returns the key of the model; a failure marks the job failed, as does
+    running out of the invocation's time """
+    table = get_model_table()
+    job_table = get_job_table()
+    job_id = job['job_id']
+    update_job(job_table, job_id, job_status=JOB_RUNNING)
+
+    watchdog = None
+    if context is not None:
+        watchdog = threading.Timer(remaining_seconds(context) - job_deadline_margin_seconds, time_out_job, [job_id])
+        watchdog.daemon = True
+        watchdog.start()
+
+    try:
+        item = get_model_item(table, job['model_id'])
+        if item is None:
+            raise LookupError('no model {}'.format(job['model_id']))
+
+        wait_seconds = max(0, min(retrieval_lease_seconds, remaining_seconds(context) - transfer_budget_seconds))
+        key = retrieve_model(s3, s3_bucket_name, table, item, job['owner_name'], job['version'], job['checkpoint'],
+                             wait_seconds=wait_seconds, progress=JobProgress(job_table, job_id))
+        if key is None:
+            raise TimeoutError('model {} is still being retrieved by another request'.format(job['model_id']))
+
+        if deactivate:
+            deactivate_model(table, job['model_id'])
+    except Exception as e:
+        # the invocation is retried (see the stack), which starts the job over
+        fail_job(job_table, job_id, str(e))
+        raise
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+    return key
+
+
+def finish_job(job_table, job, key):
+    update_job(job_table, job['job_id'], job_status=JOB_DONE, model_key=key)
+    metrics.put_metric('RetrievalJobTime', (time.time() - int(job['created_at'])) * 1000, 'Milliseconds')
+
+
+# the seconds the invocation has left; unlimited outside of lambda
+def remaining_seconds(context):
+    return context.get_remaining_time_in_millis() / 1000 if context is not None else float('inf')
+
+
+def run_retrieval_job(job_id, context=None):
+    job_table = get_job_table()
+    with metrics.timer('DynamoGetItemTime'):
+        job = job_table.get_item(Key={'job_id': job_id})['Item']
+    finish_job(job_table, job, transfer_job(job, context=context))
+
+
+def run_retrieval_batch(batch_id, context=None):
+    """ Does the jobs of a batch queued by retrieve_batch, batch_workers at a time, finishing them as they are done.
+    Jobs done by an earlier attempt are skipped; jobs that were never started go first, so every invocation gets
+    further through the batch. Jobs left when the invocation runs short of time are handed to a new invocation """
+    job_table = get_job_table()
+    with metrics.timer('DynamoGetItemTime'):
+        batch = job_table.get_item(Key={'job_id': batch_id})['Item']
+    jobs = [job for job in get_jobs(job_table, batch['job_ids']) if job['job_status'] != JOB_DONE]
+    jobs.sort(key=lambda job: job['job_status'] != JOB_QUEUED)
+
+    retrieved, failures, running = 0, 0, {}
+    with ThreadPoolExecutor(max_workers=batch_workers) as executor:
+        while jobs or running:
+            while jobs and len(running) < batch_workers and remaining_seconds(context) >= transfer_budget_seconds:
+                job = jobs.pop(0)
+                running[executor.submit(transfer_job, job, False, context)] = job
+            if not running:
+                break  # out of time
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            finished = []
+            for future in done:
+                job = running.pop(future)
+                try:
+                    finished.append((job, future.result()))
+                except Exception:
+                    logging.error('Failed to retrieve model %s', job['model_id'], exc_info=True)
+                    failures += 1
+
+            # the models are flipped before their jobs say they are done
+            deactivate_models(get_model_table(), [job['model_id'] for job, _ in finished])
+            for job, key in finished:
+                finish_job(job_table, job, key)
+            retrieved += len(finished)
+
+    metrics.put_metric('BatchModelsRetrieved', retrieved, 'Count')
+    if jobs:
+        # the new invocation also retries the jobs that failed in this one
+        metrics.put_metric('BatchContinuations', 1, 'Count')
+        invoke_worker({'retrieval_batch': batch_id})
+    elif failures:
+        # the retry only does the jobs that failed
+        raise RuntimeError('{} models of batch {} failed'.format(failures, batch_id))
+
+
+def job_status(s3, s3_bucket_name, job):
+    status = {
+        'jobId': job['job_id'],
+        'status': job['job_status'],
+        'modelId': job['model_id'],
+        'version': job['version'],
+        'bytesTransferred': int(job['bytes_transferred']),
+        'totalBytes': int(job['total_bytes']) if job.get('total_bytes') is not None else None,
+    }
+    # finished models come with a fresh download url, and large ones with the ranges to download them in
+    if job['job_status'] == JOB_DONE:
+        status['url'] = download_url(s3, s3_bucket_name, job['model_key'])
+        status['expiresIn'] = download_url_seconds
+        manifest = read_manifest(s3, s3_bucket_name, job['model_key'])
+        if manifest is not None:
+            status.update(bytes=manifest['bytes'], sha256=manifest['sha256'])
+            if len(manifest['chunks']) > 1:
+                status['chunks'] = manifest['chunks']
+    if job['job_status'] == JOB_FAILED:
+        status['error'] = job['error']
+    return status
+
+
+def retrieval_status(event):
+    """ The status of a job, or of every job of a batch """
+    job_id = event['queryStringParameters']['jobId']
+    job_table = get_job_table()
+    with metrics.timer('DynamoGetItemTime'):
+        job = job_table.get_item(Key={'job_id': job_id}).get('Item')
+    if job is None:
+        return {
+            'isBase64Encoded': False,
+            'statusCode': 404,
+            'headers': {},
+            'body': json.dumps({'message': 'No retrieval job {}'.format(job_id)})
+        }
+
+    if job['job_status'] == JOB_BATCH:
+        statuses = [job_status(s3, s3_bucket_name, batch_job) for batch_job in get_jobs(job_table, job['job_ids'])]
+        status = {
+            'batchId': job_id,
+            'done': sum(1 for batch_job in statuses if batch_job['status'] == JOB_DONE),
+            'failed': sum(1 for batch_job in statuses if batch_job['status'] == JOB_FAILED),
+            'jobs': statuses
+        }
+    else:
+        status = job_status(s3, s3_bucket_name, job)
+
+    return {
+        'isBase64Encoded': False,
+        'statusCode': 200,
         'headers': {},
-        'body': {'message': 'You\'ve successfully invoked the retrieve model method'},
-        'url': bucket_url
+        'body': json.dumps(status)
     }
 
 
+@instrumented_handler
 def lambda_handler(event, context):
+    # asynchronous invocations from retrieve and retrieve_batch
+    if 'retrieval_job' in event:
+        run_retrieval_job(event['retrieval_job'], context)
+        return
+    if 'retrieval_batch' in event:
+        run_retrieval_batch(event['retrieval_batch'], context)
+        return
+
     try:
         method = event['httpMethod']
         # body = event['body'] # JSON body passed to method
@@ -180,14 +819,19 @@ def lambda_handler(event, context):
                 return test()
             if event['path'] == '/retrieve':
                 return retrieve(event)
+            if event['path'] == '/retrieve/status':
+                return retrieval_status(event)
+
+        elif method == 'POST' and event['path'] == '/retrieve/batch':
+            return retrieve_batch(event)
 
         else:
-            # We only accept GET for now
+            # We only accept GET (and POST for batches) for now
             return {
                 'isBase64Encoded': False,
                 'statusCode': 400,
                 'headers': {},
-                'body': json.dumps('We only accept GET methods right now')
+                'body': json.dumps('We only accept GET methods right now, and POST /retrieve/batch')
             }
 
     except KeyError:
@@ -207,14 +851,3 @@ def lambda_handler(event, context):
             'headers': {},
             'body': json.dumps({'message': 'Unexpected error occurred.'})
         }
-
-
-event = {
-    "queryStringParameters": {
-        "ownerName": "QUILL",
-        "modelId": "mnist",
-        "version": "1.0"
-    }
-}
-
-print(retrieve(event))
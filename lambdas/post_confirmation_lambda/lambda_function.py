@@ -1,31 +1,53 @@
 import json
+import logging
 import boto3
 import secrets
+import contextlib
+
+# This lambda is deployed by hand, possibly without the instrumentation layer; sign-ups must not depend on it, so
+# without the layer the metrics are simply left out
+try:
+    from instrumentation import instrumented_handler, logger, metrics
+except ImportError:
+    class NoMetrics:
+        def timer(self, name):
+            return contextlib.nullcontext()
+
+        def put_metric(self, name, value, unit='None'):
+            pass
+
+    def instrumented_handler(handler):
+        return handler
+
+    metrics = NoMetrics()
+    logger = logging.getLogger('artificien')
 
 dynamodb = boto3.resource('dynamodb', region_name='us-east-1')
 table_name = 'user_table'
 user_table = dynamodb.Table(table_name)
 
 
+@instrumented_handler
 def lambda_handler(event, context):
 
-    print(event)
+    logger.debug('%s', event)
 
     email = event["request"]["userAttributes"]["email"]
     name = event["userName"]
 
     api_key = secrets.token_urlsafe(16)
 
-    user_table.put_item(
-        Item={
-            'user_id': email,
-            'user_account_email': email,
-            'username': name,
-            'has_onboarded': '0',
-            'role': '0',
-            'api_key': api_key,
-            'datasets_purchased': ['Artificien-Health']
-        }
-    )
+    with metrics.timer('DynamoPutItemTime'):
+        user_table.put_item(
+            Item={
+                'user_id': email,
+                'user_account_email': email,
+                'username': name,
+                'has_onboarded': '0',
+                'role': '0',
+                'api_key': api_key,
+                'datasets_purchased': ['Artificien-Health']
+            }
+        )
 
     return event
@@ -0,0 +1,98 @@
+import os
+import sys
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# the lambdas' modules are deployed flat, next to those of the instrumentation layer, so they are imported the way the
+# lambda runtime does
+root = os.path.join(os.path.dirname(__file__), '..', '..')
+sys.path.append(os.path.join(root, 'lambdas', 'instrumentation_layer', 'python'))
+sys.path.append(os.path.join(root, 'lambdas', 'data_upload_lambda'))
+sys.path.append(os.path.join(root, 'lambdas', 'model_retrieval_lambda'))
+
+DATASET_BUCKET = 'artificien-fake-dataset-storage'
+MODEL_BUCKET = 'artificien-retrieved-models-storage'
+
+# the modules that keep a dynamoDB resource per thread (thread_local), bound to whichever mock was running when it was
+# created
+THREAD_LOCAL_MODULES = ['helper_functions', 'get_models']
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """ moto's in-process stand-ins for every AWS service, with the environment the data upload lambda is deployed
+    with. The lambdas' modules read it when they are first imported, so import them inside the test """
+    monkeypatch.setenv('AWS_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('DYNAMO_TABLE', 'dataset_table')
+    monkeypatch.setenv('S3_BUCKET', DATASET_BUCKET)
+
+    with mock_aws():
+        for name in THREAD_LOCAL_MODULES:
+            if name in sys.modules:
+                sys.modules[name].thread_local.__dict__.clear()
+        yield
+
+
+@pytest.fixture
+def dataset_bucket(aws):
+    """ The bucket the sample datasets are written to """
+    boto3.client('s3').create_bucket(Bucket=DATASET_BUCKET)
+    return DATASET_BUCKET
+
+
+@pytest.fixture
+def dataset_table(aws):
+    """ The dataset table, streaming new images like the deployed one """
+    boto3.client('dynamodb').create_table(
+        TableName='dataset_table',
+        KeySchema=[{'AttributeName': 'dataset_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'dataset_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+        StreamSpecification={'StreamEnabled': True, 'StreamViewType': 'NEW_IMAGE'}
+    )
+    return boto3.resource('dynamodb').Table('dataset_table')
+
+
+@pytest.fixture
+def model_bucket(aws, monkeypatch):
+    """ The bucket retrieved models are written to; the model retrieval lambda is deployed with it as S3_BUCKET """
+    monkeypatch.setenv('S3_BUCKET', MODEL_BUCKET)
+    boto3.client('s3').create_bucket(Bucket=MODEL_BUCKET)
+    return MODEL_BUCKET
+
+
+@pytest.fixture
+def model_table(aws):
+    """ The model table, with the index of the models of an owner that haven't been retrieved yet """
+    boto3.client('dynamodb').create_table(
+        TableName='model_table',
+        KeySchema=[{'AttributeName': 'model_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'model_id', 'AttributeType': 'S'},
+                              {'AttributeName': 'owner_name', 'AttributeType': 'S'},
+                              {'AttributeName': 'active_status', 'AttributeType': 'N'}],
+        GlobalSecondaryIndexes=[{
+            'IndexName': 'owner_name-active_status-index',
+            'KeySchema': [{'AttributeName': 'owner_name', 'KeyType': 'HASH'},
+                          {'AttributeName': 'active_status', 'KeyType': 'RANGE'}],
+            'Projection': {'ProjectionType': 'ALL'}
+        }],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    return boto3.resource('dynamodb').Table('model_table')
+
+
+@pytest.fixture
+def job_table(aws):
+    """ The table of model retrieval jobs """
+    boto3.client('dynamodb').create_table(
+        TableName='model_retrieval_job_table',
+        KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'job_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    return boto3.resource('dynamodb').Table('model_retrieval_job_table')
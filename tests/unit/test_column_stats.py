@@ -0,0 +1,88 @@
+import json
+from decimal import Decimal
+
+import boto3
+import numpy as np
+
+from column_stats import HISTOGRAM_BINS, DatasetStats, summarize
+from fake_data import generate_column_chunks
+from schema_plan import compile_schema
+from vocabulary import ZIPF, get_vocabulary
+
+
+def test_streaming_stats_match_the_whole_data():
+    plan = compile_schema(['age', 'smoker', 'city', 'bmi'], ['N', 'B', 'S', 'F'], [18, 10.5], [90, 45.0])
+    vocabulary = get_vocabulary(distribution=ZIPF)
+    chunks = list(generate_column_chunks(plan, vocabulary, 8, 0, 25000))
+    age, smoker, city, bmi = [np.concatenate(column) for column in zip(*chunks)]
+
+    stats = DatasetStats(plan)
+    for data_columns in chunks:
+        stats.observe(data_columns)
+    columns = stats.to_dict()['columns']
+
+    assert stats.rows == 25000
+    for name, values in (('age', age), ('smoker', smoker), ('bmi', bmi)):
+        assert columns[name]['count'] == 25000
+        assert columns[name]['min'] == values.min() and columns[name]['max'] == values.max()
+        assert np.isclose(columns[name]['mean'], values.mean()) and np.isclose(columns[name]['variance'], values.var())
+        assert sum(columns[name]['histogram']['counts']) == 25000
+
+    assert len(columns['bmi']['histogram']['counts']) == HISTOGRAM_BINS
+    assert columns['smoker']['histogram']['counts'] == [int((smoker == 0).sum()), int((smoker == 1).sum())]
+
+    words, counts = np.unique(city, return_counts=True)
+    assert columns['city']['distinct'] == len(words)
+    assert columns['city']['top_words'][0] == {'word': words[counts.argmax()], 'count': counts.max()}
+    assert 'histogram' not in summarize(stats.to_dict())['columns']['bmi']
+
+
+def test_stats_sidecar_and_item_copy(dataset_bucket, dataset_table):
+    import helper_functions
+
+    s3, table = boto3.client('s3'), dataset_table
+    item = {
+        'dataset_id': 'stats',
+        'attributes': ['age', 'city'],
+        'attributeTypes': ['N', 'S'],
+        'attributeRangeMins': [Decimal(18)],
+        'attributeRangeMaxes': [Decimal(90)],
+        'num_devices': 3000,
+    }
+    table.put_item(Item=item)
+    helper_functions.query_to_csv('dataset_id', 'stats', item)
+
+    sidecar = json.loads(s3.get_object(Bucket=dataset_bucket, Key='/stats.stats.json')['Body'].read())
+    assert sidecar['rows'] == 3000 and sidecar['columns']['age']['count'] == 3000
+
+    # the data is already there the second time, so the statistics come from the sidecar
+    table.update_item(Key={'dataset_id': 'stats'}, UpdateExpression='remove column_stats')
+    helper_functions.query_to_csv('dataset_id', 'stats', item)
+    column_stats = table.get_item(Key={'dataset_id': 'stats'})['Item']['column_stats']
+    assert column_stats['columns']['age']['mean'] == Decimal(str(sidecar['columns']['age']['mean']))
+
+
+def test_wide_schema_stats_stay_out_of_the_item(dataset_bucket, dataset_table):
+    import helper_functions
+
+    types = ['N', 'F', 'B', 'S'] * 1250
+    numeric = [t for t in types if t in ('N', 'F')]
+    item = {
+        'dataset_id': 'wide',
+        'attributes': ['attribute_{}'.format(i) for i in range(len(types))],
+        'attributeTypes': types,
+        'attributeRangeMins': [Decimal(0)] * len(numeric),
+        'attributeRangeMaxes': [Decimal(1000)] * len(numeric),
+        'num_devices': 20,
+        'column_stats': {'rows': 20},  # from an earlier schema
+    }
+    dataset_table.put_item(Item=item)
+    helper_functions.query_to_csv('dataset_id', 'wide', item)
+
+    # even their summary is larger than an item can be, so the item only points at the sidecar
+    stored = dataset_table.get_item(Key={'dataset_id': 'wide'})['Item']
+    assert stored['sample_data_status'] == 'ready' and 'column_stats' not in stored
+    sidecar = json.loads(boto3.client('s3').get_object(Bucket=dataset_bucket, Key=stored['column_stats_key'])['Body']
+                         .read())
+    assert len(sidecar['columns']) == 5000
+    assert helper_functions.dynamo_size(stored) <= helper_functions.max_item_bytes
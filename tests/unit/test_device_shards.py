@@ -0,0 +1,60 @@
+import json
+from decimal import Decimal
+
+import boto3
+import numpy as np
+
+from device_shards import DeviceLayout, generate_device_columns
+from fake_data import BLOCK_ROWS, generate_column_chunks
+from schema_plan import compile_schema
+from vocabulary import get_vocabulary
+
+
+def get_plan():
+    return compile_schema(['age', 'smoker', 'city', 'bmi'], ['N', 'B', 'S', 'F'], [18, 10.5], [90, 45.0])
+
+
+def test_unskewed_shards_are_the_dataset_cut_up():
+    plan, vocabulary = get_plan(), get_vocabulary()
+    layout = DeviceLayout(num_devices=7, rows_per_device=BLOCK_ROWS // 3)
+
+    devices = list(generate_device_columns(plan, vocabulary, 3, layout))
+    whole = [np.concatenate(column) for column in zip(*generate_column_chunks(plan, vocabulary, 3, 0, layout.num_rows))]
+
+    assert [device for device, _ in devices] == list(range(7))
+    for column, values in enumerate(whole):
+        assert np.array_equal(np.concatenate([columns[column] for _, columns in devices]), values)
+
+
+def test_skew_narrows_every_device_within_the_range():
+    plan, vocabulary = get_plan(), get_vocabulary()
+    devices = list(generate_device_columns(plan, vocabulary, 3, DeviceLayout(20, 500, skew=0.8)))
+
+    ages = [columns[0] for _, columns in devices]
+    assert all(a.dtype == np.int64 and a.min() >= 18 and a.max() <= 90 for a in ages)
+    assert all(a.max() - a.min() <= (90 - 18) * 0.2 + 1 for a in ages)
+    assert np.std([a.mean() for a in ages]) > 5  # devices sit at different places in the range
+
+
+def test_device_shards_written_with_manifest(dataset_bucket):
+    import helper_functions
+
+    s3 = boto3.client('s3')
+    item = {
+        'dataset_id': 'federated',
+        'attributes': ['age', 'city'],
+        'attributeTypes': ['N', 'S'],
+        'attributeRangeMins': [Decimal(18)],
+        'attributeRangeMaxes': [Decimal(90)],
+        'num_devices': 12,
+        'rowsPerDevice': 250,
+        'deviceSkew': Decimal('0.5'),
+    }
+    helper_functions.upload_device_shards(helper_functions.grab_relevant_info('dataset_id', 'federated', item))
+
+    manifest = json.loads(s3.get_object(Bucket=dataset_bucket, Key='/federated/devices/manifest.json')['Body'].read())
+    assert manifest['num_devices'] == 12 and len(manifest['devices']) == 12
+    shard = s3.get_object(Bucket=dataset_bucket,
+                          Key='/federated/devices/' + manifest['devices'][5]['file'])['Body'].read()
+    assert len(shard) == manifest['devices'][5]['bytes']
+    assert len(shard.decode('utf-8').splitlines()) == 251  # header and the device's rows
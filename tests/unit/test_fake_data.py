@@ -0,0 +1,86 @@
+import numpy as np
+
+from fake_data import (
+    BLOCK_CELLS, BLOCK_ROWS, encode_csv_range, generate_column_chunks, generate_row_chunks, plan_block_rows,
+    shard_ranges, write_csv_parts
+)
+from schema_plan import compile_schema
+from vocabulary import ZIPF, get_vocabulary
+
+
+def get_plan():
+    return compile_schema(
+        ['age', 'smoker', 'city', 'bmi', 'steps'],
+        ['N', 'B', 'S', 'F', 'N'],
+        [18, 10.5, 0],
+        [90, 45.0, 30000]
+    )
+
+
+def single_process_csv(plan, vocabulary, seed, num_rows):
+    return b''.join(encode_csv_range(plan, vocabulary, seed, 0, num_rows))
+
+
+def test_parallel_parts_match_single_process(tmp_path):
+    plan, vocabulary, seed = get_plan(), get_vocabulary(distribution=ZIPF), 1234
+    num_rows = 3 * BLOCK_ROWS + 17
+
+    paths = write_csv_parts(plan, vocabulary, seed, num_rows, str(tmp_path), num_shards=4, max_workers=2)
+    parallel = b''.join(open(path, 'rb').read() for path in paths)
+
+    assert parallel == single_process_csv(plan, vocabulary, seed, num_rows)
+
+
+def test_rows_do_not_depend_on_shard_layout():
+    plan, vocabulary, seed = get_plan(), get_vocabulary(), 99
+    num_rows = 2 * BLOCK_ROWS + 500
+
+    def rows(start, stop):
+        return [row for chunk in generate_row_chunks(plan, vocabulary, seed, start, stop) for row in chunk]
+
+    whole = rows(0, num_rows)
+    assert len(whole) == num_rows
+    assert rows(0, 7) + rows(7, BLOCK_ROWS + 3) + rows(BLOCK_ROWS + 3, num_rows) == whole
+
+
+def test_seed_changes_rows():
+    plan, vocabulary = get_plan(), get_vocabulary()
+    assert single_process_csv(plan, vocabulary, 1, 100) != single_process_csv(plan, vocabulary, 2, 100)
+
+
+def test_shard_ranges_cover_rows_in_order():
+    num_rows = 5 * BLOCK_ROWS + 1
+    ranges = shard_ranges(num_rows, 3)
+
+    assert ranges[0][0] == 0 and ranges[-1][1] == num_rows
+    assert all(stop == next_start for (_, stop), (next_start, _) in zip(ranges, ranges[1:]))
+    assert all(start % BLOCK_ROWS == 0 for start, _ in ranges)
+
+
+def test_correlated_columns_follow_correlation_and_ranges():
+    plan = compile_schema(['height', 'weight', 'age'], ['F', 'F', 'N'], [150, 40, 18], [200, 120, 90],
+                          correlations=[('height', 'weight', 0.8)])
+    chunks = list(generate_column_chunks(plan, get_vocabulary(), 5, 0, 50000))
+    height, weight, age = [np.concatenate(column) for column in zip(*chunks)]
+
+    assert abs(np.corrcoef(height, weight)[0, 1] - 0.8) < 0.02
+    assert height.min() >= 150 and height.max() <= 200 and weight.min() >= 40 and weight.max() <= 120
+    assert age.dtype == np.int64 and age.min() >= 18 and age.max() <= 90
+
+
+def test_wide_schema_blocks_are_bounded():
+    types = ['N', 'B', 'S', 'F'] * 1250
+    numeric = [t for t in types if t in ('N', 'F')]
+    plan = compile_schema(['attribute_{}'.format(i) for i in range(len(types))], types, [-5] * len(numeric),
+                          [5] * len(numeric))
+    block_rows = plan_block_rows(plan)
+    chunks = list(generate_column_chunks(plan, get_vocabulary(), 11, 0, 3 * block_rows + 1))
+
+    assert block_rows * len(types) <= BLOCK_CELLS
+    assert [len(chunk[0]) for chunk in chunks] == [block_rows] * 3 + [1]
+    for column, attribute_type in enumerate(types):
+        values = np.concatenate([chunk[column] for chunk in chunks])
+        if attribute_type in ('N', 'F'):
+            assert values.min() >= -5 and values.max() <= 5
+        if attribute_type == 'B':
+            assert set(values.tolist()) <= {0, 1}
@@ -0,0 +1,46 @@
+from decimal import Decimal
+
+import boto3
+import pytest
+
+
+def test_overlapping_generations_are_deduplicated(monkeypatch, dataset_bucket, dataset_table):
+    import helper_functions
+
+    monkeypatch.setattr(helper_functions, 'lease_wait_seconds', 0)
+
+    s3, table = boto3.client('s3'), dataset_table
+    item = {
+        'dataset_id': 'leased',
+        'attributes': ['age', 'city'],
+        'attributeTypes': ['N', 'S'],
+        'attributeRangeMins': [Decimal(18)],
+        'attributeRangeMaxes': [Decimal(90)],
+        'num_devices': 100,
+    }
+    table.put_item(Item=item)
+
+    # another worker holds the lease: this one leaves the dataset to it
+    other = helper_functions.acquire_generation_lease('leased')
+    assert helper_functions.acquire_generation_lease('leased') is None
+    helper_functions.query_to_csv('dataset_id', 'leased', item)
+    assert s3.list_objects_v2(Bucket=dataset_bucket, Prefix='/leased.csv')['KeyCount'] == 0
+
+    # once its lease has run out, the next worker takes over, and the stale one can no longer record its files
+    table.update_item(Key={'dataset_id': 'leased'}, UpdateExpression="set generation_lease_expires = :e",
+                      ExpressionAttributeValues={':e': 0})
+    helper_functions.query_to_csv('dataset_id', 'leased', item)
+    assert len(s3.get_object(Bucket=dataset_bucket, Key='/leased.csv')['Body'].read().splitlines()) == 101
+    stored = table.get_item(Key={'dataset_id': 'leased'})['Item']
+    assert stored['sample_data_status'] == 'ready' and stored['generation_version'] == other.version + 1
+    assert 'generation_lease_owner' not in stored
+
+    table.update_item(Key={'dataset_id': 'leased'}, UpdateExpression="remove sample_data_hashes")
+    helper_functions.save_content_hashes(other, {'csv': 'stale'})
+    assert 'sample_data_hashes' not in table.get_item(Key={'dataset_id': 'leased'})['Item']
+
+    # a failed generation gives its lease back right away
+    monkeypatch.setattr(helper_functions, 'write_full_sample_data', lambda *args: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        helper_functions.query_to_csv('dataset_id', 'leased', item)
+    assert helper_functions.acquire_generation_lease('leased') is not None
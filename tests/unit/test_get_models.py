@@ -0,0 +1,329 @@
+import io
+import os
+import sys
+import json
+import time
+import hashlib
+import subprocess
+from urllib.parse import urlparse, parse_qs
+
+import boto3
+import pytest
+
+MODEL = os.urandom(9 * 1024 * 1024)  # two manifest chunks
+
+
+class FakeBody(io.BytesIO):
+    """ A response body that remembers the most it was asked to read at once """
+
+    largest_read = 0
+
+    def read(self, size=-1):
+        self.largest_read = max(self.largest_read, size if size >= 0 else len(self.getvalue()))
+        return super().read(size)
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.raw = FakeBody(body)
+        self.headers = {'Content-Length': str(len(body))}
+
+    def raise_for_status(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakePyGrid:
+    """ Stands in for the requests session to PyGrid """
+
+    def __init__(self):
+        self.requests = []
+        self.responses = []
+
+    def get(self, url, params, stream):
+        assert stream, 'the model is to be streamed'
+        self.requests.append(params)
+        self.responses.append(FakeResponse(MODEL))
+        return self.responses[-1]
+
+
+class InlineLambda:
+    """ Runs asynchronous invocations of the function right away """
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.handler(json.loads(Payload), None)
+
+
+class QueuedLambda:
+    """ Keeps asynchronous invocations of the function until the test runs them """
+
+    def __init__(self):
+        self.payloads = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.payloads.append(json.loads(Payload))
+
+
+class FakeContext:
+    """ The lambda context, with the remaining time of the invocation counting down through the given values """
+
+    def __init__(self, *remaining_seconds):
+        self.remaining_seconds = list(remaining_seconds)
+
+    def get_remaining_time_in_millis(self):
+        # the last value stays
+        if len(self.remaining_seconds) > 1:
+            return self.remaining_seconds.pop(0) * 1000
+        return self.remaining_seconds[0] * 1000
+
+
+def call(get_models, method, path, parameters=None, body=None):
+    response = get_models.lambda_handler({'httpMethod': method, 'path': path, 'queryStringParameters': parameters,
+                                          'body': body}, None)
+    return response['statusCode'], json.loads(response['body'])
+
+
+@pytest.fixture
+def pygrid():
+    return FakePyGrid()
+
+
+@pytest.fixture
+def get_models(monkeypatch, pygrid, model_bucket, model_table, job_table):
+    """ The model retrieval lambda, talking to the fake PyGrid and doing its jobs right away, with three models of
+    QUILL that have finished training but haven't been retrieved yet """
+    import get_models
+
+    monkeypatch.setattr(get_models, 'http_session', pygrid)
+    monkeypatch.setattr(get_models, 'lambda_client', InlineLambda(get_models.lambda_handler))
+
+    for model_id in ['mnist', 'cifar', 'iris']:
+        model_table.put_item(Item={'model_id': model_id, 'owner_name': 'QUILL', 'active_status': 1, 'version': '1.0',
+                                   'percent_complete': 100, 'latest_checkpoint': 3, 'node_URL': 'http://pygrid:5000'})
+    return get_models
+
+
+def test_models_are_streamed_from_pygrid_into_s3(get_models, pygrid, model_bucket):
+    s3, key = boto3.client('s3'), 'QUILL/mnist/1.0/checkpoint-3/model.pkl'
+    get_models.transfer_model(s3, model_bucket, key, 'http://pygrid:5000', 'mnist', '1.0', 3)
+
+    # the model is stored as PyGrid serves it, in multipart parts read off the response one at a time
+    assert pygrid.requests == [{'name': 'mnist', 'version': '1.0', 'checkpoint': 3}]
+    assert s3.get_object(Bucket=model_bucket, Key=key)['Body'].read() == MODEL
+    assert s3.head_object(Bucket=model_bucket, Key=key)['ETag'].endswith('-2"')
+    assert pygrid.responses[0].raw.largest_read <= get_models.transfer_config.multipart_chunksize
+
+
+def test_checkpoints_are_cached_and_latest_without_a_number_is_not(get_models, pygrid, model_bucket, model_table):
+    s3, item = boto3.client('s3'), model_table.get_item(Key={'model_id': 'mnist'})['Item']
+
+    # 'latest' resolves to the checkpoint the model item records, which is transferred once
+    for checkpoint in ['latest', 3]:
+        key = get_models.retrieve_model(s3, model_bucket, model_table, item, 'QUILL', '1.0', checkpoint)
+        assert key == 'QUILL/mnist/1.0/checkpoint-3/model.pkl'
+    assert pygrid.requests == [{'name': 'mnist', 'version': '1.0', 'checkpoint': 3}]
+
+    # without it, every retrieval transfers the model again, to a key nobody else is downloading
+    del item['latest_checkpoint']
+    keys = [get_models.retrieve_model(s3, model_bucket, model_table, item, 'QUILL', '1.0', 'latest')
+            for _ in range(2)]
+    assert keys[0] != keys[1] and all(key.startswith('latest/QUILL/mnist/1.0/') for key in keys)
+    assert all(s3.get_object(Bucket=model_bucket, Key=key)['Body'].read() == MODEL for key in keys)
+    assert s3.list_objects_v2(Bucket=model_bucket, Prefix='QUILL/mnist/1.0/checkpoint-latest')['KeyCount'] == 0
+    assert len(pygrid.requests) == 3
+
+    # and still takes the retrieval lease, giving it back once it is done
+    owner = get_models.acquire_retrieval_lease(model_table, 'mnist')
+    assert owner is not None
+    assert get_models.retrieve_model(s3, model_bucket, model_table, item, 'QUILL', '1.0', 'latest',
+                                     wait_seconds=0) is None
+    assert len(pygrid.requests) == 3
+
+
+def test_retrieve_queues_a_job_and_reports_its_status(monkeypatch, get_models, pygrid):
+    worker = QueuedLambda()
+    monkeypatch.setattr(get_models, 'lambda_client', worker)
+
+    # the request only queues the job
+    parameters = {'ownerName': 'QUILL', 'modelId': 'mnist', 'version': '1.0', 'checkpoint': '3'}
+    status_code, body = call(get_models, 'GET', '/retrieve', parameters)
+    assert status_code == 202 and worker.payloads == [{'retrieval_job': body['jobId']}]
+    status_code, status = call(get_models, 'GET', '/retrieve/status', {'jobId': body['jobId']})
+    assert status_code == 200 and status['status'] == 'queued' and status['bytesTransferred'] == 0
+    assert pygrid.requests == []
+
+    # which the asynchronous invocation then does
+    get_models.lambda_handler(worker.payloads.pop(), None)
+    status_code, status = call(get_models, 'GET', '/retrieve/status', {'jobId': body['jobId']})
+    assert status['status'] == 'done' and status['bytesTransferred'] == status['totalBytes'] == len(MODEL)
+    assert 'QUILL/mnist/1.0/checkpoint-3/model.pkl' in status['url']
+
+    # a job that fails says why
+    monkeypatch.setattr(pygrid, 'get', lambda *args, **kwargs: 1 / 0)
+    status_code, body = call(get_models, 'GET', '/retrieve', dict(parameters, modelId='cifar'))
+    with pytest.raises(ZeroDivisionError):
+        get_models.lambda_handler(worker.payloads.pop(), None)
+    status_code, status = call(get_models, 'GET', '/retrieve/status', {'jobId': body['jobId']})
+    assert status['status'] == 'failed' and 'division' in status['error']
+
+    # requests that can't be done are turned down without a job
+    for checkpoint in ['newest', '-1', '2.5']:
+        assert call(get_models, 'GET', '/retrieve', dict(parameters, checkpoint=checkpoint))[0] == 400
+    status_code, body = call(get_models, 'POST', '/retrieve/batch', body=json.dumps(
+        {'ownerName': 'QUILL', 'models': [{'modelId': 'mnist', 'version': '1.0', 'checkpoint': True}]}))
+    assert status_code == 400
+    assert call(get_models, 'GET', '/retrieve', dict(parameters, modelId='vgg'))[0] == 404
+    assert call(get_models, 'GET', '/retrieve/status', {'jobId': 'unknown'})[0] == 404
+    assert worker.payloads == []
+
+
+def test_finished_jobs_link_to_the_model_with_a_manifest_of_its_chunks(get_models, model_bucket):
+    s3 = boto3.client('s3')
+    parameters = {'ownerName': 'QUILL', 'modelId': 'mnist', 'version': '1.0'}
+    status_code, body = call(get_models, 'GET', '/retrieve', parameters)
+    status_code, status = call(get_models, 'GET', '/retrieve/status', {'jobId': body['jobId']})
+
+    # a presigned link, valid for a while
+    url = urlparse(status['url'])
+    assert url.path.endswith('/QUILL/mnist/1.0/checkpoint-3/model.pkl')
+    assert any(name.endswith('Signature') for name in parse_qs(url.query))
+    assert status['expiresIn'] == get_models.download_url_seconds
+
+    # and the hashes to check the whole model and each of its ranges with
+    assert status['bytes'] == len(MODEL) and status['sha256'] == hashlib.sha256(MODEL).hexdigest()
+    assert [chunk['range'] for chunk in status['chunks']] == [
+        'bytes=0-8388607', 'bytes=8388608-{}'.format(len(MODEL) - 1)]
+    for chunk in status['chunks']:
+        part = s3.get_object(Bucket=model_bucket, Key='QUILL/mnist/1.0/checkpoint-3/model.pkl',
+                             Range=chunk['range'])['Body'].read()
+        assert len(part) == chunk['length'] and hashlib.sha256(part).hexdigest() == chunk['sha256']
+
+    # models cached before there were manifests still get a link
+    s3.delete_object(Bucket=model_bucket, Key='QUILL/mnist/1.0/checkpoint-3/model.pkl.manifest.json')
+    status_code, status = call(get_models, 'GET', '/retrieve/status', {'jobId': body['jobId']})
+    assert 'url' in status and 'sha256' not in status and 'chunks' not in status
+
+
+def test_batches_retrieve_the_models_an_owner_has_not_retrieved_yet(monkeypatch, get_models, pygrid, model_table):
+    worker = QueuedLambda()
+    monkeypatch.setattr(get_models, 'lambda_client', worker)
+    model_table.update_item(Key={'model_id': 'iris'}, UpdateExpression='set active_status = :a',
+                            ExpressionAttributeValues={':a': 0})
+    model_table.put_item(Item={'model_id': 'resnet', 'owner_name': 'OTHER', 'active_status': 1, 'version': '1.0',
+                               'percent_complete': 100})
+    model_table.put_item(Item={'model_id': 'alexnet', 'owner_name': 'QUILL', 'active_status': 1, 'version': '1.0',
+                               'percent_complete': 40})
+
+    def active_status():
+        return {item['model_id']: item['active_status'] for item in model_table.scan()['Items']}
+
+    # without a list, the batch holds the owner's models that are still active and have finished training
+    status_code, body = call(get_models, 'POST', '/retrieve/batch', body=json.dumps({'ownerName': 'QUILL'}))
+    assert status_code == 202 and len(body['jobs']) == 2
+    get_models.lambda_handler(worker.payloads.pop(), None)
+    status_code, status = call(get_models, 'GET', '/retrieve/status', {'jobId': body['batchId']})
+    assert status['done'] == 2 and status['failed'] == 0
+    assert sorted(job['modelId'] for job in status['jobs']) == ['cifar', 'mnist']
+    assert sorted(request['name'] for request in pygrid.requests) == ['cifar', 'mnist']
+    assert active_status() == {'mnist': 0, 'cifar': 0, 'iris': 0, 'resnet': 1, 'alexnet': 1}
+
+    # a listed model that fails doesn't hold the others back, and the retry only does it again
+    models = [{'modelId': 'mnist', 'version': '1.0'}, {'modelId': 'vgg', 'version': '1.0'}]
+    status_code, body = call(get_models, 'POST', '/retrieve/batch',
+                             body=json.dumps({'ownerName': 'QUILL', 'models': models}))
+    payload = worker.payloads.pop()
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            get_models.lambda_handler(payload, None)
+    status_code, status = call(get_models, 'GET', '/retrieve/status', {'jobId': body['batchId']})
+    assert status['done'] == 1 and status['failed'] == 1
+    assert len(pygrid.requests) == 2  # mnist was cached already
+
+    # batches that are empty or too large are turned down
+    for models in [[], [{'modelId': 'mnist', 'version': '1.0'}] * (get_models.max_batch_models + 1)]:
+        status_code, body = call(get_models, 'POST', '/retrieve/batch',
+                                 body=json.dumps({'ownerName': 'QUILL', 'models': models}))
+        assert status_code == 400
+    assert call(get_models, 'POST', '/retrieve/batch', body=json.dumps({'ownerName': 'QUILL'}))[0] == 400
+    assert worker.payloads == []
+
+
+def test_importing_leaves_requests_to_the_first_transfer():
+    # a new python process, the way a new container of the lambda starts
+    code = 'import sys, get_models; print(sorted({"requests", "torch", "syft"} & set(sys.modules)))'
+    environment = dict(os.environ, AWS_DEFAULT_REGION='us-east-1', S3_BUCKET='artificien-retrieved-models-storage',
+                       PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    output = subprocess.run([sys.executable, '-c', code], env=environment, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    assert output.strip().splitlines()[-1] == '[]'
+
+
+def test_batches_record_every_model_as_it_is_done_and_continue_when_short_of_time(monkeypatch, get_models, pygrid,
+                                                                                  model_table):
+    worker = QueuedLambda()
+    monkeypatch.setattr(get_models, 'lambda_client', worker)
+    monkeypatch.setattr(get_models, 'batch_workers', 1)
+
+    status_code, body = call(get_models, 'POST', '/retrieve/batch', body=json.dumps({'ownerName': 'QUILL'}))
+    payload = worker.payloads.pop()
+
+    # the invocation has time for one model only: that one is done and flipped, the rest go to a new invocation
+    get_models.lambda_handler(payload, FakeContext(900, 60))
+    status_code, status = call(get_models, 'GET', '/retrieve/status', {'jobId': body['batchId']})
+    assert status['done'] == 1 and [job['status'] for job in status['jobs']].count('queued') == 2
+    done = [job['modelId'] for job in status['jobs'] if job['status'] == 'done']
+    assert model_table.get_item(Key={'model_id': done[0]})['Item']['active_status'] == 0
+    assert worker.payloads == [payload]
+
+    # which does the rest
+    get_models.lambda_handler(worker.payloads.pop(), FakeContext(900))
+    status_code, status = call(get_models, 'GET', '/retrieve/status', {'jobId': body['batchId']})
+    assert status['done'] == 3 and len(pygrid.requests) == 3 and worker.payloads == []
+    assert all(item['active_status'] == 0 for item in model_table.scan()['Items'])
+
+
+def test_jobs_fail_before_the_invocation_times_out(monkeypatch, get_models, pygrid, model_table, job_table):
+    worker = QueuedLambda()
+    monkeypatch.setattr(get_models, 'lambda_client', worker)
+    monkeypatch.setattr(get_models, 'cache_poll_seconds', 0.01)
+
+    def retrieve(model_id):
+        parameters = {'ownerName': 'QUILL', 'modelId': model_id, 'version': '1.0'}
+        return call(get_models, 'GET', '/retrieve', parameters)[1]['jobId']
+
+    def job_status(job_id):
+        return job_table.get_item(Key={'job_id': job_id})['Item']['job_status']
+
+    # another request holds the model: the job only waits for it as long as it still has time for the transfer
+    owner = get_models.acquire_retrieval_lease(model_table, 'mnist')
+    job_id = retrieve('mnist')
+    with pytest.raises(TimeoutError):
+        get_models.lambda_handler(worker.payloads.pop(), FakeContext(get_models.transfer_budget_seconds + 0.05))
+    assert job_status(job_id) == 'failed'
+    get_models.release_retrieval_lease(model_table, 'mnist', owner)
+
+    # a transfer still going when the invocation is about to time out is marked failed first
+    seen = []
+    transfer = pygrid.get
+
+    def slow_get(url, params, stream):
+        time.sleep(0.3)
+        seen.append(job_status(job_id))
+        return transfer(url, params, stream)
+    monkeypatch.setattr(pygrid, 'get', slow_get)
+    job_id = retrieve('cifar')
+    get_models.lambda_handler(worker.payloads.pop(), FakeContext(get_models.job_deadline_margin_seconds + 0.1))
+    assert seen == ['failed']
+    assert job_status(job_id) == 'done'  # lambda would have stopped it; here it got to finish
+
+    # leases are only taken on models that exist
+    assert get_models.acquire_retrieval_lease(model_table, 'vgg') is None
+    assert 'Item' not in model_table.get_item(Key={'model_id': 'vgg'})
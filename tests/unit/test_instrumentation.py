@@ -0,0 +1,84 @@
+import logging
+from decimal import Decimal
+
+from boto3.dynamodb.types import TypeSerializer
+
+from instrumentation import (
+    MAX_VALUES_PER_RECORD, MetricsLogger, capture_metrics, logger, metric_values, metrics, sample_log_level
+)
+
+
+def test_flush_emits_embedded_metric_format():
+    records = []
+    logger = MetricsLogger(namespace='Test', dimensions={'FunctionName': 'fn'}, sink=records.append)
+
+    with logger.timer('WorkTime'):
+        pass
+    logger.put_metric('Rows', 10, 'Count')
+    logger.flush()
+
+    assert len(records) == 1
+    record = records[0]
+    directive = record['_aws']['CloudWatchMetrics'][0]
+    assert directive['Namespace'] == 'Test' and directive['Dimensions'] == [['FunctionName']]
+    assert {'Name': 'Rows', 'Unit': 'Count'} in directive['Metrics']
+    assert {'Name': 'WorkTime', 'Unit': 'Milliseconds'} in directive['Metrics']
+    assert record['FunctionName'] == 'fn' and record['Rows'] == [10] and record['WorkTime'][0] >= 0
+
+    # flushing clears the collected values
+    logger.flush()
+    assert len(records) == 1
+
+
+def test_flush_splits_values_over_records():
+    records = []
+    logger = MetricsLogger(dimensions={}, sink=records.append)
+    for i in range(MAX_VALUES_PER_RECORD + 1):
+        logger.put_metric('Value', i)
+    logger.flush()
+
+    assert [len(record['Value']) for record in records] == [MAX_VALUES_PER_RECORD, 1]
+    assert metric_values(records, 'Value') == list(range(MAX_VALUES_PER_RECORD + 1))
+
+
+def test_sample_log_level(monkeypatch):
+    monkeypatch.setattr(logging.getLogger(), 'level', logging.INFO)
+    sample_log_level(rate=1.0)
+    assert logger.isEnabledFor(logging.DEBUG)
+    sample_log_level(rate=0.0)
+    assert not logger.isEnabledFor(logging.DEBUG) and logger.isEnabledFor(logging.INFO)
+
+    # the AWS SDK logs signed request headers at DEBUG, which stays off even if the root logger is set to it
+    sample_log_level(rate=1.0)
+    logging.getLogger().setLevel(logging.DEBUG)
+    assert not any(logging.getLogger(name).isEnabledFor(logging.DEBUG)
+                   for name in ['botocore.endpoint', 'botocore.auth', 'boto3.resources', 'urllib3.connectionpool'])
+
+
+def test_data_upload_lambda_metrics(dataset_bucket, dataset_table):
+    import lambda_function
+
+    item = {
+        'dataset_id': 'metrics',
+        'attributes': ['age', 'city'],
+        'attributeTypes': ['N', 'S'],
+        'attributeRangeMins': [Decimal(18)],
+        'attributeRangeMaxes': [Decimal(90)],
+        'num_devices': 1000,  # small enough to be generated in one phase
+    }
+    dataset_table.put_item(Item=item)
+    event = {'Records': [{
+        'eventID': '1',
+        'eventName': 'INSERT',
+        'dynamodb': {'SequenceNumber': '1', 'NewImage': {k: TypeSerializer().serialize(v) for k, v in item.items()}}
+    }]}
+
+    with capture_metrics() as records:
+        assert lambda_function.lambda_handler(event, None) == {'batchItemFailures': []}
+
+    assert metrics.sink is not records.append
+    assert sum(metric_values(records, 'RowsGenerated')) == 1000
+    assert metric_values(records, 'SampleDataGenerated') == [1]
+    for name in ('HandlerTime', 'GenerationTime', 'S3HeadTime', 'S3PutObjectTime', 'S3CopyTime',
+                 'DynamoUpdateItemTime'):
+        assert metric_values(records, name), name
@@ -0,0 +1,69 @@
+import gzip
+import io
+from decimal import Decimal
+
+import boto3
+import pyarrow.parquet as pq
+
+import output_formats
+from output_formats import PARQUET, write_rows
+from schema_plan import compile_schema
+from vocabulary import get_vocabulary
+
+
+def mixed_plan(num_columns):
+    types = ['N', 'B', 'S', 'F'] * (num_columns // 4)
+    numeric = [t for t in types if t in ('N', 'F')]
+    return compile_schema(['attribute_{}'.format(i) for i in range(num_columns)], types, [0] * len(numeric),
+                          [1000] * len(numeric))
+
+
+def test_parquet_row_groups_are_bounded_in_values(monkeypatch):
+    monkeypatch.setattr(output_formats, 'ROW_GROUP_CELLS', 1000000)
+    plan, body = mixed_plan(1000), io.BytesIO()
+    write_rows(PARQUET, plan, get_vocabulary(), 7, 0, 2050, body)
+
+    # a wide schema is written in row groups of 1,000 rows, not one of them all
+    metadata = pq.ParquetFile(io.BytesIO(body.getvalue())).metadata
+    assert metadata.num_rows == 2050 and metadata.num_columns == 1000
+    assert [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)] == [1000, 1000, 50]
+
+    # and a narrow one still in row groups of ROW_GROUP_ROWS
+    body = io.BytesIO()
+    write_rows(PARQUET, mixed_plan(4), get_vocabulary(), 7, 0, 2050, body)
+    assert pq.ParquetFile(io.BytesIO(body.getvalue())).metadata.num_row_groups == 1
+
+
+def test_formats_hold_the_same_typed_rows(dataset_bucket, dataset_table):
+    import helper_functions
+
+    item = {
+        'dataset_id': 'formats',
+        'attributes': ['age', 'smoker', 'city', 'weight'],
+        'attributeTypes': ['N', 'B', 'S', 'F'],
+        'attributeRangeMins': [Decimal(18), Decimal(40)],
+        'attributeRangeMaxes': [Decimal(90), Decimal(120)],
+        'num_devices': 100,
+        'sampleDataFormats': ['csv', 'csv.gz', 'parquet'],
+        'parquetCompression': 'zstd',
+    }
+    dataset_table.put_item(Item=item)
+    helper_functions.query_to_csv('dataset_id', 'formats', item)
+
+    s3 = boto3.client('s3')
+    csv = s3.get_object(Bucket=dataset_bucket, Key='/formats.csv')['Body'].read()
+    assert len(csv.splitlines()) == 101
+
+    # the gzipped csv is served as such, and is the csv
+    compressed = s3.get_object(Bucket=dataset_bucket, Key='/formats.csv.gz')
+    assert compressed['ContentEncoding'] == 'gzip' and compressed['ContentType'] == 'text/csv'
+    assert gzip.decompress(compressed['Body'].read()) == csv
+
+    # parquet keeps the column types, compressed as asked
+    body = s3.get_object(Bucket=dataset_bucket, Key='/formats.parquet')['Body'].read()
+    parquet = pq.ParquetFile(io.BytesIO(body))
+    assert [str(field.type) for field in parquet.schema_arrow] == ['int64', 'bool', 'string', 'double']
+    assert {parquet.metadata.row_group(0).column(i).compression for i in range(4)} == {'ZSTD'}
+    table = parquet.read()
+    ages = [int(line.split(b',')[0]) for line in csv.splitlines()[1:]]
+    assert table.num_rows == 100 and table.column('age').to_pylist() == ages
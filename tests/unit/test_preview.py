@@ -0,0 +1,43 @@
+import json
+from decimal import Decimal
+
+import boto3
+
+
+def test_preview_then_full_generation(monkeypatch, dataset_bucket, dataset_table):
+    import helper_functions
+    import row_api
+
+    requests = []
+    monkeypatch.setattr(helper_functions, 'request_generation', lambda *args, **kwargs: requests.append(args))
+
+    s3, table = boto3.client('s3'), dataset_table
+    item = {
+        'dataset_id': 'two-phase',
+        'attributes': ['age', 'city'],
+        'attributeTypes': ['N', 'S'],
+        'attributeRangeMins': [Decimal(18)],
+        'attributeRangeMaxes': [Decimal(90)],
+        'num_devices': 5000,
+    }
+    table.put_item(Item=item)
+
+    # phase one: only the preview, and a request for the rest
+    helper_functions.register_sample_data('dataset_id', 'two-phase', item)
+    preview = json.loads(s3.get_object(Bucket=dataset_bucket, Key='/two-phase.preview.json')['Body'].read())
+    assert preview['columns'] == ['age', 'city'] and preview['num_rows'] == 5000
+    assert len(preview['rows']) == helper_functions.preview_rows
+    assert requests == [('two-phase',)]
+    assert table.get_item(Key={'dataset_id': 'two-phase'})['Item']['sample_data_status'] == 'preview'
+    assert s3.list_objects_v2(Bucket=dataset_bucket, Prefix='/two-phase.csv')['KeyCount'] == 0
+
+    # phase two, as the generation function runs it; the preview is the start of the full data
+    row_api.lambda_handler({'materialize': 'two-phase', 'force': False}, None)
+    lines = s3.get_object(Bucket=dataset_bucket, Key='/two-phase.csv')['Body'].read().decode('utf-8').splitlines()
+    assert len(lines) == 5001
+    assert lines[1] == '{},{}'.format(*preview['rows'][0])
+    assert table.get_item(Key={'dataset_id': 'two-phase'})['Item']['sample_data_status'] == 'ready'
+
+    # a retry of the stream record doesn't take a ready dataset back to its preview
+    helper_functions.register_sample_data('dataset_id', 'two-phase', item)
+    assert table.get_item(Key={'dataset_id': 'two-phase'})['Item']['sample_data_status'] == 'ready'
@@ -0,0 +1,98 @@
+import json
+from decimal import Decimal
+
+import boto3
+
+
+def dataset(dataset_id, attribute_types=('N', 'S')):
+    return {
+        'dataset_id': dataset_id,
+        'attributes': ['age', 'city'],
+        'attributeTypes': list(attribute_types),
+        'attributeRangeMins': [Decimal(18)],
+        'attributeRangeMaxes': [Decimal(90)],
+        'num_devices': 50,
+    }
+
+
+def test_redrive_regenerates_and_deletes_only_what_succeeded(monkeypatch, dataset_bucket, dataset_table):
+    import redrive
+
+    # one dataset keeps failing, the way an outage would
+    query_to_csv = redrive.query_to_csv
+
+    def flaky_query_to_csv(column_header, input, item=None, force=False):
+        if input == 'flaky':
+            raise RuntimeError('S3 is down')
+        query_to_csv(column_header, input, item, force)
+    monkeypatch.setattr(redrive, 'query_to_csv', flaky_query_to_csv)
+    monkeypatch.setattr(redrive, 'dynamodb', boto3.resource('dynamodb'))
+
+    s3 = boto3.client('s3')
+    for item in [dataset('first'), dataset('second'), dataset('invalid', ['N', 'X']), dataset('flaky')]:
+        dataset_table.put_item(Item=item)
+
+    # the failed stream batches, as the event source mapping describes them in the dead letter queue
+    streams = boto3.client('dynamodbstreams')
+    stream_arn = dataset_table.latest_stream_arn
+    shard_id = streams.describe_stream(StreamArn=stream_arn)['StreamDescription']['Shards'][0]['ShardId']
+    iterator = streams.get_shard_iterator(StreamArn=stream_arn, ShardId=shard_id,
+                                          ShardIteratorType='TRIM_HORIZON')['ShardIterator']
+    records = streams.get_records(ShardIterator=iterator)['Records']
+    sequence_numbers = [record['dynamodb']['SequenceNumber'] for record in records]
+
+    def batch_info(start, end):
+        return json.dumps({'DDBStreamBatchInfo': {'streamArn': stream_arn, 'shardId': shard_id,
+                                                  'startSequenceNumber': sequence_numbers[start],
+                                                  'endSequenceNumber': sequence_numbers[end]}})
+
+    sqs = boto3.client('sqs')
+    queue_url = sqs.create_queue(QueueName='deadLetterQueueNewDataset')['QueueUrl']
+    for body in [batch_info(0, 2), batch_info(3, 3), json.dumps({'materialize': 'second', 'force': True})]:
+        sqs.send_message(QueueUrl=queue_url, MessageBody=body)
+
+    assert redrive.redrive(queue_url, workers=2, visibility_timeout=0) == (2, 1)
+    for dataset_id in ['first', 'second']:
+        lines = s3.get_object(Bucket=dataset_bucket, Key='/{}.csv'.format(dataset_id))['Body'].read().splitlines()
+        assert len(lines) == 51
+    assert s3.list_objects_v2(Bucket=dataset_bucket, Prefix='/flaky.csv')['KeyCount'] == 0
+
+    # only the message of the failing dataset is left for the next run
+    left = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10)['Messages']
+    assert [message['Body'] for message in left] == [batch_info(3, 3)]
+
+
+class FakeContext:
+    """ A lambda context whose remaining time steps through the given seconds, staying at the last """
+
+    def __init__(self, *remaining_seconds):
+        self.remaining_seconds = list(remaining_seconds)
+
+    def get_remaining_time_in_millis(self):
+        if len(self.remaining_seconds) > 1:
+            return self.remaining_seconds.pop(0) * 1000
+        return self.remaining_seconds[0] * 1000
+
+
+def test_redrive_stops_taking_messages_before_the_function_times_out(monkeypatch, dataset_bucket, dataset_table):
+    import redrive
+
+    monkeypatch.setattr(redrive, 'batch_messages', 1)
+    sqs = boto3.client('sqs')
+    queue_url = sqs.create_queue(QueueName='deadLetterQueueSampleDataGeneration')['QueueUrl']
+    for dataset_id in ['first', 'second', 'third']:
+        dataset_table.put_item(Item=dataset(dataset_id))
+        sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps({'materialize': dataset_id}))
+
+    # time for two batches of one message, and then not for a third
+    context = FakeContext(900, 600, redrive.batch_budget_seconds - 1)
+    response = redrive.lambda_handler({'queue_urls': [queue_url]}, context)
+    assert response == {queue_url: {'redriven': 2, 'left': 0}}
+
+    # the last message was never taken off the queue, so the next run finds it right away
+    left = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, VisibilityTimeout=0)['Messages']
+    assert [json.loads(message['Body']) for message in left] == [{'materialize': 'third'}]
+    assert redrive.redrive(queue_url) == (1, 0)
+    s3 = boto3.client('s3')
+    for dataset_id in ['first', 'second', 'third']:
+        assert s3.list_objects_v2(Bucket=dataset_bucket, Prefix='/{}.csv'.format(dataset_id))['KeyCount'] == 1
@@ -0,0 +1,89 @@
+import io
+import json
+import base64
+from decimal import Decimal
+
+import pyarrow as pa
+import pytest
+
+DATASET = {
+    'dataset_id': 'paged',
+    'attributes': ['age', 'smoker', 'city'],
+    'attributeTypes': ['N', 'B', 'S'],
+    'attributeRangeMins': [Decimal(18)],
+    'attributeRangeMaxes': [Decimal(90)],
+    'num_devices': 25000,
+}
+
+
+@pytest.fixture
+def get(dataset_table):
+    import row_api
+
+    dataset_table.put_item(Item=DATASET)
+
+    def get(path, **parameters):
+        event = {'httpMethod': 'GET', 'path': path, 'queryStringParameters': parameters or None}
+        return row_api.lambda_handler(event, None)
+    return get
+
+
+def body(response):
+    return base64.b64decode(response['body'])
+
+
+def test_pages_concatenate_to_the_dataset(get):
+    first = get('/datasets/paged/rows', offset='0', limit='15000')
+    second = get('/datasets/paged/rows', offset='15000', limit='15000')
+    whole = get('/datasets/paged/rows', offset='0', limit='25000')
+
+    assert first['headers']['X-Total-Rows'] == '25000' and first['headers']['X-Next-Offset'] == '15000'
+    assert 'X-Next-Offset' not in second['headers']
+
+    header, *first_rows = body(first).decode('utf-8').splitlines()
+    second_header, *second_rows = body(second).decode('utf-8').splitlines()
+    assert header == second_header == 'age,smoker,city'
+    assert [header] + first_rows + second_rows == body(whole).decode('utf-8').splitlines()
+
+
+def test_formats_hold_the_same_rows(get):
+    csv_rows = body(get('/datasets/paged/rows', offset='10', limit='5')).decode('utf-8').splitlines()[1:]
+    json_rows = [json.loads(line) for line in body(get('/datasets/paged/rows', offset='10', limit='5',
+                                                       format='jsonl')).decode('utf-8').splitlines()]
+    table = pa.ipc.open_stream(io.BytesIO(body(get('/datasets/paged/rows', offset='10', limit='5',
+                                                   format='arrow')))).read_all()
+
+    assert [row.split(',')[2] for row in csv_rows] == [row['city'] for row in json_rows] == table['city'].to_pylist()
+    assert [int(row.split(',')[0]) for row in csv_rows] == table['age'].to_pylist()
+
+
+def test_invalid_requests(get):
+    assert get('/datasets/missing/rows')['statusCode'] == 404
+    assert get('/datasets/paged/rows', limit='0')['statusCode'] == 400
+    assert get('/datasets/paged/rows', limit='many')['statusCode'] == 400
+    assert get('/datasets/paged/rows', format='xls')['statusCode'] == 400
+    assert get('/datasets/paged/columns')['statusCode'] == 404
+
+
+def test_wide_pages_are_bounded(monkeypatch, get, dataset_table):
+    import row_api
+
+    types = ['N', 'S'] * 2500
+    dataset_table.put_item(Item={
+        'dataset_id': 'wide',
+        'attributes': ['attribute_{}'.format(i) for i in range(len(types))],
+        'attributeTypes': types,
+        'attributeRangeMins': [Decimal(0)] * 2500,
+        'attributeRangeMaxes': [Decimal(9)] * 2500,
+        'num_devices': 1000,
+    })
+    monkeypatch.setattr(row_api, 'max_page_cells', 50000)
+
+    # a page of a wide schema holds fewer rows than asked for, and says where the rest start
+    page = get('/datasets/wide/rows', offset='0', limit='1000')
+    assert page['statusCode'] == 200 and page['headers']['X-Next-Offset'] == '10'
+    assert len(body(page).decode('utf-8').splitlines()) == 11
+
+    # a page that would still be too large to return stops being generated on the way
+    monkeypatch.setattr(row_api, 'max_response_bytes', 64 * 1024)
+    assert get('/datasets/wide/rows', offset='0', limit='1000')['statusCode'] == 413
@@ -0,0 +1,41 @@
+import os
+
+import boto3
+import pytest
+
+from s3_streaming import MIN_PART_SIZE, S3MultipartWriter
+
+
+def test_large_objects_are_uploaded_in_parts(dataset_bucket):
+    s3, data = boto3.client('s3'), os.urandom(2 * MIN_PART_SIZE + 12345)
+
+    # written in pieces that don't line up with the parts
+    with S3MultipartWriter(s3, dataset_bucket, 'parts.bin', part_size=MIN_PART_SIZE, ContentType='text/csv') as upload:
+        for start in range(0, len(data), 1000003):
+            upload.write(data[start:start + 1000003])
+        assert len(upload._parts) == 2  # the rest waits in the buffer for close
+
+    obj = s3.get_object(Bucket=dataset_bucket, Key='parts.bin')
+    assert obj['Body'].read() == data and obj['ContentType'] == 'text/csv'
+    assert obj['ETag'].endswith('-3"')
+    assert upload.bytes_written == len(data)
+
+
+def test_small_objects_are_put_whole(dataset_bucket):
+    s3 = boto3.client('s3')
+    with S3MultipartWriter(s3, dataset_bucket, 'small.csv') as upload:
+        upload.write(b'age,city\n')
+    assert s3.get_object(Bucket=dataset_bucket, Key='small.csv')['Body'].read() == b'age,city\n'
+    assert s3.list_multipart_uploads(Bucket=dataset_bucket).get('Uploads', []) == []
+
+
+def test_a_failed_write_aborts_the_upload(dataset_bucket):
+    s3 = boto3.client('s3')
+    with pytest.raises(RuntimeError):
+        with S3MultipartWriter(s3, dataset_bucket, 'failed.bin', part_size=MIN_PART_SIZE) as upload:
+            upload.write(os.urandom(MIN_PART_SIZE + 1))
+            raise RuntimeError('generation failed')
+
+    # nothing is left behind: neither the object nor the parts already uploaded
+    assert s3.list_multipart_uploads(Bucket=dataset_bucket).get('Uploads', []) == []
+    assert s3.list_objects_v2(Bucket=dataset_bucket, Prefix='failed.bin')['KeyCount'] == 0
@@ -0,0 +1,46 @@
+from decimal import Decimal
+
+import boto3
+
+from instrumentation import capture_metrics, metric_values, metrics
+
+
+def dataset(dataset_id):
+    return {
+        'dataset_id': dataset_id,
+        'attributes': ['age', 'city'],
+        'attributeTypes': ['N', 'S'],
+        'attributeRangeMins': [Decimal(18)],
+        'attributeRangeMaxes': [Decimal(90)],
+        'num_devices': 100,
+        'sampleSeed': 42,
+    }
+
+
+def test_identical_datasets_are_copied_from_the_cache(monkeypatch, dataset_bucket, dataset_table):
+    import helper_functions
+
+    s3 = boto3.client('s3')
+    for dataset_id in ['original', 'copy']:
+        dataset_table.put_item(Item=dataset(dataset_id))
+
+    with capture_metrics() as records:
+        helper_functions.query_to_csv('dataset_id', 'original', dataset('original'))
+        metrics.flush()
+    assert metric_values(records, 'SampleDataGenerated') == [1]
+    assert metric_values(records, 'SampleDataCacheHits') == []
+
+    # the same schema and seed: the second dataset's file is a copy of the first's, nothing is generated for it
+    def write_sample_data(*args, **kwargs):
+        raise AssertionError('generated a cached dataset')
+    monkeypatch.setattr(helper_functions, 'write_sample_data', write_sample_data)
+    with capture_metrics() as records:
+        helper_functions.query_to_csv('dataset_id', 'copy', dataset('copy'))
+        metrics.flush()
+    assert metric_values(records, 'SampleDataCacheHits') == [1]
+    assert metric_values(records, 'SampleDataGenerated') == []
+
+    original, copy = [s3.get_object(Bucket=dataset_bucket, Key='/{}.csv'.format(dataset_id))['Body'].read()
+                      for dataset_id in ['original', 'copy']]
+    assert copy == original and len(original.splitlines()) == 101
+    assert dataset_table.get_item(Key={'dataset_id': 'copy'})['Item']['sample_data_status'] == 'ready'
@@ -0,0 +1,53 @@
+from decimal import Decimal
+
+import boto3
+from boto3.dynamodb.types import TypeSerializer
+
+
+def stream_record(item, sequence_number):
+    serializer = TypeSerializer()
+    return {
+        'eventID': 'event-{}'.format(sequence_number),
+        'eventName': 'INSERT',
+        'dynamodb': {
+            'SequenceNumber': str(sequence_number),
+            'NewImage': {key: serializer.serialize(value) for key, value in item.items()}
+        }
+    }
+
+
+def dataset(dataset_id, attribute_types=('N', 'S')):
+    return {
+        'dataset_id': dataset_id,
+        'attributes': ['age', 'city'],
+        'attributeTypes': list(attribute_types),
+        'attributeRangeMins': [Decimal(18)],
+        'attributeRangeMaxes': [Decimal(90)],
+        'num_devices': 20,
+    }
+
+
+def test_only_the_records_that_failed_are_reported(monkeypatch, dataset_bucket, dataset_table):
+    import lambda_function
+
+    # one dataset fails to generate, the way an S3 outage would
+    register_sample_data = lambda_function.register_sample_data
+
+    def flaky_register_sample_data(column_header, input, item):
+        if input == 'flaky':
+            raise RuntimeError('S3 is down')
+        register_sample_data(column_header, input, item)
+    monkeypatch.setattr(lambda_function, 'register_sample_data', flaky_register_sample_data)
+
+    items = [dataset('first'), dataset('flaky'), dataset('second'), dataset('invalid', ['N', 'X'])]
+    for item in items:
+        dataset_table.put_item(Item=item)
+    records = [stream_record(item, 100 + i) for i, item in enumerate(items)]
+
+    # the invalid schema is skipped: retrying it can't help
+    response = lambda_function.lambda_handler({'Records': records}, None)
+    assert response == {'batchItemFailures': [{'itemIdentifier': '101'}]}
+    s3 = boto3.client('s3')
+    for dataset_id in ['first', 'second']:
+        assert s3.list_objects_v2(Bucket=dataset_bucket, Prefix='/{}.csv'.format(dataset_id))['KeyCount'] == 1
+    assert s3.list_objects_v2(Bucket=dataset_bucket, Prefix='/invalid')['KeyCount'] == 0
@@ -0,0 +1,46 @@
+import numpy as np
+
+from vocabulary import UNIFORM, ZIPF, Vocabulary, build_alias_table
+
+
+def alias_distribution(probabilities, aliases):
+    # the chance of every index: a column keeps itself with its probability and hands the rest to its alias
+    n = len(probabilities)
+    distribution = probabilities / n
+    np.add.at(distribution, aliases, (1.0 - probabilities) / n)
+    return distribution
+
+
+def test_alias_table_reproduces_the_weights():
+    weights = np.array([5.0, 0.0, 1.0, 3.0, 0.5, 0.0, 2.5])
+    probabilities, aliases = build_alias_table(weights)
+    assert np.allclose(alias_distribution(probabilities, aliases), weights / weights.sum())
+
+
+def test_zipf_draws_follow_the_weights():
+    vocabulary = Vocabulary('test', ['word{}'.format(i) for i in range(50)], ZIPF)
+    weights = 1.0 / np.arange(1, 51)
+
+    num_draws = 200000
+    counts = np.bincount(vocabulary.sample_indices(np.random.default_rng(3), num_draws), minlength=50)
+    assert np.allclose(counts / num_draws, weights / weights.sum(), atol=0.005)
+
+    # and the same seed draws the same words
+    first, second = [vocabulary.sample_indices(np.random.default_rng(3), 100).tolist() for _ in range(2)]
+    assert first == second
+
+
+def test_zero_weight_words_are_never_drawn():
+    vocabulary = Vocabulary('test', ['never', 'often', 'rarely', 'never again'], ZIPF)
+    vocabulary.probabilities, vocabulary.aliases = build_alias_table([0.0, 3.0, 1.0, 0.0])
+
+    words = vocabulary.sample(np.random.default_rng(5), 100000)
+    assert set(words) == {'often', 'rarely'}
+    assert abs(np.mean(words == 'often') - 0.75) < 0.01
+
+
+def test_single_word_vocabularies():
+    assert [table.tolist() for table in build_alias_table([2.0])] == [[1.0], [0]]
+    for distribution in (UNIFORM, ZIPF):
+        vocabulary = Vocabulary('test', ['only'], distribution)
+        assert vocabulary.sample(np.random.default_rng(7), 10).tolist() == ['only'] * 10